@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from src.config_loader import ConfigLoader
+from src.shared_arrays import SharedArrays
+from src.shared_arrays import attach_arrays
+from src.instrumentation import stage
+from src.instrumentation import instrument
+from src.instrumentation import Instrumentation
+from citygenerator import STAGES
+from citygenerator import generate_city
+
+# Rasters of every config attached by a worker process, by config path.
+_worker_rasters = {}
+
+
+# INPUT:    List, String, (Integer, String, String, String, Float)
+# OUTPUT:   List
+# Generates a city for every (config path, seed) job across a pool of worker
+# processes. The rasters of every config are decoded once, in this process,
+# and placed in shared memory, where the workers attach to them without
+# copying. Every job reseeds the random number generators with its seed, so
+# its city does not depend on which worker runs it or in which order. The city
+# of every job is written to its own file in output_dir, and a summary of every
+# finished job, with its timings, counters and statistics, is appended to
+# output_dir/summary.jsonl as soon as it is available. Returns the summaries in
+# the order of the jobs. If render_scale is given, every city is also rendered
+# to a PNG image next to its output, see src.render.
+def run_batch(jobs, output_dir, processes=None, output_format="json", last_stage="land_usage", raster_cache_dir=None,
+              render_scale=None):
+    os.makedirs(output_dir, exist_ok=True)
+    with SharedArrays() as shared_arrays:
+        raster_descriptors = {}
+        for config_path in dict.fromkeys(config_path for config_path, _ in jobs):
+            config = ConfigLoader(config_path, raster_cache_dir=raster_cache_dir, eager_rasters=True)
+            rasters = {name: getattr(config, name) for name in ConfigLoader.RASTERS}
+            raster_descriptors[config_path] = shared_arrays.share_all(rasters)
+
+        tasks = [(index, config_path, seed, job_output_path(output_dir, config_path, seed, output_format), output_format, last_stage,
+                  render_scale) for index, (config_path, seed) in enumerate(jobs)]
+        summaries = [None] * len(jobs)
+        with Pool(processes, initializer=_attach_worker_rasters, initargs=(raster_descriptors,)) as pool, \
+             open(os.path.join(output_dir, "summary.jsonl"), "w") as summary_file:
+            for index, summary in pool.imap_unordered(_run_job, tasks):
+                summaries[index] = summary
+                summary_file.write(json.dumps(summary) + "\n")
+                summary_file.flush()
+    return summaries
+
+
+# INPUT:    String, String, Integer, String
+# OUTPUT:   String
+# Returns the output path of a job, e.g. output_dir/auckland_seed42.json.
+def job_output_path(output_dir, config_path, seed, output_format):
+    name = "{}_seed{}".format(os.path.splitext(os.path.basename(config_path))[0], seed)
+    return os.path.join(output_dir, name + (".json" if output_format == "json" else ""))
+
+
+# INPUT:    Dictionary
+# OUTPUT:   -
+# Worker initializer. Attaches to the shared rasters of every config.
+def _attach_worker_rasters(raster_descriptors):
+    for config_path, descriptors in raster_descriptors.items():
+        _worker_rasters[config_path] = attach_arrays(descriptors)
+
+
+# INPUT:    Tuple
+# OUTPUT:   Integer, Dictionary
+# Generates the city of a single job and returns its index and summary.
+def _run_job(task):
+    from src.stats import compute_network_stats
+
+    index, config_path, seed, output_path, output_format, last_stage, render_scale = task
+    t = time.perf_counter()
+    config = ConfigLoader(config_path, rasters=_worker_rasters[config_path])
+    random.seed(seed)
+    np.random.seed(seed)
+    instrumentation = Instrumentation()
+    with instrument(instrumentation):
+        road_network, vertex_dict, land_usages = generate_city(config, output_path, output_format, last_stage)
+        render_path = None
+        if render_scale is not None:
+            from src.render import render_city_png
+            render_path = os.path.splitext(output_path)[0] + ".png"
+            with stage("render"):
+                render_city_png(render_path, config.water_map_array, road_network, land_usages, scale=render_scale)
+    stage_times = {name: stage["wall_time"] for name, stage in instrumentation.stages.items()}
+    stage_times["total"] = time.perf_counter() - t
+
+    network_stats = compute_network_stats(vertex_dict, road_network, config=config)
+    return index, {
+        "config": config_path,
+        "seed": seed,
+        "output": output_path,
+        "render": render_path,
+        "pid": os.getpid(),
+        "times": stage_times,
+        "counters": dict(instrumentation.counters),
+        "stats": {
+            "segments": len(road_network),
+            "vertices": len(vertex_dict),
+            "polygons": len(land_usages),
+            "intersection_count": network_stats["intersection_count"],
+            "average_node_degree": network_stats["average_node_degree"],
+            "total_road_length": network_stats["total_road_length"],
+            "orientation_order": network_stats["orientation_order"],
+        },
+    }
+
+
+# INPUT:    (List)
+# OUTPUT:   -
+# Command line entry point. Runs every combination of the given configs and
+# seeds, e.g.
+#   python batchgenerator.py input/configs/auckland.json input/configs/auckland_grid.json --seeds 1 2 3
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a batch of cities across a pool of processes.")
+    parser.add_argument("configs", nargs="+", help="paths to the config files")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[42], help="seeds to run every config with (default: 42)")
+    parser.add_argument("--output-dir", default=os.getcwd() + "/output/batch",
+                        help="directory of the per-job outputs and summary.jsonl (default: output/batch)")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--format", choices=["json", "binary"], default="json", help="output format (default: json)")
+    parser.add_argument("--stages", choices=STAGES, default="land_usage",
+                        help="last stage to run, later stages are skipped (default: land_usage)")
+    parser.add_argument("--raster-cache-dir", default=None, help="directory of the on-disk raster cache")
+    parser.add_argument("--render-scale", type=float, default=None,
+                        help="also render every city to a PNG image at this many output pixels per map pixel")
+    args = parser.parse_args(argv)
+
+    jobs = [(config_path, seed) for config_path in args.configs for seed in args.seeds]
+    summaries = run_batch(jobs, args.output_dir, args.processes, args.format, args.stages, args.raster_cache_dir,
+                          args.render_scale)
+
+    print("config  seed  segments  polygons  total time (s)")
+    for summary in summaries:
+        print("{}  {}  {}  {}  {:.2f}".format(os.path.basename(summary["config"]), summary["seed"],
+                                                summary["stats"]["segments"], summary["stats"]["polygons"],
+                                                summary["times"]["total"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
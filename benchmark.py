@@ -0,0 +1,394 @@
+import os
+import sys
+import copy
+import glob
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from src.config_loader import ConfigLoader
+from src.instrumentation import instrument
+from src.instrumentation import Instrumentation
+from src.road_network.vertex import Vertex
+from src.road_network.segment import Segment
+from src.road_network.road_network_store import RoadNetworkStore
+from src.road_network.road_network_generator import verify_segment
+from src.road_network.road_network_generator import generate_minor_roads
+from src.road_network.road_network_generator import generate_road_network
+from src.road_network.road_network_generator import create_vertex_index
+from src.road_network.road_network_generator import create_segment_index
+from src.road_network.spatial_index import segment_bounding_box
+from src.city_blocks.polygons import get_polygons
+from src.to_json import city_to_json
+import src.stats as stats
+
+# Minor road iteration budgets of the benchmark suite.
+SUITE_BUDGETS = [100, 1000, 10000, 100000]
+
+# Minor road iterations that fit in a single copy of the bundled maps. Minor
+# road growth fills a map after 5,500 to 10,500 iterations, depending on the
+# config. Larger budgets are benchmarked on a map tiled with enough copies, see
+# tile_config.
+MINOR_ITERATIONS_PER_MAP = 2500
+
+# Rasters used by the benchmarked stages, which are tiled by tile_config.
+TILED_RASTERS = ["road_rules_labels", "water_mask", "population_density_field", "radial_center_index",
+                 "population_density_array", "land_use_array"]
+
+# Metrics of stats.py, measured on the generated road network.
+STATS_METRICS = ["compute_average_node_degree", "compute_intersection_count", "compute_proportion_3way_intersections",
+                 "compute_proportion_4way_intersections", "compute_proportion_dead_ends", "compute_total_road_length",
+                 "compute_orientation_histogram", "compute_orientation_entropy", "compute_orientation_order"]
+
+# Differences below these are never reported as regressions, as they are
+# within the noise of a single measurement.
+MIN_DIFFERENCES = {"time": 0.005, "peak_memory": 1 << 20}
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, (Integer, Integer)
+# OUTPUT:   Float
+# Returns the average time of the spatial lookups performed by verify_segment,
+# i.e. one snapping query and one swept box candidate query, for random
+# segments of the grown network.
+def benchmark_spatial_lookups(config, store, queries=1000, seed=42):
+    vertex_index = create_vertex_index(config, store)
+    segment_index = create_segment_index(config, store)
+    rng = random.Random(seed)
+    segments = [store.segment_array(segment) for segment in rng.choices(range(store.segment_count), k=queries)]
+
+    t = time.perf_counter()
+    for start_position, end_position in segments:
+        vertex_index.nearest(end_position, config.minor_vertex_min_distance)
+        segment_index.query(segment_bounding_box(start_position, start_position + 1.5 * (end_position - start_position)))
+    return (time.perf_counter() - t) / queries
+
+
+# INPUT:    ConfigLoader, List, (Integer)
+# OUTPUT:   List
+# Grows the road network with increasingly large minor road budgets and
+# reports the marginal time spent per accepted segment between consecutive
+# budgets, together with the cost of the spatial lookups on the grown network.
+# The lookups depend on the local vertex density rather than on the
+# size of the network, so their cost should stay roughly flat as the network grows.
+def benchmark_generation_scaling(config, minor_iterations, seed=42):
+    results = []
+    previous_time = 0
+    previous_segments = 0
+    for iterations in minor_iterations:
+        config.max_minor_road_iterations = iterations
+        random.seed(seed)
+        t = time.perf_counter()
+        store = generate_road_network(config, return_store=True)
+        elapsed = time.perf_counter() - t
+
+        added_segments = store.segment_count - previous_segments
+        marginal_cost = (elapsed - previous_time) / added_segments if added_segments > 0 else float("nan")
+        results.append({
+            "minor_iterations": iterations,
+            "segments": store.segment_count,
+            "vertices": store.vertex_count,
+            "time": elapsed,
+            "marginal_time_per_segment": marginal_cost,
+            "spatial_lookup_time": benchmark_spatial_lookups(config, store, seed=seed),
+        })
+        previous_time = elapsed
+        previous_segments = store.segment_count
+    return results
+
+
+# INPUT:    Function, (Function, Integer, Bool)
+# OUTPUT:   Dictionary, Value
+# Calls function(setup()) repeats times and returns the fastest wall time,
+# excluding setup, together with the result of the last call. If
+# trace_memory is set, the function is called once more with tracemalloc
+# running to measure its peak memory, which is not included in the time.
+def measure(function, setup=lambda: None, repeats=1, trace_memory=False):
+    times = []
+    for _ in range(repeats):
+        argument = setup()
+        t = time.perf_counter()
+        result = function(argument)
+        times.append(time.perf_counter() - t)
+    measurement = {"time": min(times)}
+
+    if trace_memory:
+        argument = setup()
+        tracemalloc.start()
+        try:
+            function(argument)
+            measurement["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return measurement, result
+
+
+# INPUT:    RoadNetworkStore
+# OUTPUT:   RoadNetworkStore
+# Returns a copy of the store, so that stages modifying the road network can
+# be run repeatedly from the same network.
+def copy_store(store):
+    return RoadNetworkStore.from_arrays(store.positions, store.segment_vertices, store.is_minor_road)
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, Integer, Integer
+# OUTPUT:   List
+# Returns random minor road proposals starting at the end vertices of random
+# segments of the store, as (start vertex, Segment) pairs, for benchmarking
+# verify_segment.
+def create_proposals(config, store, count, seed):
+    rng = np.random.default_rng(seed)
+    start_vertices = store.segment_vertices[rng.integers(store.segment_count, size=count), 1]
+    angles = rng.uniform(0, 2 * np.pi, count)
+    lengths = rng.uniform(config.minor_road_min_length, config.minor_road_max_length, count)
+    end_positions = store.positions[start_vertices] + lengths[:, None] * np.column_stack((np.cos(angles), np.sin(angles)))
+    return [(int(start_vertex), Segment(segment_start=Vertex(store.positions[start_vertex]), segment_end=Vertex(end_position)))
+            for start_vertex, end_position in zip(start_vertices, end_positions)]
+
+
+# INPUT:    ConfigLoader, Integer
+# OUTPUT:   ConfigLoader
+# Returns a copy of the config whose map consists of copies x copies copies of
+# the map of the config, for benchmarking budgets too large for a single map.
+# The rasters used by the benchmarked stages are tiled, the radial centers and
+# axiom segments are repeated in every copy of the map, and the major road
+# iteration budget is multiplied by the number of copies. Other rasters are
+# not available.
+def tile_config(config, copies):
+    if copies == 1:
+        return config
+    height, width = config.road_rules_labels.shape
+    offsets = [(column * width, row * height) for row in range(copies) for column in range(copies)]
+    tiled_config = copy.copy(config)
+    for name in config.RASTERS:
+        tiled_config.__dict__[name] = None
+    for name in TILED_RASTERS:
+        raster = getattr(config, name)
+        if name == "radial_center_index" and raster is not None:
+            # Every copy of the map refers to its own copy of the radial centers.
+            raster = np.block([[raster + (row * copies + column) * len(config.radial_centers) for column in range(copies)]
+                               for row in range(copies)])
+        elif raster is not None:
+            raster = np.tile(raster, (copies, copies))
+        tiled_config.__dict__[name] = raster
+    tiled_config.radial_centers = np.concatenate([np.asarray(config.radial_centers) + offset for offset in offsets])
+
+    tiled_config.axiom = []
+    for offset in offsets:
+        for segment in config.axiom:
+            tiled_segment = Segment(segment_array=np.array([segment.start_vert.position, segment.end_vert.position]) + offset)
+            tiled_segment.is_minor_road = segment.is_minor_road
+            tiled_config.axiom.append(tiled_segment)
+    tiled_config.max_road_network_iterations = config.max_road_network_iterations * copies**2
+    return tiled_config
+
+
+# INPUT:    Dictionary, String
+# OUTPUT:   -
+# Raises an error unless the minor road growth counted by the instrumentation
+# was stopped by its iteration budget, rather than by the map being full.
+def check_budget_reached(counters, stage):
+    if counters["growth.stopped.minor_roads.max_iterations"] == 0:
+        raise RuntimeError("{} ran out of space for minor roads before reaching the iteration budget".format(stage))
+
+
+# INPUT:    String, Integer, (Integer, Integer, Bool, Integer)
+# OUTPUT:   Dictionary
+# Runs every stage of the pipeline in isolation for the config with the given
+# minor road iteration budget, with the random number generators seeded
+# before every run, and measures its time and optionally its peak memory:
+# generate_road_network, generate_minor_roads on the major roads alone,
+# verify_segment on random proposals (time per call), get_polygons,
+# get_land_usage, city_to_json (to os.devnull), every metric of stats.py and
+# all of them at once with compute_network_stats.
+# Raster loading is not measured. Growth stops early once the map is full, so
+# the map is tiled with one copy per MINOR_ITERATIONS_PER_MAP iterations of
+# the budget, see tile_config, and the growth stages are checked to have been
+# stopped by the budget.
+def benchmark_stages(config_path, minor_iterations, seed=42, repeats=1, trace_memory=False, verify_queries=1000):
+    from src.city_blocks.land_usage import get_land_usage
+
+    copies = max(1, math.ceil(math.sqrt(minor_iterations / MINOR_ITERATIONS_PER_MAP)))
+    config = tile_config(ConfigLoader(config_path, eager_rasters=True), copies)
+    config.max_minor_road_iterations = minor_iterations
+    measurements = {}
+
+    def grow(_):
+        random.seed(seed)
+        with instrument(Instrumentation()) as instrumentation:
+            grown_store = generate_road_network(config, return_store=True)
+        return grown_store, instrumentation.counters
+
+    measurements["generate_road_network"], (store, counters) = measure(grow, repeats=repeats, trace_memory=trace_memory)
+    check_budget_reached(counters, "generate_road_network")
+
+    # Grow the major roads alone, without minor road seeds, to grow the minor roads from.
+    major_config = copy.copy(config)
+    major_config.minor_road_seed_probability = 0
+    random.seed(seed)
+    major_store = generate_road_network(major_config, return_store=True)
+
+    def grow_minor_roads(major_roads):
+        random.seed(seed)
+        with instrument(Instrumentation()) as instrumentation:
+            generate_minor_roads(config, major_roads)
+        return instrumentation.counters
+
+    measurements["generate_minor_roads"], counters = measure(grow_minor_roads, lambda: copy_store(major_store), repeats, trace_memory)
+    check_budget_reached(counters, "generate_minor_roads")
+
+    proposals = create_proposals(config, store, verify_queries, seed)
+
+    def verify(network):
+        network_store, vertex_index, segment_index = network
+        for start_vertex, segment in proposals:
+            verify_segment(config, segment, start_vertex, config.minor_vertex_min_distance, network_store, vertex_index, segment_index)
+
+    def setup_verify():
+        network_store = copy_store(store)
+        return network_store, create_vertex_index(config, network_store), create_segment_index(config, network_store)
+
+    measurements["verify_segment"], _ = measure(verify, setup_verify, repeats, trace_memory)
+    measurements["verify_segment"]["time"] /= verify_queries
+
+    road_network, vertex_dict = store.to_road_network()
+    measurements["get_polygons"], polygons = measure(lambda _: get_polygons(vertex_dict), repeats=repeats, trace_memory=trace_memory)
+
+    def land_usage(_):
+        np.random.seed(seed)
+        return get_land_usage(polygons, config)
+
+    measurements["get_land_usage"], land_usages = measure(land_usage, repeats=repeats, trace_memory=trace_memory)
+
+    def write_json(_):
+        with open(os.devnull, "w") as output_file:
+            city_to_json(road_network, list(vertex_dict.keys()), land_usages, output_file)
+
+    measurements["city_to_json"], _ = measure(write_json, repeats=repeats, trace_memory=trace_memory)
+
+    orientation_histogram = stats.compute_orientation_histogram(road_network)
+    orientation_entropy = stats.compute_orientation_entropy(orientation_histogram)
+    metric_arguments = {"compute_total_road_length": lambda: stats.compute_total_road_length(road_network, config=config),
+                        "compute_orientation_histogram": lambda: stats.compute_orientation_histogram(road_network),
+                        "compute_orientation_entropy": lambda: stats.compute_orientation_entropy(orientation_histogram),
+                        "compute_orientation_order": lambda: stats.compute_orientation_order(orientation_entropy)}
+    for metric in STATS_METRICS:
+        compute = metric_arguments.get(metric, lambda metric=metric: getattr(stats, metric)(vertex_dict))
+        measurements["stats." + metric], _ = measure(lambda _: compute(), repeats=repeats, trace_memory=trace_memory)
+    measurements["stats.compute_network_stats"], _ = measure(lambda _: stats.compute_network_stats(vertex_dict, road_network, config=config),
+                                                             repeats=repeats, trace_memory=trace_memory)
+
+    return {
+        "config": os.path.basename(config_path),
+        "minor_iterations": minor_iterations,
+        "map_copies": copies,
+        "segments": store.segment_count,
+        "vertices": store.vertex_count,
+        "polygons": len(polygons),
+        "stages": measurements,
+    }
+
+
+# INPUT:    List, (List, Integer, Integer, Bool)
+# OUTPUT:   Dictionary
+# Runs benchmark_stages for every config and budget. Returns the results
+# together with a description of the environment they were measured in.
+def run_suite(config_paths, budgets=SUITE_BUDGETS, seed=42, repeats=1, trace_memory=False):
+    results = [benchmark_stages(config_path, minor_iterations, seed, repeats, trace_memory)
+               for config_path in config_paths for minor_iterations in budgets]
+    return {
+        "metadata": {"seed": seed, "repeats": repeats, "python": platform.python_version(), "numpy": np.__version__,
+                     "platform": platform.platform(), "processor": platform.processor()},
+        "results": results,
+    }
+
+
+# INPUT:    Dictionary, Dictionary, (Float)
+# OUTPUT:   List
+# Compares the results of run_suite with baseline results of the same suite.
+# Returns a regression for every stage measurement, matched by config, budget
+# and stage, that is more than tolerance (relative) and MIN_DIFFERENCES
+# (absolute) above the baseline. Measurements missing from either side are
+# skipped.
+def compare_results(suite, baseline, tolerance=0.25):
+    baseline_stages = {(result["config"], result["minor_iterations"]): result["stages"] for result in baseline["results"]}
+    regressions = []
+    for result in suite["results"]:
+        stages = baseline_stages.get((result["config"], result["minor_iterations"]), {})
+        for stage, measurement in result["stages"].items():
+            for metric, value in measurement.items():
+                baseline_value = stages.get(stage, {}).get(metric)
+                if baseline_value is None:
+                    continue
+                if value > baseline_value * (1 + tolerance) and value - baseline_value > MIN_DIFFERENCES[metric]:
+                    regressions.append({"config": result["config"], "minor_iterations": result["minor_iterations"],
+                                        "stage": stage, "metric": metric, "baseline": baseline_value, "value": value,
+                                        "ratio": value / baseline_value if baseline_value > 0 else float("inf")})
+    return regressions
+
+
+# INPUT:    (List)
+# OUTPUT:   Integer
+# Command line entry point. Runs the benchmark suite on the given configs,
+# all bundled configs by default, and prints the results. The results can be
+# written as JSON, and compared with a baseline written earlier, e.g.
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --baseline baseline.json
+# Returns 1 if a regression was found, 0 otherwise. --generation-scaling runs
+# benchmark_generation_scaling instead.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the city generation pipeline.")
+    parser.add_argument("configs", nargs="*", help="paths to the config files (default: input/configs/*.json)")
+    parser.add_argument("--budgets", type=int, nargs="+", default=SUITE_BUDGETS,
+                        help="minor road iteration budgets (default: {})".format(" ".join(map(str, SUITE_BUDGETS))))
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random number generators (default: 42)")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per measurement, the fastest is kept (default: 1)")
+    parser.add_argument("--memory", action="store_true", help="also measure the peak memory of every stage")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this path")
+    parser.add_argument("--baseline", default=None, help="compare the results with the JSON results at this path")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative slowdown reported as a regression (default: 0.25)")
+    parser.add_argument("--generation-scaling", action="store_true",
+                        help="only report the marginal cost of road network generation of the first config")
+    args = parser.parse_args(argv)
+    config_paths = args.configs or sorted(glob.glob(os.getcwd() + "/input/configs/*.json"))
+
+    if args.generation_scaling:
+        config = ConfigLoader(config_paths[0])
+        print("minor_iterations  segments  vertices  time (s)  marginal time/segment (ms)  spatial lookup (ms)")
+        for result in benchmark_generation_scaling(config, [500, 1000, 2000, 4000, 8000]):
+            print("{:>16}  {:>8}  {:>8}  {:>8.2f}  {:>26.3f}  {:>18.3f}".format(
+                result["minor_iterations"], result["segments"], result["vertices"],
+                result["time"], result["marginal_time_per_segment"] * 1000,
+                result["spatial_lookup_time"] * 1000))
+        return 0
+
+    suite = run_suite(config_paths, args.budgets, args.seed, args.repeats, args.memory)
+    for result in suite["results"]:
+        print("{}  minor_iterations={}  map_copies={}  segments={}  vertices={}  polygons={}".format(
+            result["config"], result["minor_iterations"], result["map_copies"], result["segments"], result["vertices"],
+            result["polygons"]))
+        for stage, measurement in result["stages"].items():
+            memory = "  {:>10.1f} KiB".format(measurement["peak_memory"] / 1024) if "peak_memory" in measurement else ""
+            print("  {:<45} {:>12.3f} ms{}".format(stage, measurement["time"] * 1000, memory))
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(suite, output_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_results(suite, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {config} minor_iterations={minor_iterations} {stage} {metric}: "
+                  "{baseline:.6g} -> {value:.6g} ({ratio:.2f}x)".format(**regression))
+        print("{} regression(s) against {}".format(len(regressions), args.baseline))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,77 +1,170 @@
 import os
+import sys
 import time
 import random
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.collections import LineCollection
 from src.to_json import city_to_json
+from src.to_binary import city_to_binary
 from src.config_loader import ConfigLoader
-from src.road_network.segment import Segment
+from src.instrumentation import stage
+from src.instrumentation import instrument
+from src.instrumentation import Instrumentation
 from src.road_network.road_network_generator import generate_road_network
 import src.city_blocks.polygons as polygons
-import src.city_blocks.land_usage as land_usage
-from src.stats import compute_orientation_histogram, show_orientation_histogram
-from src.stats import compute_orientation_entropy, compute_orientation_order
-from src.stats import compute_average_node_degree, compute_intersection_count, compute_total_road_length
-from src.stats import compute_proportion_3way_intersections, compute_proportion_4way_intersections, compute_proportion_dead_ends
 
+# Stages of generate, in the order they are run.
+STAGES = ["roads", "land_usage"]
 
-# INPUT:    String, (Bool, Bool)
+
+# INPUT:    String, (Bool, Bool, Bool, String, String, String, String, Bool, String, Float, String, Tuple)
 # OUTPUT:   Generated city (visualisation)
 # Main function used to generate an intermediate representation of a city.
 # If show_city is true, the representation is visualised using matplotlib.
 # If show_time is true, the process time required to generate the intermediate representation is shown.
 # If show_stats is true, the statistics used to evaluate the representation are shown
-def generate(config_path, show_city=False, show_time=False, show_stats=False):
+# The representation is written to output_path in the given output_format,
+# either "json" (output/roadnetwork.json by default) or "binary" (a directory
+# of typed arrays, output/roadnetwork by default).
+# Stages after last_stage are skipped, e.g. "roads" only grows the road network
+# and writes it without land usages, also when regenerating a city. The
+# plotting and land usage modules are only imported when they are used. The
+# statistics module is always imported, by the road network store tracking
+# metrics with NetworkStatsTracker, but it only depends on numpy; matplotlib
+# is imported by show_orientation_histogram.
+# If metrics_path is given, the wall and CPU time of every stage and the
+# counters of the road network generation are written to it as JSON, see
+# src.instrumentation. If trace_memory is also true, the peak memory of every
+# stage is traced with tracemalloc, which slows generation down.
+# If render_path is given, the city is rendered without matplotlib to a PNG
+# image at render_scale output pixels per map pixel, see src.render, which
+# also works on machines without a display.
+# If previous_path is given, the city written there in the binary format is
+# only regenerated within dirty_region, see regenerate_city.
+def generate(config_path, show_city=False, show_time=False, show_stats=False, output_path=None, output_format="json",
+             last_stage="land_usage", metrics_path=None, trace_memory=False, render_path=None, render_scale=1,
+             previous_path=None, dirty_region=None):
     if show_time:
         t = time.process_time()
 
-    # Step 0: Load config.
-    config = ConfigLoader(config_path)
-    # Step 1: Grow road network.
-    road_network, vertex_dict = generate_road_network(config)
-    # Step 2: Compute polygons based on road network.
-    polys = polygons.get_polygons(vertex_dict)
-    del polys[0] # We delete the first polygon as this corresponds to the outer area.
-    # Step 3: Determine land usages.
-    land_usages = land_usage.get_land_usage(polys, config)
-    # Step 4: Dump to .json.
-    city_to_json(road_network, list(vertex_dict.keys()), land_usages)
+    instrumentation = Instrumentation(trace_memory=trace_memory)
+    with instrument(instrumentation):
+        # Step 0: Load config.
+        with stage("config_load"):
+            config = ConfigLoader(config_path)
+        if previous_path is not None:
+            road_network, vertex_dict, land_usages = regenerate_city(config, previous_path, dirty_region, output_path, output_format,
+                                                                     last_stage)
+        else:
+            road_network, vertex_dict, land_usages = generate_city(config, output_path, output_format, last_stage)
+        if render_path is not None:
+            from src.render import render_city_png
+            with stage("render"):
+                render_city_png(render_path, config.water_map_array, road_network, land_usages, scale=render_scale)
 
     if show_time:
         print('Time:', time.process_time() - t)
+        for name, load_time in config.raster_load_times.items():
+            print('Raster load time ({}):'.format(name), load_time)
+        for name, stage_measurements in instrumentation.stages.items():
+            print('Stage time ({}):'.format(name), stage_measurements["wall_time"])
+
+    if metrics_path is not None:
+        instrumentation.metadata.update({"config": config_path, "last_stage": last_stage, "output_format": output_format,
+                                         "segments": len(road_network), "vertices": len(vertex_dict),
+                                         "polygons": len(land_usages), "raster_load_times": config.raster_load_times})
+        instrumentation.write_json(metrics_path)
 
     if show_stats:
-        orientation_histogram = compute_orientation_histogram(road_network)
-        entropy = compute_orientation_entropy(orientation_histogram)
-        orientation_order = compute_orientation_order(entropy)
-        avg_node_degree = compute_average_node_degree(vertex_dict)
-        proportion_dead_ends = compute_proportion_dead_ends(vertex_dict)
-        proportion_3way_intersections = compute_proportion_3way_intersections(vertex_dict)
-        proportion_4way_intersections = compute_proportion_4way_intersections(vertex_dict)
-        intersection_count = compute_intersection_count(vertex_dict)
-        total_road_length = compute_total_road_length(road_network, config=config)
-
-        print('Entropy:', entropy)
-        print('Orientation-Order:', orientation_order)
-        print('Average Node Degree:', avg_node_degree)
-        print('Proportion Dead-Ends:', proportion_dead_ends)
-        print('Proportion 3-way Intersections', proportion_3way_intersections)
-        print('Proportion 4-way Intersections', proportion_4way_intersections)
-        print('Intersection Count:', intersection_count)
-        print('Total Road Length:', total_road_length)
+        from src.stats import compute_network_stats, show_orientation_histogram
+
+        network_stats = compute_network_stats(vertex_dict, road_network, config=config)
+        print('Entropy:', network_stats["orientation_entropy"])
+        print('Orientation-Order:', network_stats["orientation_order"])
+        print('Average Node Degree:', network_stats["average_node_degree"])
+        print('Proportion Dead-Ends:', network_stats["proportion_dead_ends"])
+        print('Proportion 3-way Intersections', network_stats["proportion_3way_intersections"])
+        print('Proportion 4-way Intersections', network_stats["proportion_4way_intersections"])
+        print('Intersection Count:', network_stats["intersection_count"])
+        print('Total Road Length:', network_stats["total_road_length"])
 
     if show_city:
         visualise(config.water_map_array, road_network, land_usages=land_usages)
 
     if show_stats:
-        show_orientation_histogram(orientation_histogram)
+        show_orientation_histogram(network_stats["orientation_histogram"])
+
+
+# INPUT:    ConfigLoader, (String, String, String)
+# OUTPUT:   List, Dictionary, List
+# Runs the stages of generate for a loaded config up to last_stage and writes
+# the result to output_path. Returns the road network, the vertex dictionary
+# and the land usages. Every stage is measured by the active instrumentation,
+# if any.
+def generate_city(config, output_path=None, output_format="json", last_stage="land_usage"):
+    # Step 1: Grow road network.
+    with stage("roads"):
+        road_network, vertex_dict = generate_road_network(config)
+    land_usages = []
+    if STAGES.index(last_stage) >= STAGES.index("land_usage"):
+        # Step 2: Compute polygons based on road network.
+        with stage("polygons"):
+            polys = polygons.get_polygons(vertex_dict)
+        # Step 3: Determine land usages.
+        import src.city_blocks.land_usage as land_usage
+        with stage("land_usage"):
+            land_usages = land_usage.get_land_usage(polys, config)
+    # Step 4: Dump to .json or to the binary format.
+    export_city(road_network, vertex_dict, land_usages, output_path, output_format)
+
+    return road_network, vertex_dict, land_usages
+
+
+# INPUT:    ConfigLoader, String, Tuple, (String, String, String)
+# OUTPUT:   List, Dictionary, List
+# Incremental version of generate_city after an edit of the input maps of a
+# city previously written to previous_path in the binary format, which keeps
+# the road classes. Only the roads, blocks and land usages around the
+# (x0, y0, x1, y1) dirty_region are regenerated from the edited maps of the
+# config, see src.incremental_generation. If last_stage is "roads", only the
+# roads are regenerated and the city is written without land usages. The
+# result is written to output_path and returned like the result of
+# generate_city.
+def regenerate_city(config, previous_path, dirty_region, output_path=None, output_format="json", last_stage="land_usage"):
+    from src.to_binary import load_city_binary
+    from src.incremental_generation import regenerate_region
+
+    with stage("load_previous"):
+        previous = load_city_binary(previous_path)
+        store, land_usages = previous.store(), previous.land_usages()
+        # Release the memory-mapped arrays, which may be overwritten by the export.
+        del previous
+    regenerate_land_usages = STAGES.index(last_stage) >= STAGES.index("land_usage")
+    store, land_usages = regenerate_region(config, store, land_usages, dirty_region,
+                                           regenerate_land_usages=regenerate_land_usages)
+    road_network, vertex_dict = store.to_road_network()
+    export_city(road_network, vertex_dict, land_usages, output_path, output_format)
+    return road_network, vertex_dict, land_usages
+
+
+# INPUT:    List, Dictionary, List, (String, String)
+# OUTPUT:   -
+# Dumps the city to .json or to the binary format.
+def export_city(road_network, vertex_dict, land_usages, output_path=None, output_format="json"):
+    with stage("export"):
+        if output_format == "binary":
+            city_to_binary(road_network, list(vertex_dict.keys()), land_usages, output_path)
+        else:
+            city_to_json(road_network, list(vertex_dict.keys()), land_usages, output_path)
 
 
 # INPUT:    numpy.Array, List, Dict
 # OUTPUT:   matplotlib plot
 # Function used to visualise intermediate representation using matplotlib
 def visualise(water_map_array, road_network, land_usages=None):
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
     major_segment_coords = [np.array([segment.start_vert.position, segment.end_vert.position]) for segment in road_network 
                             if not segment.is_minor_road]
     minor_segment_coords = [np.array([segment.start_vert.position, segment.end_vert.position]) for segment in road_network 
@@ -108,6 +201,70 @@ def visualise(water_map_array, road_network, land_usages=None):
     plt.show()
 
 
+# INPUT:    (List)
+# OUTPUT:   -
+# Command line entry point, e.g.
+#   python citygenerator.py input/configs/auckland.json --seed 1 --stages roads --format binary
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate an intermediate representation of a city.")
+    parser.add_argument("config", nargs="?", default=os.getcwd() + "/input/configs/auckland.json",
+                        help="path to the config file (default: input/configs/auckland.json)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random number generators (default: 42)")
+    parser.add_argument("--output", default=None,
+                        help="output path (default: output/roadnetwork.json, or output/roadnetwork for binary)")
+    parser.add_argument("--format", choices=["json", "binary"], default="json", help="output format (default: json)")
+    parser.add_argument("--stages", choices=STAGES, default="land_usage",
+                        help="last stage to run, later stages are skipped (default: land_usage)")
+    parser.add_argument("--previous", default=None,
+                        help="regenerate only the dirty region of the city previously written to this binary output")
+    parser.add_argument("--dirty-region", type=int, nargs=4, metavar=("X0", "Y0", "X1", "Y1"), default=None,
+                        help="pixel bounds of the edited part of the input maps (with --previous)")
+    parser.add_argument("--previous-image", action="append", default=[],
+                        help="previous version of an edited input image, diffed with the image of the same name "
+                             "to find the dirty region (with --previous, may be repeated)")
+    parser.add_argument("--show-city", action="store_true", help="render the city using matplotlib")
+    parser.add_argument("--render", default=None, help="render the city to this PNG file, without matplotlib")
+    parser.add_argument("--render-scale", type=float, default=1, help="output pixels per map pixel of --render (default: 1)")
+    parser.add_argument("--show-time", action="store_true", help="show the time required to generate the city")
+    parser.add_argument("--show-stats", action="store_true", help="show the statistics of the road network")
+    parser.add_argument("--metrics", default=None, help="write per-stage timings and counters as JSON to this path")
+    parser.add_argument("--trace-memory", action="store_true", help="trace the peak memory of every stage (with --metrics)")
+    args = parser.parse_args(argv)
+
+    dirty_region = args.dirty_region
+    if args.previous is not None and dirty_region is None:
+        dirty_region = find_edited_region(args.previous_image)
+        if dirty_region is None:
+            parser.error("--previous requires --dirty-region or a changed --previous-image")
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    generate(args.config, show_city=args.show_city, show_time=args.show_time, show_stats=args.show_stats,
+             output_path=args.output, output_format=args.format, last_stage=args.stages,
+             metrics_path=args.metrics, trace_memory=args.trace_memory, render_path=args.render, render_scale=args.render_scale,
+             previous_path=args.previous, dirty_region=dirty_region)
+
+
+# INPUT:    List
+# OUTPUT:   Tuple | None
+# Returns the bounds of the pixels that changed between the previous versions
+# of input images and the images of the same names in input/images, or None
+# if nothing changed.
+def find_edited_region(previous_images):
+    from src.utilities import parse_image
+    from src.incremental_generation import find_dirty_region
+
+    dirty_regions = []
+    for previous_image in previous_images:
+        image = os.getcwd() + "/input/images/" + os.path.basename(previous_image)
+        dirty_region = find_dirty_region(parse_image(previous_image), parse_image(image))
+        if dirty_region is not None:
+            dirty_regions.append(dirty_region)
+    if len(dirty_regions) == 0:
+        return None
+    x0, y0, x1, y1 = np.array(dirty_regions).T
+    return (int(x0.min()), int(y0.min()), int(x1.max()), int(y1.max()))
+
+
 if __name__ == "__main__":
-    random.seed(42)
-    generate(os.getcwd() + "/input/configs/auckland.json", show_city=True, show_time=True, show_stats=True)
+    main(sys.argv[1:])
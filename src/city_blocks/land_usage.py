@@ -4,82 +4,203 @@ from matplotlib.path import Path
 from shapely.geometry import Polygon
 from src.utilities import read_tif_file
 
-# INPUT:    List, numpy.Array
+# Land use classes, in the order they are counted. Ties are resolved in favour
+# of the class listed first.
+LAND_USAGES = ["residential", "commercial", "industry"]
+
+
+# Arrays and parameters of the land use worker processes, set by _init_land_usage_worker.
+_worker_state = {}
+
+
+# INPUT:    List, ConfigLoader, (Integer, Integer, Integer, Integer)
 # OUTPUT:   List
-# Create a meshgrid (rectangular grid of unique x and y values) based on the
-# land_use_array shapes (matches the input image). Flatten each x and y arrays
-# to one-dimensional arrays and take the transposed vstack (concatenate the
-# first axis after 1-D arrays of shape (N,) have been reshaped to (1,N)).
-# Iterate through all found polygons. For each polygon, find the positions for
-# every vertex making up the polygon. Make a path combining every position. Make
-# a bool array which is True if the path contains the corresponding point from
-# the meshgrid using https://matplotlib.org/api/path_api.html#matplotlib.path.Path.contains_points.
-# Return the indices from the mask and extract the inner coordinates. Convert
-# these to a np.array and randomly sample N% of the coordinates making up the
-# polygon. Extract the colour of each sampled coordinate against the
-# land_use_array. The type of land use most common in the sample will be the
-# type of land use assigned to the polygon. Meshgrid implementation inspired:
-# by https://stackoverflow.com/a/45731214
-def get_land_usage(polygons, config, N=2):
-    size = max(config.land_use_array.shape[0], config.land_use_array.shape[1])
-    x, y = np.meshgrid(np.arange(size), np.arange(size))
-    x, y = x.flatten(), y.flatten()
-    points = np.vstack((x, y)).T
-    
+# For every polygon, find the positions of the vertices making up the polygon
+# and make a path combining every position. Only the pixels inside the
+# bounding box of the polygon can be contained by it, so we test the
+# pixel coordinates of the bounding box against the path using
+# https://matplotlib.org/api/path_api.html#matplotlib.path.Path.contains_points
+# rather than every pixel of the map. The inner coordinates are kept in
+# row-major order, and N% of them are randomly sampled. The land use of each
+# sampled coordinate is looked up in a table of the legend values and their
+# land use classes, and the classes are counted with np.bincount.
+# The type of land use most common in the sample will be the type of land use
+# assigned to the polygon.
+# By default the polygons are processed one after another, sampling with
+# np.random. If processes is given, the polygons are split into chunks of
+# chunk_size polygons that are processed by a pool of that many worker
+# processes, see get_land_usage_parallel.
+def get_land_usage(polygons, config, N=2, processes=None, seed=None, chunk_size=256):
+    if processes is not None:
+        return get_land_usage_parallel(polygons, config, N, processes, seed, chunk_size)
+
+    land_use_classes = get_land_use_lookup_table(config)
     polygon_results = []
     for polygon in polygons:
-        positions = [(int(round(vertex.position[0])), int(round(vertex.position[1]))) for vertex in polygon]
-        path = Path(positions)
-        grid = path.contains_points(points)
-        mask = grid.reshape(size, size)
-        indices = np.where(mask)
-
-        inner_coords = np.array(list(zip(indices[1], indices[0])))
-
-        if inner_coords.size == 0:
-            continue
-
-        random_indices = np.random.choice(inner_coords.shape[0], math.ceil(len(inner_coords) / N), replace=False)
-        random_coords = inner_coords[random_indices]
-        
-        land_usages = {
-            "residential" : 0,
-            "commercial" : 0,
-            "industry" : 0,
-        }
-
-        # get the land use in the sampled coordinates
-        for coord in random_coords:
-            sample = config.land_use_array[coord[1]][coord[0]]
-            if sample in config.residential_legends:
-                land_usages["residential"] += 1
-            elif sample in config.commercial_legends:
-                land_usages["commercial"] += 1
-            elif sample in config.industry_legends:
-                land_usages["industry"] += 1
-        
-        # determine land use based on the most common observed land use in the samples
-        final_use = max(land_usages, key=land_usages.get)
-        if land_usages[final_use] == 0:
-            final_use = "none"
-
-        density = get_population_density(random_coords, config.population_density_array)
-        population = get_population(config.pixel_scaling_factor, density, positions)
-
-        polygon_results.append({"polygon" : [{'x': float(vertex.position[0]), 'z': float(vertex.position[1]), 'mark': 0} for vertex in polygon], 
-                                "land_usage" : final_use, "population_density" : density, "population" : population})
+        result = get_polygon_land_usage(get_polygon_positions(polygon), config.land_use_array, config.population_density_array,
+                                        land_use_classes, config.pixel_scaling_factor, N, np.random.choice)
+        if result is not None:
+            polygon_results.append(result)
 
     return polygon_results
 
 
-# INPUT:    List, Config
+# INPUT:    List, ConfigLoader, Integer, Integer, (Integer, Integer)
+# OUTPUT:   List
+# Parallel version of get_land_usage. The polygons are split into chunks of
+# chunk_size polygons, and every chunk samples with its own random number
+# generator seeded with (seed, chunk index). The result therefore only depends
+# on the seed, which is drawn from np.random if not given, and not on the
+# number of processes. land_use_array and population_density_array are placed
+# in shared memory once rather than being pickled for every chunk, windowed
+# rasters are sent to every worker, which reads them on its own, and the
+# results are returned in the order of the polygons. With a single process the
+# chunks are processed in this process.
+def get_land_usage_parallel(polygons, config, N, processes, seed=None, chunk_size=256):
+    if seed is None:
+        seed = int(np.random.randint(2**31))
+    polygon_positions = [get_polygon_positions(polygon) for polygon in polygons]
+    chunks = list(enumerate(polygon_positions[i:i + chunk_size] for i in range(0, len(polygon_positions), chunk_size)))
+    parameters = (get_land_use_lookup_table(config), config.pixel_scaling_factor, N, seed)
+
+    if processes == 1:
+        _worker_state["arrays"] = (config.land_use_array, config.population_density_array)
+        _worker_state["parameters"] = parameters
+        chunk_results = [_get_chunk_land_usage(chunk) for chunk in chunks]
+        _worker_state.clear()
+    else:
+        from multiprocessing import Pool
+        from src.shared_arrays import SharedArrays
+        with SharedArrays() as shared_arrays:
+            descriptors = tuple(shared_arrays.share(array) if isinstance(array, np.ndarray) else array
+                                for array in (config.land_use_array, config.population_density_array))
+            with Pool(processes, initializer=_init_land_usage_worker, initargs=(descriptors, parameters)) as pool:
+                chunk_results = pool.map(_get_chunk_land_usage, chunks)
+
+    return [result for results in chunk_results for result in results]
+
+
+# INPUT:    Tuple, Tuple
+# OUTPUT:   -
+# Worker initializer. Attaches to the shared land use and population density
+# arrays, or takes the windowed rasters as they are.
+def _init_land_usage_worker(descriptors, parameters):
+    from src.shared_arrays import attach_array
+    _worker_state["arrays"] = tuple(attach_array(descriptor) if isinstance(descriptor, tuple) else descriptor
+                                    for descriptor in descriptors)
+    _worker_state["parameters"] = parameters
+
+
+# INPUT:    Tuple
 # OUTPUT:   List
+# Determines the land usages of a chunk (chunk index, list of polygon positions).
+def _get_chunk_land_usage(chunk):
+    chunk_index, polygon_positions = chunk
+    land_use_array, population_density_array = _worker_state["arrays"]
+    land_use_classes, pixel_scaling_factor, N, seed = _worker_state["parameters"]
+    rng = np.random.default_rng([seed, chunk_index])
+
+    chunk_results = []
+    for positions in polygon_positions:
+        result = get_polygon_land_usage(positions, land_use_array, population_density_array,
+                                        land_use_classes, pixel_scaling_factor, N, rng.choice)
+        if result is not None:
+            chunk_results.append(result)
+    return chunk_results
+
+
+# INPUT:    List
+# OUTPUT:   numpy.Array
+# Returns the positions of the vertices making up the polygon as an (N,2) array.
+def get_polygon_positions(polygon):
+    return np.array([vertex.position for vertex in polygon], dtype=float).reshape(-1, 2)
+
+
+# INPUT:    numpy.Array, numpy.Array, numpy.Array, numpy.Array, Float, Integer, Function
+# OUTPUT:   Dictionary | None
+# Determines the land use, population density and population of the polygon
+# with the given vertex positions, as described in get_land_usage. choice is
+# used to sample the inner coordinates, e.g. np.random.choice or the choice
+# method of a numpy Generator. Returns None if the polygon contains no pixels.
+def get_polygon_land_usage(polygon_positions, land_use_array, population_density_array, land_use_classes,
+                           pixel_scaling_factor, N, choice):
+    size = max(land_use_array.shape[0], land_use_array.shape[1])
+    positions = [(int(round(x)), int(round(y))) for x, y in polygon_positions.tolist()]
+    inner_coords = get_inner_coordinates(positions, size)
+
+    if inner_coords.size == 0:
+        return None
+
+    random_indices = choice(inner_coords.shape[0], math.ceil(len(inner_coords) / N), replace=False)
+    random_coords = inner_coords[random_indices]
+
+    # get the land use in the sampled coordinates
+    samples = land_use_array[random_coords[:, 1], random_coords[:, 0]]
+    land_usages = np.bincount(get_land_use_classes(samples, land_use_classes), minlength=len(LAND_USAGES) + 1)[:len(LAND_USAGES)]
+
+    # determine land use based on the most common observed land use in the samples
+    final_use = LAND_USAGES[int(np.argmax(land_usages))]
+    if land_usages.max() == 0:
+        final_use = "none"
+
+    density = get_population_density(random_coords, population_density_array)
+    population = get_population(pixel_scaling_factor, density, positions)
+
+    return {"polygon" : [{'x': x, 'z': y, 'mark': 0} for x, y in polygon_positions.tolist()],
+            "land_usage" : final_use, "population_density" : density, "population" : population}
+
+
+# INPUT:    List, Integer
+# OUTPUT:   numpy.Array
+# Returns the (x, y) coordinates, in row-major order, of the pixels of a
+# size x size grid contained by the polygon with the given vertex positions.
+def get_inner_coordinates(positions, size):
+    path = Path(positions)
+    min_x, min_y = np.maximum(np.min(positions, axis=0), 0)
+    max_x, max_y = np.minimum(np.max(positions, axis=0), size - 1)
+    if min_x > max_x or min_y > max_y:
+        return np.empty((0, 2), dtype=int)
+
+    x, y = np.meshgrid(np.arange(min_x, max_x + 1), np.arange(min_y, max_y + 1))
+    points = np.vstack((x.flatten(), y.flatten())).T
+    return points[path.contains_points(points)]
+
+
+# INPUT:    ConfigLoader
+# OUTPUT:   (numpy.Array, numpy.Array)
+# Returns a table of the values listed in the legends, sorted, and the index of
+# the class in LAND_USAGES each value belongs to. A value listed in several
+# legends belongs to the class checked first.
+def get_land_use_lookup_table(config):
+    legends = [config.residential_legends, config.commercial_legends, config.industry_legends]
+    values = np.array([legend for legend_list in legends for legend in legend_list], dtype=float)
+    classes = np.repeat(np.arange(len(legends)), [len(legend_list) for legend_list in legends])
+    order = np.lexsort((classes, values))
+    values, classes = values[order], classes[order]
+    first = np.concatenate(([True], values[1:] != values[:-1]))
+    return values[first], classes[first]
+
+
+# INPUT:    numpy.Array, (numpy.Array, numpy.Array)
+# OUTPUT:   numpy.Array
+# Returns the index of the class in LAND_USAGES of every sampled value of the
+# land use map, found with np.searchsorted in the lookup table, or
+# len(LAND_USAGES) if the value is not in any of the legends. Values are
+# compared as they are, so float rasters and nodata values such as -9999 are
+# handled like any other value.
+def get_land_use_classes(samples, lookup_table):
+    values, classes = lookup_table
+    if len(values) == 0:
+        return np.full(np.shape(samples), len(LAND_USAGES), dtype=np.intp)
+    indices = np.minimum(np.searchsorted(values, samples), len(values) - 1)
+    return np.where(values[indices] == samples, classes[indices], len(LAND_USAGES))
+
+
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   Float
 # Return the average population density for the given polygon.
 def get_population_density(indices, population_density_array):
-    population_density = []
-    for index in indices:
-        density = population_density_array[index[1], index[0]]
-        population_density.append(density)
+    population_density = population_density_array[indices[:, 1], indices[:, 0]].tolist()
 
     # Return the average population density.
     return sum(population_density) / len(population_density)
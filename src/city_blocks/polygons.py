@@ -1,78 +1,184 @@
 import numpy as np
-from operator import itemgetter
+from src.road_network.vertex import Vertex
 
-# INPUT:    Dictionary
+# INPUT:    Dictionary, (Bool)
 # OUTPUT:   List
-# Creates a list of all polygons in the generated road network
-def get_polygons(vertex_dict):
-    wedges = get_wedges(vertex_dict)
-    polygons = []
+# Creates a list of all polygons in the generated road network. Every polygon
+# is a face of the road network traced along its half-edges, given as the list
+# of vertices on its boundary. The outer area of the road network, i.e. the
+# face enclosing it from the outside, is traced in the opposite direction to
+# the city blocks and is only included if include_outer_faces is True.
+def get_polygons(vertex_dict, include_outer_faces=False):
+    vertices, origins, next_half_edges, start_order = get_half_edges(vertex_dict)
+    visited = [False] * len(origins)
+    faces = []
+
+    # Follow the next half-edges until we are back at the half-edge we
+    # started from. A face is discarded if it runs into a half-edge without a
+    # successor or into a half-edge that already belongs to another face.
+    for start in start_order:
+        if visited[start]:
+            continue
+        face = []
+        half_edge = start
+        while half_edge != -1 and not visited[half_edge]:
+            visited[half_edge] = True
+            face.append(half_edge)
+            half_edge = next_half_edges[half_edge]
+        if half_edge == start:
+            faces.append(face)
 
-    # INPUT:    Tuple
-    # OUTPUT:   Tuple | None
-    # Find a new set of vertices forming a wedge that shares a segment with the
-    # input vertices. This ensures the list returned is in a clockwise order.
-    def search(wedge):
-        for w in wedges:            
-            if wedge[1] is w[0] and wedge[2] is w[1]:
-                return w
-        return None
-
-    while len(wedges) > 0:
-        start = current_wedge = wedges[0]
-        current_polygon = []
-
-        while current_wedge is not None:
-            current_polygon.append(current_wedge[0])
-            wedges.remove(current_wedge)
-            if current_wedge[1] is start[0] and current_wedge[2] is start[1]:
-                polygons.append(current_polygon)
-                break
-            current_wedge = search(current_wedge)
-    
+    if len(faces) == 0:
+        return []
+
+    # The signed area of every face is computed in one pass using the shoelace
+    # formula. City blocks have a negative signed area and the outer area of
+    # the road network a positive one.
+    positions = np.array([vertex.position for vertex in vertices], dtype=float)
+    face_half_edges = np.concatenate(faces)
+    face_starts = np.cumsum([0] + [len(face) for face in faces[:-1]])
+    next_positions = positions[np.asarray(origins)[np.asarray(next_half_edges)[face_half_edges]]]
+    current_positions = positions[np.asarray(origins)[face_half_edges]]
+    cross_products = current_positions[:, 0] * next_positions[:, 1] - next_positions[:, 0] * current_positions[:, 1]
+    signed_areas = np.add.reduceat(cross_products, face_starts) / 2
+
+    polygons = []
+    for face, signed_area in zip(faces, signed_areas):
+        if include_outer_faces or signed_area <= 0:
+            polygons.append([vertices[origins[half_edge]] for half_edge in face])
     return polygons
 
 
 # INPUT:    Dictionary
+# OUTPUT:   List, List, List, List
+# Builds the half-edges of the road network. Every segment connected to a
+# vertex gives the half-edge arriving at the vertex along the segment. The
+# half-edges arriving at each vertex are sorted by the angle of their segment
+# as seen from the vertex, in one vectorised pass. After arriving at a vertex,
+# we leave it along the next segment in that order, which gives the next
+# half-edge of every half-edge in constant time.
+# Returns the list of vertices, the origin vertex index and the next half-edge
+# (-1 if there is none) of every half-edge, and the order in which the
+# half-edges are used to start tracing faces.
+def get_half_edges(vertex_dict):
+    vertices = list(vertex_dict)
+    vertex_indices = {id(vertex): index for index, vertex in enumerate(vertices)}
+    segment_indices = {}
+    origins = []
+    targets = []
+    segments = []
+
+    for target, (vertex, connected_segments) in enumerate(vertex_dict.items()):
+        for segment in connected_segments:
+            neighbour = segment.end_vert if vertex is segment.start_vert else segment.start_vert
+            if id(neighbour) not in vertex_indices:
+                # The neighbour is not part of the road network. It gets no
+                # half-edges, so faces running into it are discarded.
+                vertex_indices[id(neighbour)] = len(vertices)
+                vertices.append(neighbour)
+            origins.append(vertex_indices[id(neighbour)])
+            targets.append(target)
+            segments.append(segment_indices.setdefault(id(segment), len(segment_indices)))
+
+    if len(origins) == 0:
+        return vertices, [], [], []
+
+    positions = np.array([vertex.position for vertex in vertices], dtype=float)
+    origins = np.array(origins)
+    targets = np.array(targets)
+    segments = np.array(segments)
+
+    # Angle of every segment as seen from the vertex the half-edge arrives at.
+    vectors = positions[origins] - positions[targets]
+    alphas = np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0]))
+    alphas[alphas < 0] += 360
+
+    # Sort the half-edges by the vertex they arrive at and then by angle.
+    order = np.lexsort((alphas, targets))
+    origins, targets, segments = origins[order], targets[order], segments[order]
+
+    # The half-edge arriving at a vertex is followed by the segment next in
+    # angular order around the vertex, wrapping around at the last segment.
+    group_starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, len(targets)])
+    group_first = np.repeat(group_starts, group_sizes)
+    group_last = group_first + np.repeat(group_sizes, group_sizes) - 1
+    following = np.arange(len(targets)) + 1
+    following[following > group_last] = group_first[following > group_last]
+
+    # The next half-edge leaves the vertex along the following segment, i.e.
+    # it arrives at the origin of the following half-edge along its segment.
+    vertex_count = len(vertices)
+    keys = segments * vertex_count + targets
+    key_order = np.argsort(keys, kind="stable")
+    wanted_keys = segments[following] * vertex_count + origins[following]
+    matches = key_order[np.minimum(np.searchsorted(keys[key_order], wanted_keys), len(keys) - 1)]
+    next_half_edges = np.where((keys[matches] == wanted_keys) & (origins[matches] == targets), matches, -1)
+
+    # Faces are started from the half-edges in order of the vertex they arrive
+    # at, beginning with the half-edge arriving along the last segment.
+    ranks = (np.arange(len(targets)) - group_first + 1) % np.repeat(group_sizes, group_sizes)
+    start_order = np.lexsort((ranks, targets))
+
+    return vertices, origins.tolist(), next_half_edges.tolist(), start_order.tolist()
+
+
+# INPUT:    RoadNetworkStore, Iterable, (Bool)
 # OUTPUT:   List
-# Get tuples of vertices forming wedges. I.e. each tuple contains three
-# vertices. Each vertex in the road network is considered one at a time. A
-# vertex with four segments connected to it will have four different wedges as
-# output.
-def get_wedges(vertex_dict):
-    all_wedges = []
-    for vertex, segments in vertex_dict.items():
-
-        alphas = []
-
-        for segment in segments:
-            if vertex is segment.start_vert:
-                alpha = np.degrees(np.arctan2(segment.end_vert.position[1] - segment.start_vert.position[1],
-                                              segment.end_vert.position[0] - segment.start_vert.position[0]))
-            else:
-                alpha = np.degrees(np.arctan2(segment.start_vert.position[1] - segment.end_vert.position[1],
-                                              segment.start_vert.position[0] - segment.end_vert.position[0]))
-            
-            if alpha < 0:
-                alpha += 360
-            
-            if vertex is segment.start_vert:
-                alphas.append((segment.end_vert, alpha))
-            else:
-                alphas.append((segment.start_vert, alpha))
-        
-        # Sort list ascendingly based on angle values. 
-        alphas.sort(key=itemgetter(1))
-
-        for i in range(len(alphas)):
-            alpha = alphas[i-1]
-            next_alpha = alphas[i]
-            if i == 0:
-                angle = next_alpha[1] - alpha[1] + 360
-            else:
-                angle = next_alpha[1] - alpha[1]
-
-            angle %= 360
-            all_wedges.append((alpha[0], vertex, next_alpha[0], angle))
-
-    return all_wedges
+# Local version of get_polygons for a road network held in a RoadNetworkStore.
+# Only the faces passing through the given vertices are traced, so the work
+# is proportional to the size of these faces rather than to the size of the
+# road network, e.g. to find the city blocks changed by an edit. Faces are
+# traced along the same half-edges, in the same angular order, as
+# get_polygons, and the angular order of the segments around a vertex is only
+# computed for the vertices the faces pass through.
+def get_polygons_through(store, vertices, include_outer_faces=False):
+    positions = store.positions
+    segment_vertices = store.segment_vertices
+    leaving_orders = {}
+
+    # INPUT:    Integer
+    # OUTPUT:   List
+    # Returns the (segment, neighbour) pairs of the vertex sorted by the angle
+    # of the segment as seen from the vertex.
+    def leaving_order(vertex):
+        if vertex not in leaving_orders:
+            neighbours = []
+            for segment in store.vertex_segments(vertex):
+                start_vertex, end_vertex = segment_vertices[segment].tolist()
+                neighbours.append((segment, end_vertex if start_vertex == vertex else start_vertex))
+            vectors = positions[[neighbour for _, neighbour in neighbours]] - positions[vertex]
+            alphas = np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0])).reshape(-1)
+            alphas[alphas < 0] += 360
+            leaving_orders[vertex] = [neighbours[i] for i in np.argsort(alphas, kind="stable")]
+        return leaving_orders[vertex]
+
+    visited = set()
+    polygons = []
+    for vertex in vertices:
+        # Every face through the vertex contains a half-edge arriving at it,
+        # given as (segment, origin, target).
+        for segment, neighbour in leaving_order(vertex):
+            start = (segment, neighbour, vertex)
+            if start in visited:
+                continue
+            face = []
+            half_edge = start
+            while half_edge not in visited:
+                visited.add(half_edge)
+                segment, origin, target = half_edge
+                face.append(origin)
+                # Leave the target along the segment following the one we
+                # arrived on in angular order, wrapping around at the last.
+                order = leaving_order(target)
+                index = next(i for i, (leaving_segment, _) in enumerate(order) if leaving_segment == segment)
+                following_segment, following_neighbour = order[(index + 1) % len(order)]
+                half_edge = (following_segment, target, following_neighbour)
+
+            if half_edge == start:
+                face_positions = positions[face]
+                next_positions = np.roll(face_positions, -1, axis=0)
+                signed_area = np.sum(face_positions[:, 0] * next_positions[:, 1] - next_positions[:, 0] * face_positions[:, 1]) / 2
+                if include_outer_faces or signed_area <= 0:
+                    polygons.append([Vertex(positions[origin].copy()) for origin in face])
+    return polygons
@@ -1,14 +1,47 @@
 import os
 import json
+import time
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from src.utilities import parse_image
 from src.utilities import read_tif_file
+from src.utilities import find_legend_mask
+from src.utilities import find_mask_centers
 from src.utilities import find_legend_centers
-from src.utilities import find_legend_color_coordinates
+from src.utilities import compile_label_raster
+from src.utilities import compute_nearest_center_raster
+from src.raster_cache import raster_cache
+from src.windowed_raster import ArrayReader
+from src.windowed_raster import WindowedRaster
+from src.windowed_raster import NearestCenterReader
+from src.windowed_raster import open_raster_reader
 from src.road_network.segment import Segment
+from src.road_network.road_network_generator import Rules
 
+# Loads the configuration and the rasters it refers to. Rasters are loaded on
+# first access by default, so callers only pay for the rasters they use. If
+# eager_rasters is True, all rasters are loaded concurrently at construction
+# instead. Decoded and derived rasters are shared through the process-level
+# raster cache. If raster_cache_dir is given, they are also cached on disk and
+# memory-mapped by later loads. Rasters that are already available, e.g.
+# attached from shared memory, can be passed in the rasters dictionary. The
+# time taken to load every raster is recorded in raster_load_times.
+# If windowed_rasters is True, rasters are WindowedRasters instead of numpy
+# arrays, which read blocks of raster_block_size pixels from the source files
+# on demand and cache the last raster_cache_blocks blocks, see
+# _compute_windowed_raster. raster_overviews maps raster names to a factor by
+# which their resolution is reduced, e.g. {"population_density_array": 4}.
+# Derived rasters inherit the overviews of the rasters they are derived from.
 class ConfigLoader:
-    def __init__(self, config_path=None):
+    # Attributes holding rasters, or values derived from rasters.
+    RASTERS = ["road_rules_array", "population_density_array", "radial_centers",
+               "grid_centers", "organic_centers", "water_map_array", "land_use_array",
+               "road_rules_labels", "water_mask", "radial_center_index", "population_density_field"]
+
+    def __init__(self, config_path=None, raster_cache_dir=None, eager_rasters=False, rasters=None,
+                 windowed_rasters=False, raster_block_size=256, raster_cache_blocks=64, raster_overviews=None):
         
         try:
             with open(config_path, "r") as config_file:
@@ -20,14 +53,161 @@ class ConfigLoader:
 
         # Create starting segments based on config axiom.
         self.axiom = [Segment(segment_array=np.array(segment_coordinates)) for segment_coordinates in self.axiom]
+        self.raster_cache_dir = raster_cache_dir
+        self.windowed_rasters = windowed_rasters
+        self.raster_block_size = raster_block_size
+        self.raster_cache_blocks = raster_cache_blocks
+        self.raster_overviews = {} if raster_overviews is None else raster_overviews
+        self.raster_load_times = {}
+        self._raster_locks = {name: threading.RLock() for name in ConfigLoader.RASTERS}
+        if rasters is not None:
+            self.__dict__.update(rasters)
 
-        # Parse road rule map and population density map.
+        if eager_rasters:
+            self.load_rasters()
+
+    # The raster locks cannot be pickled. They are left out and recreated, so
+    # that a config can be sent to worker processes together with its
+    # loaded rasters.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_raster_locks"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._raster_locks = {name: threading.RLock() for name in ConfigLoader.RASTERS}
+
+    # Only called for attributes that have not been set, i.e. rasters that
+    # have not been loaded yet.
+    def __getattr__(self, name):
+        if name in ConfigLoader.RASTERS:
+            return self._get_raster(name)
+        raise AttributeError("'ConfigLoader' object has no attribute '{}'".format(name))
+
+    # INPUT:    (List, Integer)
+    # OUTPUT:   -
+    # Loads the given rasters, all rasters by default, concurrently in a
+    # thread pool. Image decoding releases the GIL, so the rasters are decoded
+    # in parallel.
+    def load_rasters(self, names=None, max_workers=None):
+        names = ConfigLoader.RASTERS if names is None else names
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self._get_raster, names))
+
+    # INPUT:    String
+    # OUTPUT:   numpy.Array
+    # Returns the raster, loading it if it has not been loaded yet. Rasters
+    # that depend on other rasters load those first.
+    def _get_raster(self, name):
+        with self._raster_locks[name]:
+            if name not in self.__dict__:
+                t = time.perf_counter()
+                if self.windowed_rasters:
+                    self.__dict__[name] = self._compute_windowed_raster(name)
+                else:
+                    self.__dict__[name] = self._compute_raster(name)
+                self.raster_load_times[name] = time.perf_counter() - t
+        return self.__dict__[name]
+
+    # INPUT:    String
+    # OUTPUT:   numpy.Array
+    def _compute_raster(self, name):
         path = os.getcwd() + "/input/images/"
-        self.road_rules_array = parse_image(path + self.rule_image_name)
-        self.population_density_array = read_tif_file(path + self.population_density_image_name)
-        # find radial centers. Only relevant if radial road rule is used.
-        self.radial_centers = find_legend_centers(self.road_rules_array, self.radial_legend)
+        rule_image = path + self.rule_image_name
+        population_density_image = path + self.population_density_image_name
+        water_map_image = path + self.water_map_image_name
+        land_use_image = path + self.land_use_image_name
+
+        # Parse road rule map and population density map.
+        if name == "road_rules_array":
+            return self._load_raster("parse_image", [rule_image], lambda: parse_image(rule_image))
+        elif name == "population_density_array":
+            return self._load_raster("read_tif_file", [population_density_image], lambda: read_tif_file(population_density_image))
+        # find radial centers. Only relevant if radial road rule is used. The
+        # centers of the grid and organic regions are available in the same way.
+        elif name in ("radial_centers", "grid_centers", "organic_centers"):
+            legend = getattr(self, name[:-len("centers")] + "legend")
+            return self._load_raster(("find_legend_centers", list(legend)), [rule_image],
+                                     lambda: np.reshape(find_legend_centers(self.road_rules_array, legend), (-1, 2)))
         # Parse water map.
-        self.water_map_array = parse_image(path + self.water_map_image_name)
+        elif name == "water_map_array":
+            return self._load_raster("parse_image", [water_map_image], lambda: parse_image(water_map_image))
         # Parse land usage map.
-        self.land_use_array = read_tif_file(path + self.land_use_image_name)
+        elif name == "land_use_array":
+            return self._load_raster("read_tif_file", [land_use_image], lambda: read_tif_file(land_use_image))
+
+        # Compile derived rasters so that every lookup during generation is a
+        # single integer-indexed read: road rule labels, a water mask, the
+        # index of the nearest radial center and a float32 population field.
+        elif name == "road_rules_labels":
+            legend_labels = [(self.grid_legend, Rules.RULE_GRID.value),
+                             (self.organic_legend, Rules.RULE_ORGANIC.value),
+                             (self.radial_legend, Rules.RULE_RADIAL.value)]
+            return self._load_raster(("compile_label_raster", repr(legend_labels)), [rule_image],
+                                     lambda: compile_label_raster(self.road_rules_array, legend_labels, Rules.RULE_ORGANIC.value))
+        elif name == "water_mask":
+            return self._load_raster(("water_mask", list(self.water_legend)), [water_map_image],
+                                     lambda: find_legend_mask(self.water_map_array, self.water_legend))
+        elif name == "radial_center_index":
+            if len(self.radial_centers) == 0:
+                return None
+            return self._load_raster(("compute_nearest_center_raster", list(self.radial_legend)), [rule_image],
+                                     lambda: compute_nearest_center_raster(self.road_rules_labels.shape, self.radial_centers))
+        elif name == "population_density_field":
+            return self._load_raster("population_density_field", [population_density_image],
+                                     lambda: np.ascontiguousarray(self.population_density_array, dtype=np.float32))
+
+    # INPUT:    String
+    # OUTPUT:   WindowedRaster | numpy.Array
+    # Windowed version of _compute_raster. GeoTIFFs are read in windows
+    # through GDAL. PNG images cannot be, and are decoded through the raster
+    # cache, which memory-maps them from raster_cache_dir if given. Derived
+    # rasters are computed block by block from their source rasters when a
+    # block is first used. The raster center lists are still computed from the
+    # whole image, one Boolean mask at a time.
+    def _compute_windowed_raster(self, name):
+        path = os.getcwd() + "/input/images/"
+        rule_image = path + self.rule_image_name
+        water_map_image = path + self.water_map_image_name
+
+        if name == "road_rules_array":
+            raster = self._windowed_raster(ArrayReader(self._load_raster("parse_image", [rule_image], lambda: parse_image(rule_image))))
+        elif name == "population_density_array":
+            raster = self._windowed_raster(open_raster_reader(path + self.population_density_image_name))
+        elif name in ("radial_centers", "grid_centers", "organic_centers"):
+            legend = getattr(self, name[:-len("centers")] + "legend")
+            legend_matches = self.road_rules_array.derive(partial(find_legend_mask, legend=legend))
+            return self._load_raster(("find_legend_centers", list(legend)), [rule_image],
+                                     lambda: np.reshape(find_mask_centers(np.asarray(legend_matches)), (-1, 2)))
+        elif name == "water_map_array":
+            raster = self._windowed_raster(ArrayReader(self._load_raster("parse_image", [water_map_image], lambda: parse_image(water_map_image))))
+        elif name == "land_use_array":
+            raster = self._windowed_raster(open_raster_reader(path + self.land_use_image_name))
+        elif name == "road_rules_labels":
+            legend_labels = [(self.grid_legend, Rules.RULE_GRID.value),
+                             (self.organic_legend, Rules.RULE_ORGANIC.value),
+                             (self.radial_legend, Rules.RULE_RADIAL.value)]
+            raster = self.road_rules_array.derive(partial(compile_label_raster, legend_labels=legend_labels,
+                                                          default_label=Rules.RULE_ORGANIC.value))
+        elif name == "water_mask":
+            raster = self.water_map_array.derive(partial(find_legend_mask, legend=self.water_legend))
+        elif name == "radial_center_index":
+            if len(self.radial_centers) == 0:
+                return None
+            raster = self._windowed_raster(NearestCenterReader(self.radial_centers, self.road_rules_labels.shape))
+        elif name == "population_density_field":
+            raster = self.population_density_array.derive(partial(np.asarray, dtype=np.float32))
+        return raster.overview(self.raster_overviews.get(name, 1))
+
+    # INPUT:    ArrayReader | GdalReader | NearestCenterReader
+    # OUTPUT:   WindowedRaster
+    def _windowed_raster(self, reader):
+        return WindowedRaster(reader, self.raster_block_size, self.raster_cache_blocks)
+
+    # INPUT:    String | Tuple, List, Function
+    # OUTPUT:   numpy.Array
+    # Loads a raster through the raster cache. The name identifies how the
+    # raster is computed from the source files, including any parameters.
+    def _load_raster(self, name, sources, compute):
+        return raster_cache.load(repr(name), sources, compute, self.raster_cache_dir)
@@ -0,0 +1,266 @@
+import numpy as np
+from collections import deque
+from src.instrumentation import count
+from src.instrumentation import stage
+from src.road_network.vertex import Vertex
+from src.road_network.segment import Segment
+from src.road_network.road_network_store import RoadNetworkStore
+from src.road_network.road_network_generator import create_vertex_index
+from src.road_network.road_network_generator import create_segment_index
+from src.road_network.road_network_generator import generate_suggested_segments
+from src.road_network.road_network_generator import check_segment
+from src.road_network.road_network_generator import create_end_vertex
+from src.road_network.road_network_generator import get_verified_end_position
+from src.road_network.road_network_generator import _add_segment
+from src.road_network.growth_rules.minor_road import minor_road
+from src.road_network.growth_rules.minor_road_seed import minor_road_seed
+from src.road_network.tiled_generation import get_seam_distance
+from src.road_network.tiled_generation import _crosses_road_network
+from src.road_network.tiled_generation import _inside
+from src.city_blocks.polygons import get_polygons_through
+from src.utilities import get_population_density_value
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, List, Tuple, (Float, Bool)
+# OUTPUT:   RoadNetworkStore, List
+# Regenerates the part of a previously generated city affected by an edit of
+# its input maps, e.g. a repainted patch of the road rule or water map, given
+# as the (x0, y0, x1, y1) bounds of the changed pixels. The config must hold
+# the edited maps. The dirty region is expanded by margin pixels, by default
+# the furthest a segment can reach from its start vertex, see
+# get_seam_distance, so that every segment touching the changed pixels has an
+# end inside the expanded region. These segments are removed, see
+# remove_region, and the roads are regrown into the region from its boundary
+# with the normal growth rules and the checks of verify_segment, see
+# regrow_region. Only the city blocks through the vertices whose roads changed
+# are traced again, see get_polygons_through, and only their land usages are
+# recomputed. The land usages of all other blocks are kept as they are. Returns
+# the new road network and the land usages, which are empty if
+# regenerate_land_usages is false. The work done is proportional to the size of
+# the edit, apart from a few vectorised passes over the arrays of the road
+# network.
+def regenerate_region(config, store, land_usages, dirty_region, margin=None, regenerate_land_usages=True):
+    import src.city_blocks.land_usage as land_usage
+
+    margin = get_seam_distance(config) if margin is None else margin
+    region = expand_region(dirty_region, margin, config.road_rules_labels.shape)
+
+    with stage("incremental_roads"):
+        new_store, removed_positions, frontier = remove_region(store, region)
+        touched_vertices = regrow_region(config, new_store, frontier, region, margin)
+    if not regenerate_land_usages:
+        return new_store, []
+    with stage("incremental_polygons"):
+        polygons = get_polygons_through(new_store, touched_vertices)
+    with stage("incremental_land_usage"):
+        new_land_usages = land_usage.get_land_usage(polygons, config)
+
+    # A block is unchanged unless one of its vertices was removed or had its
+    # roads changed, in which case it has been traced again.
+    changed_positions = removed_positions | set(map(tuple, new_store.positions[touched_vertices].tolist()))
+    kept_land_usages = [use for use in land_usages
+                        if not any((vertex['x'], vertex['z']) in changed_positions for vertex in use["polygon"])]
+    count("incremental.polygons_recomputed", len(polygons))
+    count("incremental.land_usages_kept", len(kept_land_usages))
+    return new_store, kept_land_usages + new_land_usages
+
+
+# INPUT:    Tuple, Float, Tuple
+# OUTPUT:   Tuple
+# Returns the (x0, y0, x1, y1) bounds extended by margin pixels on every side
+# and clipped to a map of the given (height, width).
+def expand_region(bounds, margin, shape):
+    height, width = shape
+    x0, y0, x1, y1 = bounds
+    margin = int(np.ceil(margin))
+    return (max(x0 - margin, 0), max(y0 - margin, 0), min(x1 + margin, width), min(y1 + margin, height))
+
+
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   Tuple | None
+# Returns the (x0, y0, x1, y1) bounds of the pixels that differ between two
+# versions of a map, or None if they are identical. All of the map is dirty
+# if its size or number of channels changed.
+def find_dirty_region(previous_array, array):
+    previous_array, array = np.asarray(previous_array), np.asarray(array)
+    if previous_array.shape != array.shape:
+        return (0, 0, array.shape[1], array.shape[0])
+    changed = previous_array != array
+    if changed.ndim == 3:
+        changed = changed.any(axis=2)
+    rows, columns = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return (int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+
+# INPUT:    RoadNetworkStore, Tuple
+# OUTPUT:   RoadNetworkStore, Set, numpy.Array
+# Removes every segment with an end inside the (x0, y0, x1, y1) region,
+# together with the vertices left without segments. Returns a new store with
+# the remaining segments, the positions of the removed vertices and the
+# frontier of the region, i.e. the vertices of the new store that lost
+# segments.
+def remove_region(store, region):
+    positions, segment_vertices = store.positions, store.segment_vertices
+    removed_segments = _inside(positions, region)[segment_vertices].any(axis=1)
+    kept_segment_vertices = segment_vertices[~removed_segments]
+    is_kept_vertex = np.zeros(store.vertex_count, dtype=bool)
+    is_kept_vertex[kept_segment_vertices.ravel()] = True
+    new_vertices = np.cumsum(is_kept_vertex) - 1
+
+    new_store = RoadNetworkStore.from_arrays(positions[is_kept_vertex], new_vertices[kept_segment_vertices],
+                                             store.is_minor_road[~removed_segments])
+    frontier = np.flatnonzero(new_store.degrees < store.degrees[is_kept_vertex])
+    count("incremental.removed_segments", int(np.sum(removed_segments)))
+    return new_store, set(map(tuple, positions[~is_kept_vertex].tolist())), frontier
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, numpy.Array, Tuple, Float
+# OUTPUT:   List
+# Regrows the roads of a region emptied by remove_region, in the same phases as
+# generate_road_network. Major roads grow from the major road segments meeting
+# at the frontier, minor road seeds are placed on the new major roads and on
+# these segments, and minor roads grow from the seeds and from the minor road
+# segments meeting at the frontier. Segments meeting at a frontier vertex grow
+# away from it, into the region. Suggested segments are only verified if they
+# end inside the region, so growth is confined to it, but they may snap to
+# vertices or intersect segments just outside of it, as long as they do not
+# cross the kept roads, see _verify_in_region. The spatial indices only hold
+# the vertices and segments within margin pixels of the region, which are the
+# only ones these segments can reach. Returns the vertices whose segments
+# changed, i.e. the frontier, the ends of the new segments and the ends of the
+# segments split by new intersections.
+def regrow_region(config, store, frontier, region, margin):
+    kept_segment_count = store.segment_count
+    kept_segment_vertices = store.segment_vertices.copy()
+    vertex_index, segment_index = _create_local_indices(config, store, expand_region(region, margin, config.road_rules_labels.shape))
+
+    major_parents, minor_parents = [], []
+    for vertex in frontier.tolist():
+        for segment in store.vertex_segments(vertex):
+            parent = _segment_towards(store, segment, vertex)
+            (minor_parents if parent.is_minor_road else major_parents).append((parent, vertex))
+
+    # Grow the major roads.
+    def suggest_major_roads(segment):
+        return generate_suggested_segments(config, segment, config.road_rules_labels, config.population_density_field)
+
+    major_segments = _grow_region(config, store, deque(major_parents), suggest_major_roads, False, config.max_road_network_iterations,
+                                  config.major_vertex_min_distance, region, vertex_index, segment_index)
+
+    # Place the minor road seeds on segments not part of an intersection.
+    minor_roads_queue = deque(minor_parents)
+    seed_candidates = major_parents + [(store.segment(segment), int(store.segment_vertices[segment, 1])) for segment in major_segments]
+    for seed_segment, start_vertex in seed_candidates:
+        if store.degree(start_vertex) >= 3:
+            continue
+        # We scale the population density which ensures the value is between [0-1].
+        population_density = get_population_density_value(seed_segment, config.population_density_field) * config.population_scaling_factor
+        suggested_seeds = minor_road_seed(config, seed_segment, population_density)
+        count("proposals.minor_seed", len(suggested_seeds))
+        for suggested_seed in suggested_seeds:
+            segment = _verify_in_region(config, suggested_seed, start_vertex, True, config.minor_vertex_min_distance,
+                                        region, store, vertex_index, segment_index)
+            if segment is not None:
+                minor_roads_queue.append((store.segment(segment), int(store.segment_vertices[segment, 1])))
+
+    # Grow the minor roads.
+    def suggest_minor_roads(segment):
+        suggested_segments = minor_road(config, segment)
+        count("proposals.minor", len(suggested_segments))
+        return suggested_segments
+
+    _grow_region(config, store, minor_roads_queue, suggest_minor_roads, True, config.max_minor_road_iterations,
+                 config.minor_vertex_min_distance, region, vertex_index, segment_index)
+
+    modified_segments = np.flatnonzero((store.segment_vertices[:kept_segment_count] != kept_segment_vertices).any(axis=1))
+    touched_vertices = np.concatenate((frontier, store.segment_vertices[kept_segment_count:].ravel(),
+                                       store.segment_vertices[modified_segments].ravel()))
+    count("incremental.added_segments", store.segment_count - kept_segment_count)
+    return np.unique(touched_vertices).tolist()
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, deque, Function, Bool, Integer, Float, Tuple, VertexIndex, SegmentIndex
+# OUTPUT:   List
+# Iterates through the queue of (segment, end vertex) pairs like the growth
+# loops of generate_road_network, expanding every segment with the suggest
+# function and verifying the suggestions within the region. Returns the
+# added segments.
+def _grow_region(config, store, queue, suggest, is_minor_road, max_iterations, min_distance, region, vertex_index, segment_index):
+    added_segments = []
+    iteration = 0
+    while queue and iteration < max_iterations:
+        current_segment, start_vertex = queue.popleft()
+        for segment in suggest(current_segment):
+            if store.degree(start_vertex) >= 4:
+                count("growth.skipped_degree_cap")
+                continue
+            new_segment = _verify_in_region(config, segment, start_vertex, is_minor_road, min_distance,
+                                            region, store, vertex_index, segment_index)
+            if new_segment is not None:
+                added_segments.append(new_segment)
+                queue.append((store.segment(new_segment), int(store.segment_vertices[new_segment, 1])))
+        iteration += 1
+    return added_segments
+
+
+# INPUT:    ConfigLoader, Segment, Integer, Bool, Float, Tuple, RoadNetworkStore, VertexIndex, SegmentIndex
+# OUTPUT:   Integer | None
+# Verifies a suggested segment ending inside the region and adds it to the
+# road network. After snapping to a vertex or shortening to an intersection
+# the segment may end outside the region, where the roads were kept and never
+# checked against it, so the verified segment is rejected if it crosses a road
+# it is not connected to, as the seam segments of stitch_tiles are. The checks
+# are done before the store is changed. Returns the added segment, or None if
+# it was rejected.
+def _verify_in_region(config, segment, start_vertex, is_minor_road, min_distance, region, store, vertex_index, segment_index):
+    if not _inside(segment.end_vert.position, region):
+        count("incremental.rejected.outside_region")
+        return None
+    verified_end = check_segment(config, segment, start_vertex, min_distance, store, vertex_index, segment_index)
+    if verified_end is None:
+        return None
+
+    connected_vertices = [start_vertex, verified_end[1]] if verified_end[0] == "vertex" else [start_vertex]
+    ignored_segments = [verified_end[1]] if verified_end[0] == "intersection" else []
+    segment_array = np.array([store.positions[start_vertex], get_verified_end_position(verified_end, segment, store)])
+    if _crosses_road_network(segment_array, connected_vertices, store, segment_index, ignored_segments):
+        count("incremental.rejected.crossing")
+        return None
+
+    end_vertex = create_end_vertex(verified_end, segment, store, vertex_index, segment_index)
+    return _add_segment(start_vertex, end_vertex, is_minor_road, store, segment_index)
+
+
+# INPUT:    RoadNetworkStore, Integer, Integer
+# OUTPUT:   Segment
+# Returns a detached Segment of the stored segment ending at the given vertex,
+# reversing it if it starts there.
+def _segment_towards(store, segment, vertex):
+    start_vertex, end_vertex = store.segment_vertices[segment].tolist()
+    if end_vertex == vertex:
+        return store.segment(segment)
+    reversed_segment = Segment(segment_start=Vertex(store.positions[end_vertex].copy()),
+                               segment_end=Vertex(store.positions[start_vertex].copy()))
+    reversed_segment.is_minor_road = bool(store.is_minor_road[segment])
+    return reversed_segment
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, Tuple
+# OUTPUT:   VertexIndex, SegmentIndex
+# Creates the spatial indices holding the vertices inside the bounds and the
+# segments whose bounding boxes overlap them.
+def _create_local_indices(config, store, bounds):
+    vertex_index = create_vertex_index(config)
+    segment_index = create_segment_index(config)
+    for vertex in np.flatnonzero(_inside(store.positions, bounds)).tolist():
+        vertex_index.insert(vertex, store.positions[vertex])
+
+    x0, y0, x1, y1 = bounds
+    segment_arrays = store.positions[store.segment_vertices]
+    overlapping = ((segment_arrays[:, :, 0].max(axis=1) >= x0) & (segment_arrays[:, :, 0].min(axis=1) <= x1) &
+                   (segment_arrays[:, :, 1].max(axis=1) >= y0) & (segment_arrays[:, :, 1].min(axis=1) <= y1))
+    for segment in np.flatnonzero(overlapping).tolist():
+        segment_index.insert(segment, *segment_arrays[segment])
+    return vertex_index, segment_index
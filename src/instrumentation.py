@@ -0,0 +1,117 @@
+import json
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# The instrumentation collecting measurements in this process, set by
+# instrument. Stages and counters are ignored while it is None.
+_active = None
+
+
+# Collects the wall and CPU time of every stage of the generation pipeline,
+# counters of the hot paths, e.g. the rejections of verify_segment by reason,
+# and optionally the peak memory allocated while every stage runs, traced
+# with tracemalloc. Stages may be nested, e.g. "major_roads" within "roads",
+# and a stage that runs several times accumulates its times. Measurements are
+# only collected while the instrumentation is active, see instrument, and
+# only in this process; work done in worker processes is timed as part of the
+# stage that waits for it but is not counted.
+class Instrumentation:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.counters = Counter()
+        self.metadata = {}
+        self._stage_stack = []
+
+    # INPUT:    String
+    # OUTPUT:   -
+    # Context manager measuring the stage with the given name.
+    @contextmanager
+    def stage(self, name):
+        entry = {"peak_memory": 0}
+        if self.trace_memory:
+            entry["start_memory"] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._stage_stack.append(entry)
+        wall_time, cpu_time = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall_time, cpu_time = time.perf_counter() - wall_time, time.process_time() - cpu_time
+            self._stage_stack.pop()
+            stage = self.stages.setdefault(name, {"wall_time": 0.0, "cpu_time": 0.0, "calls": 0})
+            stage["wall_time"] += wall_time
+            stage["cpu_time"] += cpu_time
+            stage["calls"] += 1
+            if self.trace_memory:
+                # Peak traced memory above the memory in use when the stage
+                # started, including the peaks of nested stages, which reset
+                # the tracemalloc peak.
+                peak_memory = max(entry["peak_memory"], tracemalloc.get_traced_memory()[1]) - entry["start_memory"]
+                stage["peak_memory"] = max(stage.get("peak_memory", 0), peak_memory)
+                if self._stage_stack:
+                    parent = self._stage_stack[-1]
+                    parent["peak_memory"] = max(parent["peak_memory"], peak_memory + entry["start_memory"])
+
+    # INPUT:    String, (Integer)
+    # OUTPUT:   -
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    # INPUT:    -
+    # OUTPUT:   Dictionary
+    def to_dict(self):
+        return {"metadata": self.metadata, "stages": self.stages, "counters": dict(sorted(self.counters.items()))}
+
+    # INPUT:    String | File
+    # OUTPUT:   -
+    # Writes the measurements as JSON to the given path or file-like object.
+    def write_json(self, output):
+        if isinstance(output, str):
+            with open(output, "w") as output_file:
+                json.dump(self.to_dict(), output_file, indent=2)
+        else:
+            json.dump(self.to_dict(), output, indent=2)
+
+
+# INPUT:    Instrumentation
+# OUTPUT:   -
+# Context manager activating the instrumentation in this process. Starts
+# tracemalloc if the instrumentation traces memory and it is not running yet.
+@contextmanager
+def instrument(instrumentation):
+    global _active
+    previous = _active
+    started_tracing = instrumentation.trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _active = instrumentation
+    try:
+        yield instrumentation
+    finally:
+        _active = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+
+# INPUT:    String
+# OUTPUT:   -
+# Context manager measuring the stage in the active instrumentation, if any.
+@contextmanager
+def stage(name):
+    if _active is None:
+        yield
+    else:
+        with _active.stage(name):
+            yield
+
+
+# INPUT:    String, (Integer)
+# OUTPUT:   -
+# Adds the value to the counter of the active instrumentation, if any. Cheap
+# enough to be called on the hot paths of generation.
+def count(name, value=1):
+    if _active is not None:
+        _active.counters[name] += value
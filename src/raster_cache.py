@@ -0,0 +1,112 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# Process-level LRU cache of decoded and derived rasters. Every raster is
+# identified by a name, describing how it is computed, and the source files it
+# is computed from. The size and modification time of the source files are part
+# of the key, so a raster is recomputed as soon as one of its sources changes.
+# If a cache directory is given, rasters are also stored there as .npy files
+# and memory-mapped on later loads, including in other processes. Cached arrays
+# are shared between callers and therefore read-only. The cache can be used
+# from several threads; a raster requested by two threads at once may be
+# computed twice.
+class RasterCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # INPUT:    String, List, Function, (String)
+    # OUTPUT:   numpy.Array
+    # Returns the raster computed by compute() from the given source files,
+    # either from memory, from the cache directory or by computing it.
+    def load(self, name, sources, compute, cache_dir=None):
+        signatures = tuple(source_signature(source) for source in sources)
+        key = (name,) + signatures
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        array = None
+        if cache_dir is not None:
+            cache_file = cache_file_path(cache_dir, name, sources, signatures)
+            if os.path.exists(cache_file):
+                array = np.load(cache_file, mmap_mode="r")
+
+        if array is None:
+            array = np.asarray(compute())
+            array.flags.writeable = False
+            if cache_dir is not None:
+                write_cache_file(cache_file, array)
+
+        with self.lock:
+            self.entries[key] = array
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return array
+
+    # INPUT:    -
+    # OUTPUT:   -
+    # Empties the in-memory cache. Files in cache directories are kept.
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# INPUT:    String
+# OUTPUT:   Tuple
+# Returns the absolute path, size and modification time of the file.
+def source_signature(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+# INPUT:    String, String, List, Tuple
+# OUTPUT:   String
+# Returns the path of the cache file of a raster. The file name consists of
+# the name of the first source, a hash of what the raster is (name and source
+# paths) and a hash of the source file versions.
+def cache_file_path(cache_dir, name, sources, signatures):
+    raster_hash = hashlib.sha1(repr((name, [os.path.abspath(source) for source in sources])).encode()).hexdigest()[:16]
+    version_hash = hashlib.sha1(repr(signatures).encode()).hexdigest()[:16]
+    base_name = os.path.basename(sources[0]) if len(sources) > 0 else "raster"
+    return os.path.join(cache_dir, "{}.{}.{}.npy".format(base_name, raster_hash, version_hash))
+
+
+# INPUT:    String, numpy.Array
+# OUTPUT:   -
+# Writes the array to the cache file and removes cache files of older versions
+# of the same raster. The file is written under a temporary name first so that
+# other processes never memory-map a partially written file.
+def write_cache_file(cache_file, array):
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_file = "{}.{}.tmp.npy".format(cache_file[:-len(".npy")], os.getpid())
+    np.save(temporary_file, array)
+    os.replace(temporary_file, cache_file)
+
+    raster_prefix = os.path.basename(cache_file).rsplit(".", 2)[0] + "."
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(raster_prefix) and file_name != os.path.basename(cache_file) and not file_name.endswith(".tmp.npy"):
+            try:
+                os.remove(os.path.join(cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+
+
+# The cache shared by every ConfigLoader in the process.
+raster_cache = RasterCache()
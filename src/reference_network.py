@@ -0,0 +1,236 @@
+import os
+import json
+import math
+import hashlib
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from src.stats import compute_network_stats_from_arrays
+from src.raster_cache import source_signature
+
+# Version of the reference statistics. Cached fingerprints of other versions
+# are recomputed.
+REFERENCE_STATS_VERSION = 1
+
+# Values of the OSM highway tag that are not part of the drivable network,
+# following the drive network type of osmnx.
+NON_DRIVE_HIGHWAYS = {"abandoned", "bridleway", "bus_guideway", "construction", "corridor", "cycleway", "elevator",
+                      "escalator", "footway", "no", "path", "pedestrian", "planned", "platform", "proposed",
+                      "raceway", "razed", "service", "steps", "track"}
+
+# Mean radius of the earth in metres, used for the length of edges without a length.
+EARTH_RADIUS = 6371009
+
+
+# Road network used as a reference for the generated networks, e.g. a real
+# city downloaded from OpenStreetMap. Nodes are given as an (N,2) array of
+# (x, y) positions, for OSM data (longitude, latitude), and edges as an (M,2)
+# array of node indices. Nodes at the same position are merged when the
+# network is loaded. Edges are kept as given, so a two-way street of a
+# directed graph is listed in both directions, which is how its orientation
+# is weighted. edge_lengths holds the length of every edge in metres.
+class ReferenceNetwork:
+    def __init__(self, positions, edges, edge_lengths=None):
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.edge_lengths = compute_haversine_lengths(self.positions[self.edges]) if edge_lengths is None else np.asarray(edge_lengths, dtype=float)
+
+    # INPUT:    -
+    # OUTPUT:   numpy.Array
+    # Returns the degree of every node, counting the distinct neighbours it is
+    # connected to regardless of direction, as the generator's vertex
+    # dictionary does. A self-loop counts once.
+    def degrees(self):
+        unique_edges = np.unique(np.sort(self.edges, axis=1), axis=0)
+        loops = unique_edges[:, 0] == unique_edges[:, 1]
+        endpoints = np.concatenate((unique_edges[:, 0], unique_edges[~loops, 1]))
+        return np.bincount(endpoints, minlength=len(self.positions))
+
+    # INPUT:    -
+    # OUTPUT:   Float
+    # Returns the total length of the streets in metres, counting every pair
+    # of connected nodes once.
+    def total_length(self):
+        _, first_edges = np.unique(np.sort(self.edges, axis=1), axis=0, return_index=True)
+        return float(np.sum(self.edge_lengths[first_edges]))
+
+    # INPUT:    -
+    # OUTPUT:   Dictionary
+    # Computes the metrics of the network with the same engine as the
+    # generated networks, see compute_network_stats_from_arrays. The total
+    # road length is replaced by the length of the streets in metres. Nodes
+    # without edges are left out, as they are not part of the road network.
+    def stats(self):
+        degrees = self.degrees()
+        edge_arrays = self.positions[self.edges]
+        network_stats = compute_network_stats_from_arrays(degrees[degrees > 0], edge_arrays[:, 1] - edge_arrays[:, 0])
+        network_stats["total_road_length"] = self.total_length()
+        return network_stats
+
+    # INPUT:    -
+    # OUTPUT:   List
+    # Returns the edges as Segments, e.g. for visualise.
+    def to_road_network(self):
+        from src.road_network.segment import Segment
+        return [Segment(segment_array=segment_array) for segment_array in self.positions[self.edges]]
+
+
+# INPUT:    String
+# OUTPUT:   ReferenceNetwork
+# Loads a reference network from a local file: GraphML (.graphml), e.g. as
+# saved by osmnx.save_graphml, OSM XML (.osm, .xml) or the compact array dump
+# written by save_reference_network (.npz).
+def load_reference_network(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".graphml":
+        return load_graphml(path)
+    elif extension in (".osm", ".xml"):
+        return load_osm_xml(path)
+    elif extension == ".npz":
+        with np.load(path) as arrays:
+            return ReferenceNetwork(arrays["positions"], arrays["edges"], arrays["edge_lengths"])
+    raise ValueError("Unknown reference network format: {}".format(path))
+
+
+# INPUT:    String, ReferenceNetwork
+# OUTPUT:   -
+# Writes the network as a compact array dump, which loads without parsing.
+def save_reference_network(path, network):
+    np.savez(path, positions=network.positions, edges=network.edges, edge_lengths=network.edge_lengths)
+
+
+# INPUT:    String
+# OUTPUT:   ReferenceNetwork
+# Loads a GraphML graph whose nodes have x and y attributes, as written by
+# osmnx. The length attribute of the edges is used if every edge has one.
+# The file is parsed incrementally and nodes are deduplicated by id and
+# position with dictionaries.
+def load_graphml(path):
+    attribute_keys = {}
+    node_indices = {}
+    position_indices = {}
+    positions = []
+    edge_ids = []
+    edge_lengths = []
+
+    for _, element in ElementTree.iterparse(path, events=("end",)):
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "key":
+            attribute_keys[(element.get("for"), element.get("attr.name"))] = element.get("id")
+        elif tag == "node":
+            data = _graphml_data(element)
+            position = (float(data[attribute_keys[("node", "x")]]), float(data[attribute_keys[("node", "y")]]))
+            node_indices[element.get("id")] = _position_index(position, position_indices, positions)
+            element.clear()
+        elif tag == "edge":
+            length = _graphml_data(element).get(attribute_keys.get(("edge", "length")))
+            edge_ids.append((element.get("source"), element.get("target")))
+            edge_lengths.append(float(length) if length is not None else math.nan)
+            element.clear()
+
+    edges = [(node_indices[source], node_indices[target]) for source, target in edge_ids]
+    edge_lengths = None if np.isnan(edge_lengths).any() else edge_lengths
+    return ReferenceNetwork(positions, edges, edge_lengths)
+
+
+# INPUT:    String
+# OUTPUT:   ReferenceNetwork
+# Loads the drivable roads of an OSM XML file. Every way tagged as a drivable
+# highway contributes an edge between each pair of consecutive nodes, in both
+# directions unless it is one-way, as in an osmnx drive graph. Unlike osmnx,
+# chains of nodes between intersections are not simplified into single
+# edges; such nodes have degree 2 and are ignored by the degree metrics.
+def load_osm_xml(path):
+    node_positions = {}
+    ways = []
+
+    for _, element in ElementTree.iterparse(path, events=("end",)):
+        if element.tag == "node":
+            node_positions[element.get("id")] = (float(element.get("lon")), float(element.get("lat")))
+            element.clear()
+        elif element.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+            if _is_drivable(tags):
+                ways.append(([nd.get("ref") for nd in element.iter("nd")], tags.get("oneway") in ("yes", "true", "1", "-1")))
+            element.clear()
+
+    position_indices = {}
+    positions = []
+    edges = []
+    for refs, oneway in ways:
+        indices = [_position_index(node_positions[ref], position_indices, positions) for ref in refs if ref in node_positions]
+        for start, end in zip(indices[:-1], indices[1:]):
+            edges.append((start, end))
+            if not oneway:
+                edges.append((end, start))
+    return ReferenceNetwork(positions, edges)
+
+
+# INPUT:    String, (String)
+# OUTPUT:   Dictionary
+# Returns the metrics of the reference network in the file. If cache_dir is
+# given, the metrics are cached there as a JSON fingerprint keyed by the
+# path, size and modification time of the file, so repeated comparisons
+# against the same reference do not load it again.
+def compute_reference_stats(path, cache_dir=None):
+    cache_file = None
+    if cache_dir is not None:
+        signature = repr((REFERENCE_STATS_VERSION,) + source_signature(path))
+        cache_file = os.path.join(cache_dir, "{}.{}.json".format(os.path.basename(path), hashlib.sha1(signature.encode()).hexdigest()[:16]))
+        if os.path.exists(cache_file):
+            with open(cache_file) as fingerprint_file:
+                return json.load(fingerprint_file)
+
+    reference_stats = load_reference_network(path).stats()
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        with open(temporary_file, "w") as fingerprint_file:
+            json.dump(reference_stats, fingerprint_file)
+        os.replace(temporary_file, cache_file)
+    return reference_stats
+
+
+# INPUT:    numpy.Array
+# OUTPUT:   numpy.Array
+# Returns the great-circle length in metres of every (M,2,2) edge given as
+# (longitude, latitude) positions in degrees.
+def compute_haversine_lengths(edge_arrays):
+    longitudes, latitudes = np.radians(edge_arrays[..., 0]), np.radians(edge_arrays[..., 1])
+    half_chord = (np.sin((latitudes[:, 1] - latitudes[:, 0]) / 2) ** 2 +
+                  np.cos(latitudes[:, 0]) * np.cos(latitudes[:, 1]) * np.sin((longitudes[:, 1] - longitudes[:, 0]) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(half_chord, 0, 1)))
+
+
+# INPUT:    String, Tuple, (String)
+# OUTPUT:   -
+# Downloads the drivable road network within the (north, south, east, west)
+# bounding box with osmnx and saves it as GraphML for load_reference_network.
+# Requires osmnx and network access.
+def download_reference_network(path, bbox, network_type="drive"):
+    import osmnx as ox
+    north, south, east, west = bbox
+    ox.save_graphml(ox.graph_from_bbox(north, south, east, west, network_type=network_type), path)
+
+
+# INPUT:    Tuple, Dictionary, List
+# OUTPUT:   Integer
+# Returns the index of the position, adding it if it has not been seen.
+def _position_index(position, position_indices, positions):
+    index = position_indices.get(position)
+    if index is None:
+        index = position_indices[position] = len(positions)
+        positions.append(position)
+    return index
+
+
+# INPUT:    Element
+# OUTPUT:   Dictionary
+def _graphml_data(element):
+    return {data.get("key"): data.text for data in element if data.tag.rsplit("}", 1)[-1] == "data"}
+
+
+# INPUT:    Dictionary
+# OUTPUT:   Bool
+def _is_drivable(tags):
+    return ("highway" in tags and tags["highway"] not in NON_DRIVE_HIGHWAYS and tags.get("area") != "yes"
+            and tags.get("access") != "private" and tags.get("motor_vehicle") != "no" and tags.get("motorcar") != "no")
@@ -0,0 +1,167 @@
+import numpy as np
+
+# Colours of the land usages, as drawn by visualise in citygenerator.py.
+LAND_USAGE_COLOURS = {"residential": (128, 0, 128), "commercial": (191, 191, 0), "industry": (0, 0, 255)}
+DEFAULT_LAND_USAGE_COLOUR = (255, 0, 0)
+
+MAJOR_ROAD_COLOUR = (31, 119, 180)
+MINOR_ROAD_COLOUR = (0, 0, 0)
+MINOR_ROAD_OPACITY = 0.8
+
+
+# INPUT:    numpy.Array, List, (List, Float, Float, Float)
+# OUTPUT:   numpy.Array
+# Headless replacement of visualise. Draws the land usage polygons and the
+# roads of the city over the water map into an RGB image buffer, without
+# matplotlib, and returns it as an (H,W,3) uint8 array. The image has scale
+# output pixels per pixel of the water map. Polygons are filled all at once
+# with a scanline rasterizer and roads are drawn all at once by stamping a
+# round brush of the road width, in output pixels, along every segment. As in
+# visualise, the major roads are drawn over the polygons and the minor roads,
+# slightly transparent, over the major roads.
+def render_city(water_map_array, road_network, land_usages=None, scale=1, major_road_width=2, minor_road_width=1):
+    image = render_background(water_map_array, scale)
+
+    if land_usages:
+        polygon_positions = [np.array([(vertex['x'], vertex['z']) for vertex in use["polygon"]], dtype=float).reshape(-1, 2)
+                             for use in land_usages]
+        colours = np.array([LAND_USAGE_COLOURS.get(use["land_usage"], DEFAULT_LAND_USAGE_COLOUR) for use in land_usages], dtype=np.uint8)
+        pixels, polygon_indices = rasterize_polygons([_to_image_positions(positions, scale) for positions in polygon_positions],
+                                                     image.shape[:2])
+        image.reshape(-1, 3)[pixels] = colours[polygon_indices]
+
+    segment_arrays = np.array([(segment.start_vert.position, segment.end_vert.position) for segment in road_network],
+                              dtype=float).reshape(-1, 2, 2)
+    is_minor_road = np.array([segment.is_minor_road for segment in road_network], dtype=bool)
+    major_pixels = rasterize_lines(_to_image_positions(segment_arrays[~is_minor_road], scale), major_road_width, image.shape[:2])
+    image.reshape(-1, 3)[major_pixels] = MAJOR_ROAD_COLOUR
+    minor_pixels = rasterize_lines(_to_image_positions(segment_arrays[is_minor_road], scale), minor_road_width, image.shape[:2])
+    blended = (1 - MINOR_ROAD_OPACITY) * image.reshape(-1, 3)[minor_pixels] + MINOR_ROAD_OPACITY * np.array(MINOR_ROAD_COLOUR)
+    image.reshape(-1, 3)[minor_pixels] = np.round(blended).astype(np.uint8)
+    return image
+
+
+# INPUT:    String, numpy.Array, List, (List, Float, Float, Float)
+# OUTPUT:   -
+# Renders the city with render_city and writes it to path as a PNG image.
+def render_city_png(path, water_map_array, road_network, land_usages=None, scale=1, major_road_width=2, minor_road_width=1):
+    save_png(path, render_city(water_map_array, road_network, land_usages, scale, major_road_width, minor_road_width))
+
+
+# INPUT:    String, numpy.Array
+# OUTPUT:   -
+def save_png(path, image):
+    from PIL import Image
+    Image.fromarray(image).save(path, format="PNG")
+
+
+# INPUT:    numpy.Array, Float
+# OUTPUT:   numpy.Array
+# Returns the water map as an RGB uint8 image resized to scale output pixels
+# per pixel, using the nearest pixel. Transparent maps are composited over
+# white, as matplotlib shows them.
+def render_background(water_map_array, scale=1):
+    water_map_array = np.asarray(water_map_array)
+    height, width = water_map_array.shape[:2]
+    rows = np.minimum((np.arange(int(round(height * scale))) + 0.5) / scale, height - 1).astype(int)
+    columns = np.minimum((np.arange(int(round(width * scale))) + 0.5) / scale, width - 1).astype(int)
+    background = np.atleast_3d(water_map_array[rows[:, None], columns]).astype(float)
+
+    if background.shape[2] in (2, 4):
+        alpha = background[..., -1:] / 255
+        background = background[..., :-1] * alpha + 255 * (1 - alpha)
+    if background.shape[2] == 1:
+        background = np.repeat(background, 3, axis=2)
+    return np.ascontiguousarray(np.round(background), dtype=np.uint8)
+
+
+# INPUT:    List, Tuple
+# OUTPUT:   numpy.Array, numpy.Array
+# Rasterizes a list of polygons, given as (N,2) arrays of (x, y) positions in
+# image coordinates, into an image of the given (height, width). A pixel
+# belongs to a polygon if its center is inside it by the even-odd rule. All
+# polygons are rasterized at once: every edge is intersected with the rows of
+# pixel centers it spans, the intersections are sorted by polygon, row and x,
+# and consecutive pairs of intersections enclose a span of pixels. Returns the
+# flat index of every covered pixel and the index of the polygon covering it,
+# in polygon order, so that later polygons overwrite earlier ones on
+# assignment.
+def rasterize_polygons(polygons, shape):
+    height, width = shape
+    polygons = [positions for positions in polygons if len(positions) >= 3]
+    if not polygons:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # Edges from every vertex to the next, closing every polygon.
+    starts = np.concatenate(polygons)
+    ends = np.concatenate([np.roll(positions, -1, axis=0) for positions in polygons])
+    edge_polygons = np.repeat(np.arange(len(polygons)), [len(positions) for positions in polygons])
+
+    # The rows of pixel centers y crossed by an edge, with min_y <= y < max_y.
+    min_y, max_y = np.minimum(starts[:, 1], ends[:, 1]), np.maximum(starts[:, 1], ends[:, 1])
+    first_rows = np.clip(np.ceil(min_y), 0, height).astype(np.intp)
+    row_counts = np.maximum(np.clip(np.ceil(max_y), 0, height).astype(np.intp) - first_rows, 0)
+    edges = np.repeat(np.arange(len(starts)), row_counts)
+    rows = first_rows[edges] + _ranges(row_counts)
+
+    start_x, start_y = starts[edges, 0], starts[edges, 1]
+    slopes = (ends[edges, 0] - start_x) / (ends[edges, 1] - start_y)
+    crossings_x = start_x + (rows - start_y) * slopes
+    crossing_polygons = edge_polygons[edges]
+
+    # Every polygon crosses every row an even number of times, so after
+    # sorting, the crossings pair up into the spans inside the polygon.
+    order = np.lexsort((crossings_x, rows, crossing_polygons))
+    span_polygons, span_rows = crossing_polygons[order][0::2], rows[order][0::2]
+    first_columns = np.clip(np.ceil(crossings_x[order][0::2]), 0, width).astype(np.intp)
+    column_counts = np.maximum(np.clip(np.ceil(crossings_x[order][1::2]), 0, width).astype(np.intp) - first_columns, 0)
+
+    spans = np.repeat(np.arange(len(span_rows)), column_counts)
+    pixels = span_rows[spans] * width + first_columns[spans] + _ranges(column_counts)
+    return pixels, span_polygons[spans]
+
+
+# INPUT:    numpy.Array, Float, Tuple
+# OUTPUT:   numpy.Array
+# Rasterizes an (N,2,2) array of line segments in image coordinates with the
+# given width into an image of the given (height, width). Every segment is
+# sampled every half pixel, and a round brush of the line width is stamped on
+# every sample. Returns the sorted, unique flat indices of the covered pixels.
+def rasterize_lines(segment_arrays, line_width, shape):
+    height, width = shape
+    if len(segment_arrays) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    segment_vectors = segment_arrays[:, 1] - segment_arrays[:, 0]
+    sample_counts = np.ceil(2 * np.sqrt(np.einsum("ij,ij->i", segment_vectors, segment_vectors))).astype(np.intp) + 1
+    segments = np.repeat(np.arange(len(segment_arrays)), sample_counts)
+    fractions = _ranges(sample_counts) / np.maximum(sample_counts - 1, 1)[segments]
+    samples = np.rint(segment_arrays[segments, 0] + fractions[:, None] * segment_vectors[segments]).astype(np.intp)
+
+    # Offsets of the pixels within the brush, at least the center pixel.
+    radius = max(line_width / 2, 0.5)
+    reach = int(np.floor(radius))
+    offset_y, offset_x = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    brush = (offset_x ** 2 + offset_y ** 2) <= radius ** 2
+    x = (samples[:, 0, None] + offset_x[brush]).ravel()
+    y = (samples[:, 1, None] + offset_y[brush]).ravel()
+
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    return np.unique(y[inside] * width + x[inside])
+
+
+# INPUT:    numpy.Array, Float
+# OUTPUT:   numpy.Array
+# Maps positions in pixels of the input maps to output pixels at the given
+# scale, so that the center of a map pixel is at the center of the block of
+# output pixels covering it.
+def _to_image_positions(positions, scale):
+    return positions * scale + (scale - 1) / 2
+
+
+# INPUT:    numpy.Array
+# OUTPUT:   numpy.Array
+# Returns 0..n-1 for every count n, concatenated.
+def _ranges(counts):
+    offsets = np.cumsum(counts) - counts
+    return np.arange(int(np.sum(counts))) - np.repeat(offsets, counts)
@@ -4,7 +4,9 @@ from src.utilities import rotate
 from src.road_network.vertex import Vertex
 from src.road_network.segment import Segment
 from src.road_network.growth_rules.grid import grid
+from src.road_network.growth_rules.grid import grid_batch
 from src.road_network.growth_rules.organic import organic
+from src.road_network.growth_rules.organic import organic_batch
 
 def minor_road(config, segment):
     road_organic_probability = config.minor_road_organic_probability
@@ -13,3 +15,29 @@ def minor_road(config, segment):
         return organic(config,segment, 1.5)
     else:
         return grid(config, segment, 1.5)
+
+
+# INPUT:    ConfigLoader, numpy.Array, numpy.Array, numpy.Array, numpy.random.Generator
+# OUTPUT:   numpy.Array, numpy.Array
+# Batched version of minor_road for N parent segments given by their (N,2)
+# start and end positions and road classes. Returns the parent index and end
+# position of every suggested segment, ordered by parent.
+def minor_road_batch(config, start_positions, end_positions, is_minor_road, rng):
+    use_organic = rng.uniform(0, 1, len(end_positions)) <= config.minor_road_organic_probability
+    population_density = np.full(len(end_positions), 1.5)
+
+    parents = []
+    suggested_positions = []
+    for rule, mask in ((organic_batch, use_organic), (grid_batch, ~use_organic)):
+        if mask.any():
+            rule_parents, rule_positions = rule(config, start_positions[mask], end_positions[mask],
+                                                is_minor_road[mask], population_density[mask], rng)
+            parents.append(np.nonzero(mask)[0][rule_parents])
+            suggested_positions.append(rule_positions)
+
+    if not parents:
+        return np.empty(0, dtype=int), np.empty((0, 2))
+
+    parents = np.concatenate(parents)
+    order = np.argsort(parents, kind="stable")
+    return parents[order], np.concatenate(suggested_positions)[order]
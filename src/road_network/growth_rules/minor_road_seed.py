@@ -1,6 +1,7 @@
 import random
 import numpy as np
 from src.utilities import rotate
+from src.utilities import collect_proposals
 from src.road_network.vertex import Vertex
 from src.road_network.segment import Segment
 
@@ -43,3 +44,28 @@ def minor_road_seed(config, segment, population_density):
         suggested_segments.append(new_segment)
 
     return suggested_segments
+
+
+# INPUT:    ConfigLoader, numpy.Array, numpy.Array, numpy.Array, numpy.random.Generator
+# OUTPUT:   numpy.Array, numpy.Array
+# Batched version of minor_road_seed for N parent segments given by their
+# (N,2) start and end positions and population densities. Returns the parent
+# index and end position of every suggested seed.
+def minor_road_seed_batch(config, start_positions, end_positions, population_density, rng):
+    parent_count = len(end_positions)
+
+    # Compute the unit vectors of the given segments to determine direction.
+    segment_vectors = end_positions - start_positions
+    segment_unit_vectors = segment_vectors / np.linalg.norm(segment_vectors, axis=1)[:, None]
+
+    # Rotate unit vectors 90 degrees to turn right and left.
+    rotated_unit_vectors = np.column_stack((-segment_unit_vectors[:, 1], segment_unit_vectors[:, 0]))
+    directions = np.stack((rotated_unit_vectors, -rotated_unit_vectors), axis=1)
+
+    # We multiply the probability with the population density because we want to
+    # modestly increase the probability of turning the closer to the density.
+    road_turn_probability = config.minor_road_seed_probability * (population_density + 1)
+
+    accepted = rng.uniform(0, 1, (parent_count, 2)) <= road_turn_probability[:, None]
+    lengths = rng.uniform(config.minor_road_min_length, config.minor_road_max_length, (parent_count, 2))
+    return collect_proposals(end_positions[:, None] + lengths[..., None] * directions, accepted)
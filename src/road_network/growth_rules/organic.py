@@ -1,6 +1,8 @@
 import random
 import numpy as np
 from src.utilities import rotate
+from src.utilities import rotate_batch
+from src.utilities import collect_proposals
 from src.road_network.vertex import Vertex
 from src.road_network.segment import Segment
 
@@ -52,4 +54,33 @@ def organic(config, segment, population_density):
         new_segment = Segment(segment_start=segment.end_vert, segment_end=Vertex(turn_road_segment_array))
         suggested_segments.append(new_segment)
     
-    return suggested_segments
\ No newline at end of file
+    return suggested_segments
+
+
+# INPUT:    ConfigLoader, numpy.Array, numpy.Array, numpy.Array, numpy.Array, numpy.random.Generator
+# OUTPUT:   numpy.Array, numpy.Array
+# Batched version of organic for N parent segments given by their (N,2) start
+# and end positions, road classes and population densities. Returns the parent
+# index and end position of every suggested segment.
+def organic_batch(config, start_positions, end_positions, is_minor_road, population_density, rng):
+    parent_count = len(end_positions)
+    road_mininum_length = np.where(is_minor_road, config.minor_road_min_length, config.organic_road_min_length)
+    road_maximum_length = np.where(is_minor_road, config.minor_road_max_length, config.organic_road_max_length)
+
+    # Compute the unit vectors of the given segments to determine direction.
+    segment_vectors = end_positions - start_positions
+    segment_unit_vectors = segment_vectors / np.linalg.norm(segment_vectors, axis=1)[:, None]
+
+    # Going straight, turning right and turning left, each with a random deviation.
+    angles = rng.uniform((-30, -120, 60), (30, -60, 120), (parent_count, 3))
+    directions = rotate_batch(segment_unit_vectors[:, None], angles)
+
+    # We multiply the turn probability with the population density because we
+    # want to modestly increase the probability of turning the closer to the density.
+    road_turn_probability = config.organic_road_turn_probability * (population_density + 1)
+    probabilities = np.column_stack((np.full(parent_count, config.organic_straight_road_probability),
+                                     road_turn_probability, road_turn_probability))
+
+    accepted = rng.uniform(0, 1, (parent_count, 3)) <= probabilities
+    lengths = rng.uniform(road_mininum_length[:, None], road_maximum_length[:, None], (parent_count, 3))
+    return collect_proposals(end_positions[:, None] + lengths[..., None] * directions, accepted)
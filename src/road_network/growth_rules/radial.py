@@ -1,6 +1,8 @@
 import random
 import numpy as np
 from src.utilities import rotate
+from src.utilities import rotate_batch
+from src.utilities import collect_proposals
 from src.road_network.vertex import Vertex
 from src.road_network.segment import Segment
 
@@ -22,7 +24,7 @@ def radial(config, segment, population_density):
     segment_unit_vector = (segment.end_vert.position - segment.start_vert.position)/segment.segment_norm()
 
     # Find the nearest centroid for given segment.
-    nearest_center = config.radial_centers[np.argmin(np.linalg.norm(radial_axis_start - config.radial_centers, axis=1))]
+    nearest_center = find_nearest_radial_centers(config, radial_axis_start[None])[0]
 
     # In the case that the current segment ends at the radial center,
     # we return an empty list because the radial vector cannot be computed
@@ -78,4 +80,71 @@ def radial(config, segment, population_density):
         new_segment = Segment(segment_start=segment.end_vert, segment_end=Vertex(turn_road_segment_array))
         suggested_segments.append(new_segment)
 
-    return suggested_segments
\ No newline at end of file
+    return suggested_segments
+
+
+# INPUT:    ConfigLoader, numpy.Array, numpy.Array, numpy.Array, numpy.Array, numpy.random.Generator
+# OUTPUT:   numpy.Array, numpy.Array
+# Batched version of radial for N parent segments given by their (N,2) start
+# and end positions, road classes and population densities. Returns the parent
+# index and end position of every suggested segment.
+def radial_batch(config, start_positions, end_positions, is_minor_road, population_density, rng):
+    parent_count = len(end_positions)
+    segment_vectors = end_positions - start_positions
+
+    # The start positions we are measuring from for the radial axis lines going
+    # towards the radial centers. Positioning these offset from the current
+    # vertices helps prevent spiraling.
+    radial_axis_starts = end_positions + segment_vectors * rng.uniform(0.0, 1.0, (parent_count, 1))
+
+    # Compute the unit vectors of the given segments to determine direction.
+    segment_unit_vectors = segment_vectors / np.linalg.norm(segment_vectors, axis=1)[:, None]
+
+    # Find the nearest centroid for every segment.
+    nearest_centers = find_nearest_radial_centers(config, radial_axis_starts)
+
+    # Segments ending at their radial center get no suggestions because the
+    # radial vector cannot be computed.
+    has_radial_vector = ~np.all(nearest_centers == end_positions, axis=1)
+
+    radial_vectors = radial_axis_starts - nearest_centers
+    radial_unit_vectors = radial_vectors / np.linalg.norm(radial_vectors, axis=1)[:, None]
+
+    # Find degree between segment_unit_vector and radial_unit_vector, and the
+    # angle to rotate the previous segment by that snaps the new segment to the
+    # nearest parallel or perpendicular radial axes.
+    alpha = np.degrees(np.arccos(np.clip(np.sum(segment_unit_vectors * radial_unit_vectors, axis=1), -1.0, 1.0)))
+    alpha = np.select([(alpha >= 45) & (alpha < 135), (alpha >= 225) & (alpha < 315), (alpha >= 135) & (alpha < 225)],
+                      [90 - alpha, 270 - alpha, 180 - alpha], 0 - alpha)
+
+    corrected_forward = rotate_batch(segment_unit_vectors, alpha)
+    directions = np.stack((corrected_forward, rotate_batch(corrected_forward, 90), rotate_batch(corrected_forward, -90)), axis=1)
+
+    # We multiply the probability with the population density because we
+    # want to increase the probability of turning the closer to the density.
+    road_turn_probability = config.radial_road_turn_probability * (population_density + 1)
+    probabilities = np.column_stack((np.full(parent_count, config.radial_straight_road_probability),
+                                     road_turn_probability, road_turn_probability))
+
+    accepted = (rng.uniform(0, 1, (parent_count, 3)) <= probabilities) & has_radial_vector[:, None]
+    lengths = rng.uniform(config.radial_road_min_length, config.radial_road_max_length, (parent_count, 3))
+    return collect_proposals(end_positions[:, None] + lengths[..., None] * directions, accepted)
+
+
+# INPUT:    ConfigLoader, numpy.Array
+# OUTPUT:   numpy.Array
+# Returns the nearest radial center of each of the (N,2) positions. Positions
+# inside the map are resolved with a single read of the nearest center raster
+# compiled by the ConfigLoader, positions outside of it are resolved exactly.
+def find_nearest_radial_centers(config, positions):
+    radial_centers = np.asarray(config.radial_centers)
+    height, width = config.radial_center_index.shape
+    pixels = np.round(positions).astype(int)
+    inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+
+    nearest = np.empty(len(positions), dtype=int)
+    nearest[inside] = config.radial_center_index[pixels[inside, 1], pixels[inside, 0]]
+    if not inside.all():
+        center_distances = np.linalg.norm(positions[~inside][:, None] - radial_centers[None], axis=2)
+        nearest[~inside] = np.argmin(center_distances, axis=1)
+    return radial_centers[nearest]
@@ -1,22 +1,37 @@
 # city size: 10.000 m x 10.000 m
 # input image size: 1000x1000
 # pixel size: 10 m x 10 m
+# Larger maps can be read in blocks on demand, see ConfigLoader windowed_rasters.
 
+import random
 import numpy as np
 from enum import Enum
-from queue import Queue
-from scipy.spatial import cKDTree
+from collections import deque
 from src.road_network.vertex import Vertex
 from src.road_network.segment import Segment
+from src.road_network.road_network_store import RoadNetworkStore
+from src.road_network.spatial_index import VertexIndex
+from src.road_network.spatial_index import SegmentIndex
+from src.road_network.spatial_index import segment_bounding_box
+from src.road_network.stopping_criteria import create_stopping_criteria
 from src.road_network.growth_rules.grid import grid
+from src.road_network.growth_rules.grid import grid_batch
 from src.road_network.growth_rules.radial import radial
+from src.road_network.growth_rules.radial import radial_batch
 from src.road_network.growth_rules.organic import organic
+from src.road_network.growth_rules.organic import organic_batch
 from src.road_network.growth_rules.minor_road import minor_road
+from src.road_network.growth_rules.minor_road import minor_road_batch
 from src.road_network.growth_rules.minor_road_seed import minor_road_seed
+from src.road_network.growth_rules.minor_road_seed import minor_road_seed_batch
 from src.utilities import find_pixel_value
-from src.utilities import compute_intersection
+from src.utilities import find_pixel_values
+from src.utilities import find_closest_intersection
 from src.utilities import normalise_pixel_values
 from src.utilities import get_population_density_value
+from src.utilities import get_population_density_values
+from src.instrumentation import count
+from src.instrumentation import stage
 
 
 class Rules(Enum):
@@ -26,101 +41,285 @@ class Rules(Enum):
     RULE_GRID = 4
     RULE_MINOR = 5
 
-# INPUT:    ConfigLoader
-# OUTPUT:   List
-# Generates a road network given a loaded config.
-def generate_road_network(config):
-    segment_added_list = []
-    vertex_added_dict = {}
-    segment_front_queue = Queue(maxsize=0)
+# INPUT:    ConfigLoader, (Bool, Bool, Bool)
+# OUTPUT:   List, Dictionary | RoadNetworkStore
+# Generates a road network given a loaded config. The network is grown in a
+# RoadNetworkStore. By default it is converted to the list of segments and the
+# dictionary of vertices used by the rest of the pipeline. If return_store is
+# set, the store itself is returned instead.
+# By default segments are expanded one at a time in queue order. If batched is
+# set, the whole frontier is expanded at once per generation using the batched
+# growth rules, drawing from a numpy generator seeded from the random module.
+# The growth of major roads, minor road seeds and minor roads are measured as
+# the stages "major_roads", "minor_seeds" and "minor_roads" of the active
+# instrumentation, see src.instrumentation.
+# If track_metrics is set, or the config declares stopping criteria, the
+# metrics of the network are kept up to date in store.metrics as it grows.
+# Growth of the major and minor roads ends early once the stopping criteria
+# of the phase are met, see src.road_network.stopping_criteria.
+def generate_road_network(config, return_store=False, batched=False, track_metrics=False):
+    store = RoadNetworkStore()
+    if track_metrics:
+        store.track_metrics(config.pixel_scaling_factor)
+    stopping_criteria = _create_stopping_criteria(config, store, "major_roads")
+    vertex_index = create_vertex_index(config)
+    segment_index = create_segment_index(config)
+    segment_front_queue = deque()
 
     for segment in config.axiom:
-        segment_added_list.append(segment)
-        segment_front_queue.put(segment)
-        vertex_added_dict[segment.start_vert] = [segment]
-        vertex_added_dict[segment.end_vert] = [segment]
+        start_vertex = _add_vertex(segment.start_vert.position, store, vertex_index)
+        end_vertex = _add_vertex(segment.end_vert.position, store, vertex_index)
+        segment_front_queue.append(_add_segment(start_vertex, end_vertex, segment.is_minor_road, store, segment_index))
 
-    # Iterate through the front queue, incrementally building the road network.
-    iteration = 0
     min_distance = config.major_vertex_min_distance # Min distance between major road vertices.
-    while not segment_front_queue.empty() and iteration < config.max_road_network_iterations:
-        current_segment = segment_front_queue.get()
+    if batched:
+        rng = np.random.default_rng(random.getrandbits(64))
+
+        def suggest(parents):
+            return generate_suggested_segments_batch(config, store, parents, rng)
+
+        with stage("major_roads"):
+            _grow_batched(config, store, list(segment_front_queue), suggest, False, config.max_road_network_iterations,
+                          min_distance, vertex_index, segment_index, stopping_criteria)
+        generate_minor_roads(config, store, vertex_index, segment_index, rng=rng)
+    else:
+        # Iterate through the front queue, incrementally building the road network.
+        with stage("major_roads"):
+            iteration = 0
+            while segment_front_queue and iteration < config.max_road_network_iterations:
+                current_segment = segment_front_queue.popleft()
+                start_vertex = int(store.segment_vertices[current_segment, 1])
+
+                suggested_segments = generate_suggested_segments(config, store.segment(current_segment), config.road_rules_labels, config.population_density_field)
+                for segment in suggested_segments:
+                    if not store.degree(store.segment_vertices[current_segment, 1]) >= 4:
+                        end_vertex = verify_segment(config, segment, start_vertex, min_distance, store, vertex_index, segment_index)
+                        if end_vertex is not None:
+                            segment_front_queue.append(_add_segment(start_vertex, end_vertex, False, store, segment_index))
+                    else:
+                        count("growth.skipped_degree_cap")
+
+                iteration += 1
+                if _should_stop(stopping_criteria, store, iteration, "major_roads"):
+                    break
+            _count_iteration_cap(segment_front_queue, iteration, config.max_road_network_iterations, "major_roads")
+
+        generate_minor_roads(config, store, vertex_index, segment_index)
+
+    if return_store:
+        return store
+    return store.to_road_network()
 
-        suggested_segments = generate_suggested_segments(config, current_segment, config.road_rules_array, config.population_density_array)
-        for segment in suggested_segments:
-            if not len(vertex_added_dict[current_segment.end_vert]) >= 4:   
-                verified_segment = verify_segment(config, segment, min_distance, segment_added_list, vertex_added_dict)
-                if verified_segment:
-                    segment_front_queue.put(verified_segment)
-                    segment_added_list.append(verified_segment)
-                    for vert in [verified_segment.start_vert, verified_segment.end_vert]:
-                        if vert in vertex_added_dict:
-                            vertex_added_dict[vert].append(verified_segment)
-                        else:
-                            vertex_added_dict[vert] = [verified_segment]
 
-        iteration += 1
+# INPUT:    ConfigLoader, (RoadNetworkStore)
+# OUTPUT:   VertexIndex
+# Creates a vertex index whose cells are sized to the largest minimum vertex
+# distance, so snapping queries only touch neighbouring cells. If a store is
+# given, its vertices are added to the index.
+def create_vertex_index(config, store=None):
+    cell_size = max(config.major_vertex_min_distance, config.minor_vertex_min_distance)
+    vertex_index = VertexIndex(cell_size)
+    if store is not None:
+        for vertex, position in enumerate(store.positions):
+            vertex_index.insert(vertex, position)
+    return vertex_index
 
-    generate_minor_roads(config, segment_added_list, vertex_added_dict)
 
-    return segment_added_list, vertex_added_dict
+# INPUT:    ConfigLoader, (RoadNetworkStore)
+# OUTPUT:   SegmentIndex
+# Creates a segment index using the same cell size as the vertex index. If a
+# store is given, its segments are added to the index.
+def create_segment_index(config, store=None):
+    cell_size = max(config.major_vertex_min_distance, config.minor_vertex_min_distance)
+    segment_index = SegmentIndex(cell_size)
+    if store is not None:
+        for segment, (start_position, end_position) in enumerate(store.positions[store.segment_vertices]):
+            segment_index.insert(segment, start_position, end_position)
+    return segment_index
 
 
-# INPUT:    ConfigLoader, List, Dictionary
+# INPUT:    numpy.Array, RoadNetworkStore, VertexIndex
+# OUTPUT:   Integer
+# Adds a new vertex to the road network and registers it with the vertex index.
+def _add_vertex(position, store, vertex_index):
+    vertex = store.add_vertex(position)
+    vertex_index.insert(vertex, position)
+    return vertex
+
+
+# INPUT:    Integer, Integer, Bool, RoadNetworkStore, SegmentIndex
+# OUTPUT:   Integer
+# Adds a verified segment to the road network and registers it with the segment index.
+def _add_segment(start_vertex, end_vertex, is_minor_road, store, segment_index):
+    segment = store.add_segment(start_vertex, end_vertex, is_minor_road)
+    segment_index.insert(segment, store.positions[start_vertex], store.positions[end_vertex])
+    return segment
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, String
+# OUTPUT:   StoppingCriteria | None
+# Returns the stopping criteria of the phase declared in the config, if any,
+# and starts tracking the metrics of the store they are checked against.
+def _create_stopping_criteria(config, store, phase):
+    stopping_criteria = create_stopping_criteria(config, phase)
+    if stopping_criteria is not None and store.metrics is None:
+        store.track_metrics(config.pixel_scaling_factor)
+    return stopping_criteria
+
+
+# INPUT:    StoppingCriteria, RoadNetworkStore, Integer, String
+# OUTPUT:   Bool
+# Checks the stopping criteria of the phase, if any, after the given number
+# of iterations. The criterion that is met is counted by the instrumentation.
+def _should_stop(stopping_criteria, store, iteration, phase):
+    if stopping_criteria is None:
+        return False
+    criterion = stopping_criteria.check(store.metrics, iteration)
+    if criterion is None:
+        return False
+    count("growth.stopped.{}.{}".format(phase, criterion))
+    return True
+
+
+# INPUT:    Sequence, Integer, Integer, String
 # OUTPUT:   -
-# generate minor roads based on minor road seeds
-def generate_minor_roads(config, segment_added_list, vertex_added_dict):
+# Counts the growth of the phase as stopped by its maximum number of
+# iterations if segments were left to expand when the growth loop ended, as
+# opposed to growth ending because the map is full.
+def _count_iteration_cap(queue, iteration, max_iterations, phase):
+    if len(queue) > 0 and iteration >= max_iterations:
+        count("growth.stopped.{}.max_iterations".format(phase))
+
+
+# INPUT:    ConfigLoader, List, Function, Bool, Integer, Float, RoadNetworkStore, VertexIndex, SegmentIndex, (StoppingCriteria)
+# OUTPUT:   -
+# Grows the road network one generation at a time. Every generation, the
+# suggest function computes the suggested segments of all segments in the
+# frontier at once. The suggestions are then verified in a deterministic
+# order, by parent and then by suggestion, and the accepted segments form the
+# next frontier. Every expanded parent counts as one iteration. The stopping
+# criteria, if given, are checked after every generation.
+def _grow_batched(config, store, frontier, suggest, is_minor_road, max_iterations, min_distance, vertex_index, segment_index,
+                  stopping_criteria=None):
+    phase = "minor_roads" if is_minor_road else "major_roads"
+    iteration = 0
+    while frontier and iteration < max_iterations:
+        parents = np.array(frontier[:max_iterations - iteration], dtype=int)
+        iteration += len(parents)
+        frontier = _verify_suggestions(config, store, parents, suggest(parents), is_minor_road,
+                                       min_distance, vertex_index, segment_index)
+        if _should_stop(stopping_criteria, store, iteration, phase):
+            break
+    _count_iteration_cap(frontier, iteration, max_iterations, phase)
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, numpy.Array, Tuple, Bool, Float, VertexIndex, SegmentIndex
+# OUTPUT:   List
+# Verifies the suggestions, given as the index into parents and the end
+# position of every suggested segment, in order and adds the verified segments
+# to the road network. Suggested segments start at the end vertex their parent
+# had when the suggestions were computed. Returns the added segments.
+def _verify_suggestions(config, store, parents, suggestions, is_minor_road, min_distance, vertex_index, segment_index):
+    suggested_parents, suggested_positions = suggestions
+    start_vertices = store.segment_vertices[parents, 1][suggested_parents]
+    start_positions = store.positions[start_vertices]
+
+    added_segments = []
+    for start_vertex, start_position, end_position in zip(start_vertices.tolist(), start_positions, suggested_positions):
+        if store.degree(start_vertex) >= 4:
+            count("growth.skipped_degree_cap")
+            continue
+        segment = Segment(segment_start=Vertex(start_position), segment_end=Vertex(end_position))
+        end_vertex = verify_segment(config, segment, start_vertex, min_distance, store, vertex_index, segment_index)
+        if end_vertex is not None:
+            added_segments.append(_add_segment(start_vertex, end_vertex, is_minor_road, store, segment_index))
+    return added_segments
+
+
+# INPUT:    ConfigLoader, RoadNetworkStore, (VertexIndex, SegmentIndex, numpy.random.Generator)
+# OUTPUT:   -
+# generate minor roads based on minor road seeds. If a numpy generator is
+# given, seeds and minor roads are grown in batches using the generator.
+# Growth of the minor roads ends early once the "minor_roads" stopping
+# criteria of the config are met.
+def generate_minor_roads(config, store, vertex_index=None, segment_index=None, rng=None):
+    if vertex_index is None:
+        vertex_index = create_vertex_index(config, store)
+    if segment_index is None:
+        segment_index = create_segment_index(config, store)
+    stopping_criteria = _create_stopping_criteria(config, store, "minor_roads")
+
     # Extract all segments which are not part of an intersection,
     # i.e. segments with end vertices that have less than three segments connected to them.
-    minor_road_seed_candidates = [segment for segment in segment_added_list if len(vertex_added_dict[segment.end_vert]) < 3]
-    minor_roads_queue = Queue(maxsize=0)
+    minor_road_seed_candidates = np.nonzero(store.degrees[store.segment_vertices[:, 1]] < 3)[0]
+    min_distance = config.minor_vertex_min_distance # Min distance between minor road vertices.
+
+    if rng is not None:
+        # Generate all seeds at once, then grow minor roads a generation at a time.
+        with stage("minor_seeds"):
+            seed_arrays = store.segment_arrays(minor_road_seed_candidates)
+            population_density = get_population_density_values(seed_arrays[:, 1], config.population_density_field) * config.population_scaling_factor
+            suggested_seeds = minor_road_seed_batch(config, seed_arrays[:, 0], seed_arrays[:, 1], population_density, rng)
+            count("proposals.minor_seed", len(suggested_seeds[0]))
+            minor_roads_frontier = _verify_suggestions(config, store, minor_road_seed_candidates, suggested_seeds, True,
+                                                       min_distance, vertex_index, segment_index)
+
+        def suggest(parents):
+            segment_arrays = store.segment_arrays(parents)
+            suggestions = minor_road_batch(config, segment_arrays[:, 0], segment_arrays[:, 1], store.is_minor_road[parents], rng)
+            count("proposals.minor", len(suggestions[0]))
+            return suggestions
+
+        with stage("minor_roads"):
+            _grow_batched(config, store, minor_roads_frontier, suggest, True, config.max_minor_road_iterations,
+                          min_distance, vertex_index, segment_index, stopping_criteria)
+        return
+
+    minor_roads_queue = deque()
 
     # Start by generating all seeds from which minor roads may grow. Add them to queue.
-    min_distance = config.minor_vertex_min_distance # Min distance between minor road vertices.
-    for seed in minor_road_seed_candidates:
-        # We scale the population density which ensures the value is between [0-1].
-        population_density = get_population_density_value(seed, config.population_density_array) * config.population_scaling_factor
-        suggested_seeds = minor_road_seed(config, seed, population_density)
-
-        for suggested_seed in suggested_seeds:
-            verified_seed = verify_segment(config, suggested_seed, min_distance, segment_added_list, vertex_added_dict)
-            if verified_seed:
-                minor_roads_queue.put(verified_seed)
-                segment_added_list.append(verified_seed)
-                for vert in [verified_seed.start_vert, verified_seed.end_vert]:
-                    if vert in vertex_added_dict:
-                        vertex_added_dict[vert].append(verified_seed)
-                    else:
-                        vertex_added_dict[vert] = [verified_seed]
-    
-    iteration = 0
-    # Iterate through max_minor_road_iterations and construct minor roads from stubs created above.
-    while not minor_roads_queue.empty() and iteration < config.max_minor_road_iterations:
-        current_segment = minor_roads_queue.get()
-
-        suggested_segments = minor_road(config, current_segment)
-        for segment in suggested_segments:
-            if not len(vertex_added_dict[current_segment.end_vert]) >= 4:   
-                verified_segment = verify_segment(config, segment, min_distance, segment_added_list, vertex_added_dict)
-                if verified_segment:
-                    verified_segment.is_minor_road = True
-                    minor_roads_queue.put(verified_segment)
-                    segment_added_list.append(verified_segment)
-                    for vert in [verified_segment.start_vert, verified_segment.end_vert]:
-                        if vert in vertex_added_dict:
-                            vertex_added_dict[vert].append(verified_segment)
-                        else:
-                            vertex_added_dict[vert] = [verified_segment]
-
-        iteration += 1
-        
-        
+    with stage("minor_seeds"):
+        for seed in minor_road_seed_candidates.tolist():
+            start_vertex = int(store.segment_vertices[seed, 1])
+            seed_segment = store.segment(seed)
+            # We scale the population density which ensures the value is between [0-1].
+            population_density = get_population_density_value(seed_segment, config.population_density_field) * config.population_scaling_factor
+            suggested_seeds = minor_road_seed(config, seed_segment, population_density)
+            count("proposals.minor_seed", len(suggested_seeds))
+
+            for suggested_seed in suggested_seeds:
+                end_vertex = verify_segment(config, suggested_seed, start_vertex, min_distance, store, vertex_index, segment_index)
+                if end_vertex is not None:
+                    minor_roads_queue.append(_add_segment(start_vertex, end_vertex, True, store, segment_index))
+
+    with stage("minor_roads"):
+        iteration = 0
+        # Iterate through max_minor_road_iterations and construct minor roads from stubs created above.
+        while minor_roads_queue and iteration < config.max_minor_road_iterations:
+            current_segment = minor_roads_queue.popleft()
+            start_vertex = int(store.segment_vertices[current_segment, 1])
+
+            suggested_segments = minor_road(config, store.segment(current_segment))
+            count("proposals.minor", len(suggested_segments))
+            for segment in suggested_segments:
+                if not store.degree(store.segment_vertices[current_segment, 1]) >= 4:
+                    end_vertex = verify_segment(config, segment, start_vertex, min_distance, store, vertex_index, segment_index)
+                    if end_vertex is not None:
+                        minor_roads_queue.append(_add_segment(start_vertex, end_vertex, True, store, segment_index))
+                else:
+                    count("growth.skipped_degree_cap")
+
+            iteration += 1
+            if _should_stop(stopping_criteria, store, iteration, "minor_roads"):
+                break
+        _count_iteration_cap(minor_roads_queue, iteration, config.max_minor_road_iterations, "minor_roads")
+
 
 # INPUT:    ConfigLoader, Segment, numpy.Array, numpy.Array
 # OUTPUT:   List
 # Generates suggested segments based on the road rule at the end position of the input segment
-def generate_suggested_segments(config, segment, rule_image_array, population_image_array):
-    roadmap_rule = get_roadmap_rule(config, segment, rule_image_array)
+def generate_suggested_segments(config, segment, rule_label_array, population_image_array):
+    roadmap_rule = get_roadmap_rule(config, segment, rule_label_array)
     # We scale the population density which ensures the value is between [0-1].
     population_density = get_population_density_value(segment, population_image_array) * config.population_scaling_factor
 
@@ -131,163 +330,219 @@ def generate_suggested_segments(config, segment, rule_image_array, population_im
     elif roadmap_rule == Rules.RULE_RADIAL:
         suggested_segments = radial(config, segment, population_density)
 
+    count("proposals." + roadmap_rule.name[len("RULE_"):].lower(), len(suggested_segments))
     return suggested_segments
     
     
 # INPUT:    ConfigLoader, Segment, numpy.Array
 # OUTPUT:   Enum
-# Determine which roadmap rule should be used at current placement
-def get_roadmap_rule(config, segment, image_array):
+# Determine which roadmap rule should be used at current placement. The label
+# array holds the value of the Rules member used at every pixel, as compiled
+# from the road rule map by the ConfigLoader, so that organic is the default.
+def get_roadmap_rule(config, segment, label_array):
     # If we are dealing with a major road, we need to determine whether we
     # need to apply a radial, organic, or grid-based parttern.
-    color = find_pixel_value(segment, image_array)
-    if np.array_equal(color, config.grid_legend):
-        return Rules.RULE_GRID
-    elif np.array_equal(color, config.organic_legend):
-        return Rules.RULE_ORGANIC
-    elif np.array_equal(color, config.radial_legend):
-        return Rules.RULE_RADIAL
-    else:
-        # Defaults to organic.
-        return Rules.RULE_ORGANIC
+    return Rules(find_pixel_value(segment, label_array))
     
 
-# INPUT:    ConfigLoader, Segment, Float, List, Dictionary
-# OUTPUT:   Segment
-# Local constraints are used to verify a suggested segment. Segments are
-# either ignored if they are out of bounds or altered to fit the existing road network
-def verify_segment(config, segment, min_vertex_distance, segment_added_list, vertex_added_dict):
-    max_x = config.road_rules_array.shape[1] - 1 # maximum x coordinate
-    max_y = config.road_rules_array.shape[0] - 1 # maximum y coordinate
+# INPUT:    ConfigLoader, RoadNetworkStore, numpy.Array, numpy.random.Generator
+# OUTPUT:   numpy.Array, numpy.Array
+# Batched version of generate_suggested_segments for an array of parent
+# segments. Returns the index into parents and the end position of every
+# suggested segment, ordered by parent.
+def generate_suggested_segments_batch(config, store, parents, rng):
+    segment_arrays = store.segment_arrays(parents)
+    start_positions, end_positions = segment_arrays[:, 0], segment_arrays[:, 1]
+    is_minor_road = store.is_minor_road[parents]
+    roadmap_rules = get_roadmap_rules(config, end_positions, config.road_rules_labels)
+    # We scale the population density which ensures the value is between [0-1].
+    population_density = get_population_density_values(end_positions, config.population_density_field) * config.population_scaling_factor
+
+    suggested_parents = []
+    suggested_positions = []
+    for rule, rule_function in ((Rules.RULE_GRID, grid_batch), (Rules.RULE_ORGANIC, organic_batch), (Rules.RULE_RADIAL, radial_batch)):
+        mask = roadmap_rules == rule.value
+        if mask.any():
+            rule_parents, rule_positions = rule_function(config, start_positions[mask], end_positions[mask],
+                                                         is_minor_road[mask], population_density[mask], rng)
+            suggested_parents.append(np.nonzero(mask)[0][rule_parents])
+            suggested_positions.append(rule_positions)
+            count("proposals." + rule.name[len("RULE_"):].lower(), len(rule_parents))
+
+    suggested_parents = np.concatenate(suggested_parents)
+    order = np.argsort(suggested_parents, kind="stable")
+    return suggested_parents[order], np.concatenate(suggested_positions)[order]
+
+
+# INPUT:    ConfigLoader, numpy.Array, numpy.Array
+# OUTPUT:   numpy.Array
+# Batched version of get_roadmap_rule. Returns the value of the Rules member
+# used at each of the (N,2) positions.
+def get_roadmap_rules(config, positions, label_array):
+    return find_pixel_values(positions, label_array)
+
+
+# INPUT:    ConfigLoader, Segment, Integer, Float, RoadNetworkStore, VertexIndex, SegmentIndex
+# OUTPUT:   Integer | None
+# Local constraints are used to verify a suggested segment starting at
+# start_vertex. Segments are either ignored if they are out of bounds or
+# altered to fit the existing road network. Returns the index of the vertex
+# the verified segment should end at, which is added to the store if it is
+# new, or None if the segment is rejected. The spatial indices are kept up to
+# date with vertices and segments created by new intersections. The segment
+# is checked with check_segment and its end vertex created with
+# create_end_vertex, which callers may also use separately to inspect the
+# verified segment before the road network is changed.
+def verify_segment(config, segment, start_vertex, min_vertex_distance, store, vertex_index, segment_index):
+    verified_end = check_segment(config, segment, start_vertex, min_vertex_distance, store, vertex_index, segment_index)
+    if verified_end is None:
+        return None
+    return create_end_vertex(verified_end, segment, store, vertex_index, segment_index)
+
+
+# INPUT:    ConfigLoader, Segment, Integer, Float, RoadNetworkStore, VertexIndex, SegmentIndex
+# OUTPUT:   Tuple | None
+# Applies the local constraints of verify_segment without changing the road
+# network. Returns where the verified segment ends: ("vertex", vertex) to snap
+# to an existing vertex, ("intersection", segment, value) to split an
+# existing segment at the relative position value along the new segment, or
+# ("new", None) to end at a new vertex at the end of the segment. Returns None
+# if the segment is rejected. A start_vertex of -1 stands for a start vertex
+# that has not been added to the store yet.
+def check_segment(config, segment, start_vertex, min_vertex_distance, store, vertex_index, segment_index):
+    max_x = config.road_rules_labels.shape[1] - 1 # maximum x coordinate
+    max_y = config.road_rules_labels.shape[0] - 1 # maximum y coordinate
     max_roads_intersection = 4 # maximum allowed roads in an intersection
-    vertex_added_list = list(vertex_added_dict.keys()) # list of unique vertex positions
-    # KDTree of unique vertices used to compute nearest neighbours
-    vertex_tree = cKDTree([vertex.position for vertex in vertex_added_list])
-
-    # INPUT:    Segment, Segment  
-    # OUTPUT:   Segment
-    # Creates a new intersection using the two segments. The existing segment is
-    # split into two parts and its reference updated in the segment_added_list.
-    def _create_intersection(new_segment, intersecting_segment, intersection_value):
-        segment_vector = (segment.end_vert.position - segment.start_vert.position)
-        abs_intersection = Vertex(intersection_value * segment_vector + segment.start_vert.position)
-        new_segment = Segment(segment_start=new_segment.start_vert, segment_end=abs_intersection)
-        old_segment_split = Segment(segment_start=new_segment.end_vert, segment_end=intersecting_segment.end_vert)
-        old_segment_split.is_minor_road = intersecting_segment.is_minor_road
-        intersecting_segment.end_vert = new_segment.end_vert
-
-        # We update the dictionary with vertices and their segments to match the new intersection.
-        vertex_added_dict[abs_intersection] = [intersecting_segment, old_segment_split]
-        vertex_added_dict[old_segment_split.end_vert].remove(intersecting_segment)
-        vertex_added_dict[old_segment_split.end_vert].append(old_segment_split)
-
-        segment_added_list.append(old_segment_split)
-        return new_segment
-        
+
+    # INPUT:    -
+    # OUTPUT:   Tuple | None
+    # Snaps the end of the segment to the close vertex, unless the segment
+    # would duplicate an existing one or the vertex is a full intersection.
+    def _snap_to_vertex():
+        if duplicate:
+            count("verify_segment.rejected.duplicate")
+            return None
+        elif store.degree(close_vertex) >= max_roads_intersection:
+            count("verify_segment.rejected.degree_cap")
+            return None
+        return ("vertex", close_vertex)
+
+    count("verify_segment.calls")
     # We do not consider the segment further if it breaks the boundaries or if it is located in water.
     if ((segment.end_vert.position[0] > max_x or segment.end_vert.position[1] > max_y) or
        (segment.end_vert.position[0] < 0 or segment.end_vert.position[1] < 0)):
+        count("verify_segment.rejected.out_of_bounds")
         return None
-    elif np.array_equal(find_pixel_value(segment, config.water_map_array), config.water_legend):
+    elif find_pixel_value(segment, config.water_mask):
+        count("verify_segment.rejected.water")
         return None
 
-    # We query the KDTree to find the closest vertex to the end position of
-    # the new segment. We use k=2 to find the two closest neighbours because
-    # the closest vertex will always be the queried vertex itself.
-    _, result_index = vertex_tree.query(segment.end_vert.position, k=1, distance_upper_bound=min_vertex_distance)
+    # We query the index to find the closest vertex to the end position of
+    # the new segment within the minimum vertex distance.
+    close_vertex = vertex_index.nearest(segment.end_vert.position, min_vertex_distance)
+    count("index_queries.vertex")
     vertex_is_close = False
     duplicate = False
     closest_value = np.inf
     intersecting_segment = None
 
-    # If the second element of result_index is not equal the length
-    # of the vertex_added_list, a nearby vertex has been found
-    if result_index != len(vertex_added_list):
-        close_vertex = vertex_added_list[result_index]
-
-        if close_vertex is not segment.start_vert:
+    # If a vertex is returned, a nearby vertex has been found.
+    if close_vertex is not None:
+        if close_vertex != start_vertex:
             # if the close vertex belongs to a segment which shares
             # a vertex with the current segment, the current segment
             # should not snap to the vertex
-            close_vertex_segments = vertex_added_dict.get(close_vertex)
+            close_vertex_segments = store.vertex_segments(close_vertex)
             segments_same_start = [seg for seg in close_vertex_segments
-                                if segment.start_vert is seg.start_vert or segment.start_vert is seg.end_vert]
+                                   if start_vertex in store.segment_vertices[seg]]
             if segments_same_start:
                 duplicate = True
 
             vertex_is_close = True
     
-    # We find the maximum allowed segment length and query our tree to find any
-    # vertices within this distance. This way, we reduce the number of segments
-    # to check in the subsequent steps; assuming the query returns more than one
-    # result. If only one result is returned, it is the segment.end_vert.
-    max_segment_length = max(config.grid_road_max_length, config.organic_road_max_length, config.radial_road_max_length)
-    _, vertices_indexes = vertex_tree.query(segment.end_vert.position, k=100, distance_upper_bound=max_segment_length+1)
-    vertices_indexes = [index for index in vertices_indexes if index != len(vertex_added_list)]
-    if vertices_indexes:
-        matched_vertices = [vertex_added_list[index] for index in vertices_indexes
-                            if vertex_added_list[index] is not segment.end_vert and vertex_added_list[index] is not segment.start_vert]
-                                    
-        # We find all segments which the matched vertices are part of.
-        matched_segments = set()
-        for vertex in matched_vertices:
-            matched_segments.update(vertex_added_dict[vertex])
-
-        # We compute intersections for all matched segments.
-        for old_segment in matched_segments:
-            intersection = compute_intersection(segment, old_segment)
-
-            # We check whether the new segment intersects an existing segment.
-            # If the relative point of intersection is between 0.00001 and
-            # 0.99999 for the existing segment, an intersection is detected. We
-            # check whether the relative point of intersection is a bit further
-            # beyond the length of the new segment in order to extend it if is
-            # close to an existing segment. If multiple intersections are
-            # detected, use the intersection closest to the start position of
-            # the new segment.
-            if(intersection[0] > 0.00001 and 
-               intersection[0] < 1.49999 and 
-               intersection[1] > 0.00001 and 
-               intersection[1] < 0.99999 and 
-               intersection[0] < closest_value):
-                intersecting_segment = old_segment 
-                closest_value = intersection[0]
-    
+    # We query the segment index for all segments whose bounding boxes overlap
+    # the box swept by the new segment, including the 50% extension used to
+    # snap it onto nearby roads. Only these segments can intersect it.
+    segment_vector = segment.end_vert.position - segment.start_vert.position
+    swept_box = segment_bounding_box(segment.start_vert.position, segment.start_vert.position + 1.5 * segment_vector)
+    matched_segments = segment_index.query(swept_box)
+    count("index_queries.segment")
+    count("verify_segment.candidates_tested", len(matched_segments))
+
+    # We check whether the new segment intersects any matched segment. If the
+    # relative point of intersection is between 0.00001 and 0.99999 for the
+    # existing segment, an intersection is detected. We check whether the
+    # relative point of intersection is a bit further beyond the length of the
+    # new segment in order to extend it if is close to an existing segment. If
+    # multiple intersections are detected, use the intersection closest to the
+    # start position of the new segment.
+    if matched_segments:
+        segment_array = np.array([segment.start_vert.position, segment.end_vert.position], dtype=float)
+        closest_index, closest_value = find_closest_intersection(segment_array, store.segment_arrays(matched_segments),
+                                                                 min_value=0.00001, max_value_one=1.49999, max_value_two=0.99999)
+        if closest_index is not None:
+            intersecting_segment = matched_segments[closest_index]
+
     # If the segment intersects an existing segment, and an existing vertex
     # is not nearby, we create a new intersection (and thus vertex) and
     # split the existing segment into two parts.
-    if intersecting_segment and not vertex_is_close:
-        return _create_intersection(segment, intersecting_segment, closest_value)
+    if intersecting_segment is not None and not vertex_is_close:
+        return ("intersection", intersecting_segment, closest_value)
         
     # If the segment does not intersect an existing segment but is close to
     # an existing vertex, we snap the end position of the segment to the
     # existing vertex.
-    elif vertex_is_close and not intersecting_segment:
-        if not duplicate and len(vertex_added_dict[close_vertex]) < max_roads_intersection:
-            new_segment = Segment(segment_start=segment.start_vert, segment_end=close_vertex)
-            return new_segment
-        else:
-            return None
+    elif vertex_is_close and intersecting_segment is None:
+        return _snap_to_vertex()
 
     # If the segment intersects an existing segment and is also close to an
     # existing vertex, we consider two different cases: Where the vertex is
     # part of the intersecting segment and not.
-    elif vertex_is_close and intersecting_segment:
+    elif vertex_is_close and intersecting_segment is not None:
         # If the existing vertex is part of the intersecting segment, we
         # snap the end position of the new segment to the vertex.
-        if (close_vertex is intersecting_segment.start_vert or 
-            close_vertex is intersecting_segment.end_vert):
-            if not duplicate and len(vertex_added_dict[close_vertex]) < max_roads_intersection:
-                new_segment = Segment(segment_start=segment.start_vert, segment_end=close_vertex)
-                return new_segment
-            else:
-                return None
+        if close_vertex in store.segment_vertices[intersecting_segment]:
+            return _snap_to_vertex()
         # If the existing vertex is not part of the intersecting segment, we
         # create a new intersection (and thus vertex) and split the existing
         # segment into two parts.
         else:
-            return _create_intersection(segment, intersecting_segment, closest_value)
+            return ("intersection", intersecting_segment, closest_value)
     # If no local constraints apply, and the segment does not break outer
-    # bounds, we return it without alterations.
+    # bounds, we return its end position as a new vertex.
     else:
-        return segment
+        return ("new", None)
+
+
+# INPUT:    Tuple, Segment, RoadNetworkStore
+# OUTPUT:   numpy.Array
+# Returns the end position of a segment verified by check_segment.
+def get_verified_end_position(verified_end, segment, store):
+    if verified_end[0] == "vertex":
+        return store.positions[verified_end[1]]
+    elif verified_end[0] == "intersection":
+        return verified_end[2] * (segment.end_vert.position - segment.start_vert.position) + segment.start_vert.position
+    return segment.end_vert.position
+
+
+# INPUT:    Tuple, Segment, RoadNetworkStore, VertexIndex, SegmentIndex
+# OUTPUT:   Integer
+# Returns the vertex a segment verified by check_segment ends at. A new
+# intersection splits the existing segment into two parts, and the segment
+# index is updated to match.
+def create_end_vertex(verified_end, segment, store, vertex_index, segment_index):
+    if verified_end[0] == "vertex":
+        count("verify_segment.snaps")
+        return verified_end[1]
+    elif verified_end[0] == "intersection":
+        intersecting_segment = verified_end[1]
+        abs_intersection = _add_vertex(get_verified_end_position(verified_end, segment, store), store, vertex_index)
+        old_segment_split = store.split_segment(intersecting_segment, abs_intersection)
+
+        # We update the segment index to match the new intersection.
+        segment_index.update(intersecting_segment, *store.segment_array(intersecting_segment))
+        segment_index.insert(old_segment_split, *store.segment_array(old_segment_split))
+        count("verify_segment.intersections")
+        return abs_intersection
+    count("verify_segment.new_vertices")
+    return _add_vertex(segment.end_vert.position, store, vertex_index)
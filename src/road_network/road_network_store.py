@@ -0,0 +1,208 @@
+import numpy as np
+from src.road_network.vertex import Vertex
+from src.road_network.segment import Segment
+from src.stats import NetworkStatsTracker
+
+
+# Compact, array-backed storage of a road network. Vertices and segments are
+# identified by their integer index, i.e. the order in which they were added.
+# Vertex positions live in a growable float64 (N,2) array, segment endpoints in
+# an int32 (M,2) array and road classes in a boolean flags array. Adjacency is
+# stored with a fixed width (the maximum intersection degree of 4), padded with
+# -1, and widened on demand. Use to_road_network to obtain the Segment/Vertex
+# object graph expected by the statistics, polygon and export modules.
+# Metrics of the network can be kept up to date as it changes, see track_metrics.
+class RoadNetworkStore:
+    def __init__(self, capacity=1024, max_degree=4):
+        self.vertex_count = 0
+        self.segment_count = 0
+        self._positions = np.empty((capacity, 2), dtype=np.float64)
+        self._degrees = np.zeros(capacity, dtype=np.int32)
+        self._adjacency = np.full((capacity, max_degree), -1, dtype=np.int32)
+        self._segment_vertices = np.empty((capacity, 2), dtype=np.int32)
+        self._is_minor_road = np.zeros(capacity, dtype=bool)
+        self.metrics = None
+
+    # INPUT:    numpy.Array, numpy.Array, (numpy.Array)
+    # OUTPUT:   RoadNetworkStore
+    # Builds a store from an (N,2) array of vertex positions, an (M,2) array of
+    # segment vertex indices and optionally an (M,) array of road classes.
+    # Segments are connected to their vertices in the order they are given.
+    @classmethod
+    def from_arrays(cls, positions, segment_vertices, is_minor_road=None):
+        vertex_count, segment_count = len(positions), len(segment_vertices)
+        endpoints = np.asarray(segment_vertices, dtype=np.int32).ravel()
+        degrees = np.bincount(endpoints, minlength=vertex_count).astype(np.int32)
+        store = cls(capacity=max(vertex_count, segment_count, 1),
+                    max_degree=max(int(degrees.max()) if vertex_count > 0 else 0, 4))
+        store.vertex_count, store.segment_count = vertex_count, segment_count
+        store._positions[:vertex_count] = positions
+        store._degrees[:vertex_count] = degrees
+        store._segment_vertices[:segment_count] = segment_vertices
+        if is_minor_road is not None:
+            store._is_minor_road[:segment_count] = is_minor_road
+
+        # Every endpoint takes the next free adjacency slot of its vertex.
+        order = np.argsort(endpoints, kind="stable")
+        slots = np.arange(len(endpoints)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        store._adjacency[endpoints[order], slots] = order // 2
+        return store
+
+    # Views of the used part of the underlying arrays.
+    @property
+    def positions(self):
+        return self._positions[:self.vertex_count]
+
+    @property
+    def degrees(self):
+        return self._degrees[:self.vertex_count]
+
+    @property
+    def adjacency(self):
+        return self._adjacency[:self.vertex_count]
+
+    @property
+    def segment_vertices(self):
+        return self._segment_vertices[:self.segment_count]
+
+    @property
+    def is_minor_road(self):
+        return self._is_minor_road[:self.segment_count]
+
+    # INPUT:    (Float)
+    # OUTPUT:   NetworkStatsTracker
+    # Starts keeping the metrics of the network up to date in a
+    # NetworkStatsTracker, stored as the metrics attribute, and returns it.
+    def track_metrics(self, pixel_scaling_factor=None):
+        segment_arrays = self.positions[self.segment_vertices]
+        self.metrics = NetworkStatsTracker(self.degrees, segment_arrays[:, 1] - segment_arrays[:, 0], pixel_scaling_factor)
+        return self.metrics
+
+    # INPUT:    numpy.Array
+    # OUTPUT:   Integer
+    def add_vertex(self, position):
+        if self.vertex_count == len(self._positions):
+            self._positions = _grow(self._positions)
+            self._degrees = _grow(self._degrees, 0)
+            self._adjacency = _grow(self._adjacency, -1)
+        vertex = self.vertex_count
+        self._positions[vertex] = position
+        self.vertex_count += 1
+        if self.metrics is not None:
+            self.metrics.add_vertex()
+        return vertex
+
+    # INPUT:    Integer, Integer, (Bool)
+    # OUTPUT:   Integer
+    def add_segment(self, start_vertex, end_vertex, is_minor_road=False):
+        if self.segment_count == len(self._segment_vertices):
+            self._segment_vertices = _grow(self._segment_vertices)
+            self._is_minor_road = _grow(self._is_minor_road, False)
+        segment = self.segment_count
+        self._segment_vertices[segment] = (start_vertex, end_vertex)
+        self._is_minor_road[segment] = is_minor_road
+        self.segment_count += 1
+        self._connect(start_vertex, segment)
+        self._connect(end_vertex, segment)
+        if self.metrics is not None:
+            self.metrics.add_segment(self._positions[end_vertex] - self._positions[start_vertex])
+        return segment
+
+    # INPUT:    Integer, Integer
+    # OUTPUT:   Integer
+    # Splits a segment at the given vertex. The segment is shortened to end at
+    # the vertex and a new segment, of the same road class, is added from the
+    # vertex to the original end vertex. Returns the index of the new segment.
+    def split_segment(self, segment, vertex):
+        start_vertex, end_vertex = self._segment_vertices[segment]
+        if self.metrics is not None:
+            self.metrics.remove_segment(self._positions[end_vertex] - self._positions[start_vertex])
+            self.metrics.add_segment(self._positions[vertex] - self._positions[start_vertex])
+        self._disconnect(end_vertex, segment)
+        self._segment_vertices[segment, 1] = vertex
+        self._connect(vertex, segment)
+        return self.add_segment(vertex, end_vertex, self._is_minor_road[segment])
+
+    # INPUT:    Integer
+    # OUTPUT:   Integer
+    def degree(self, vertex):
+        return int(self._degrees[vertex])
+
+    # INPUT:    Integer
+    # OUTPUT:   List
+    # Returns the indices of the segments connected to the vertex in the order they were connected.
+    def vertex_segments(self, vertex):
+        return self._adjacency[vertex, :self._degrees[vertex]].tolist()
+
+    # INPUT:    Integer
+    # OUTPUT:   numpy.Array
+    # Returns the [start, end] positions of the segment as a (2,2) array.
+    def segment_array(self, segment):
+        return self._positions[self._segment_vertices[segment]]
+
+    # INPUT:    List
+    # OUTPUT:   numpy.Array
+    # Returns the [start, end] positions of the segments as an (N,2,2) array.
+    def segment_arrays(self, segments):
+        return self._positions[self._segment_vertices[segments]]
+
+    # INPUT:    Integer
+    # OUTPUT:   Segment
+    # Returns a detached Segment object with the positions and road class of
+    # the stored segment, e.g. as input to the growth rules.
+    def segment(self, segment):
+        start_vertex, end_vertex = self._segment_vertices[segment]
+        new_segment = Segment(segment_start=Vertex(self._positions[start_vertex].copy()),
+                              segment_end=Vertex(self._positions[end_vertex].copy()))
+        new_segment.is_minor_road = bool(self._is_minor_road[segment])
+        return new_segment
+
+    # INPUT:    -
+    # OUTPUT:   List, Dictionary
+    # Adapter to the object graph used by the rest of the pipeline. Returns the
+    # list of segments in insertion order and the dictionary mapping every
+    # vertex, in insertion order, to the list of its connected segments.
+    def to_road_network(self):
+        vertices = [Vertex(position) for position in self.positions.copy()]
+        segments = []
+        for (start_vertex, end_vertex), is_minor_road in zip(self.segment_vertices.tolist(), self.is_minor_road.tolist()):
+            segment = Segment(segment_start=vertices[start_vertex], segment_end=vertices[end_vertex])
+            segment.is_minor_road = is_minor_road
+            segments.append(segment)
+
+        vertex_dict = {}
+        for vertex, degree, connected in zip(vertices, self.degrees.tolist(), self.adjacency.tolist()):
+            vertex_dict[vertex] = [segments[segment] for segment in connected[:degree]]
+        return segments, vertex_dict
+
+    def _connect(self, vertex, segment):
+        degree = self._degrees[vertex]
+        if degree == self._adjacency.shape[1]:
+            padding = np.full_like(self._adjacency, -1)
+            self._adjacency = np.concatenate((self._adjacency, padding), axis=1)
+        self._adjacency[vertex, degree] = segment
+        self._degrees[vertex] = degree + 1
+        if self.metrics is not None:
+            self.metrics.change_degree(degree, degree + 1)
+
+    def _disconnect(self, vertex, segment):
+        degree = self._degrees[vertex]
+        connected = self._adjacency[vertex, :degree].tolist()
+        connected.remove(segment)
+        self._adjacency[vertex, :degree - 1] = connected
+        self._adjacency[vertex, degree - 1] = -1
+        self._degrees[vertex] = degree - 1
+        if self.metrics is not None:
+            self.metrics.change_degree(degree, degree - 1)
+
+
+# INPUT:    numpy.Array, (Scalar)
+# OUTPUT:   numpy.Array
+# Returns a copy of the array with its first dimension doubled. New entries
+# are filled with fill_value if given and left uninitialised otherwise.
+def _grow(array, fill_value=None):
+    if fill_value is None:
+        extension = np.empty_like(array)
+    else:
+        extension = np.full_like(array, fill_value)
+    return np.concatenate((array, extension))
@@ -0,0 +1,142 @@
+import math
+
+
+# Uniform grid hash over vertex positions. Every cell covers a cell_size x
+# cell_size square of the map and stores (x, y, vertex) tuples for the
+# vertices positioned inside it, where vertex is the index of the vertex in the
+# road network store. The index lives for an entire generation run and is
+# updated in place whenever a vertex is added to the road network, so lookups
+# cost time proportional to the number of vertices near the query rather than
+# the size of the whole network.
+class VertexIndex:
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # INPUT:    Float, Float
+    # OUTPUT:   Tuple
+    # Returns the key of the cell containing the given position.
+    def _cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    # INPUT:    Integer, numpy.Array
+    # OUTPUT:   -
+    def insert(self, vertex, position):
+        x, y = float(position[0]), float(position[1])
+        key = self._cell(x, y)
+        if key in self.cells:
+            self.cells[key].append((x, y, vertex))
+        else:
+            self.cells[key] = [(x, y, vertex)]
+        self.size += 1
+
+    # INPUT:    numpy.Array, Integer, Float
+    # OUTPUT:   List
+    # Returns at most k vertices strictly closer than distance_upper_bound to
+    # the given position, sorted by ascending distance. This mirrors
+    # cKDTree.query with the same arguments.
+    def query(self, position, k, distance_upper_bound):
+        x, y = float(position[0]), float(position[1])
+        min_cell_x, min_cell_y = self._cell(x - distance_upper_bound, y - distance_upper_bound)
+        max_cell_x, max_cell_y = self._cell(x + distance_upper_bound, y + distance_upper_bound)
+
+        matches = []
+        for cell_x in range(min_cell_x, max_cell_x + 1):
+            for cell_y in range(min_cell_y, max_cell_y + 1):
+                cell = self.cells.get((cell_x, cell_y))
+                if cell is None:
+                    continue
+                for vertex_x, vertex_y, vertex in cell:
+                    distance = math.hypot(vertex_x - x, vertex_y - y)
+                    if distance < distance_upper_bound:
+                        matches.append((distance, vertex))
+
+        matches.sort(key=lambda match: match[0])
+        return [vertex for _, vertex in matches[:k]]
+
+    # INPUT:    numpy.Array, Float
+    # OUTPUT:   Integer | None
+    # Returns the closest vertex strictly within distance_upper_bound.
+    def nearest(self, position, distance_upper_bound):
+        matches = self.query(position, 1, distance_upper_bound)
+        return matches[0] if matches else None
+
+
+# Uniform grid hash over segment bounding boxes. Every segment, identified by
+# its index in the road network store, is registered in all cells its bounding
+# box overlaps. The index is updated in place when a segment is added or
+# shortened by a split, so queries only need to consider segments registered
+# in the cells covered by the query box.
+class SegmentIndex:
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    # INPUT:    Tuple
+    # OUTPUT:   List
+    # Returns the keys of all cells overlapped by the given bounding box.
+    def _cells(self, bounding_box):
+        min_x, min_y, max_x, max_y = bounding_box
+        min_cell_x, min_cell_y = math.floor(min_x / self.cell_size), math.floor(min_y / self.cell_size)
+        max_cell_x, max_cell_y = math.floor(max_x / self.cell_size), math.floor(max_y / self.cell_size)
+        return [(cell_x, cell_y) for cell_x in range(min_cell_x, max_cell_x + 1)
+                for cell_y in range(min_cell_y, max_cell_y + 1)]
+
+    # INPUT:    Integer, numpy.Array, numpy.Array
+    # OUTPUT:   -
+    def insert(self, segment, start_position, end_position):
+        bounding_box = segment_bounding_box(start_position, end_position)
+        cells = self._cells(bounding_box)
+        self.entries[segment] = (bounding_box, cells)
+        for key in cells:
+            if key in self.cells:
+                self.cells[key].add(segment)
+            else:
+                self.cells[key] = {segment}
+
+    # INPUT:    Integer, numpy.Array, numpy.Array
+    # OUTPUT:   -
+    # Re-registers a segment whose vertices have moved, e.g. after it has been
+    # split by a new intersection.
+    def update(self, segment, start_position, end_position):
+        _, cells = self.entries[segment]
+        for key in cells:
+            self.cells[key].discard(segment)
+        self.insert(segment, start_position, end_position)
+
+    # INPUT:    Tuple
+    # OUTPUT:   List
+    # Returns exactly the segments whose bounding boxes overlap the given
+    # bounding box (min_x, min_y, max_x, max_y), in insertion order.
+    def query(self, bounding_box):
+        min_x, min_y, max_x, max_y = bounding_box
+        matches = set()
+        for key in self._cells(bounding_box):
+            cell = self.cells.get(key)
+            if cell is None:
+                continue
+            for segment in cell:
+                if segment in matches:
+                    continue
+                box = self.entries[segment][0]
+                if box[0] <= max_x and box[2] >= min_x and box[1] <= max_y and box[3] >= min_y:
+                    matches.add(segment)
+
+        return sorted(matches)
+
+
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   Tuple
+# Returns the axis-aligned bounding box (min_x, min_y, max_x, max_y) spanned by two positions.
+def segment_bounding_box(start_position, end_position):
+    start_x, start_y = float(start_position[0]), float(start_position[1])
+    end_x, end_y = float(end_position[0]), float(end_position[1])
+    return (min(start_x, end_x), min(start_y, end_y), max(start_x, end_x), max(start_y, end_y))
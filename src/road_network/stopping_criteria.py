@@ -0,0 +1,54 @@
+# Criteria ending the growth of the major or minor roads before the maximum
+# number of iterations of the phase is reached. They are declared per phase,
+# "major_roads" or "minor_roads", in the optional stopping_criteria entry of
+# the config, e.g.
+#   "stopping_criteria": {
+#       "description": "Metric targets ending the growth of a phase early.",
+#       "value": {"minor_roads": {"intersection_count": 500, "orientation_order_tolerance": 0.001}}
+#   }
+# intersection_count and total_road_length (in metres) are targets for the
+# whole network grown so far: the phase stops once either is reached. The
+# orientation order has converged, and the phase stops, once it changed by
+# less than orientation_order_tolerance over the last orientation_order_window
+# iterations of the phase. The metrics are read from the NetworkStatsTracker
+# of the road network store, see RoadNetworkStore.track_metrics.
+class StoppingCriteria:
+    def __init__(self, intersection_count=None, total_road_length=None, orientation_order_tolerance=None,
+                 orientation_order_window=100):
+        self.intersection_count = intersection_count
+        self.total_road_length = total_road_length
+        self.orientation_order_tolerance = orientation_order_tolerance
+        self.orientation_order_window = orientation_order_window
+        self._order_checkpoint = None
+
+    # INPUT:    NetworkStatsTracker, Integer
+    # OUTPUT:   String | None
+    # Returns the name of the first criterion that is met after the given
+    # number of iterations of the phase, or None if growth should continue.
+    def check(self, metrics, iteration):
+        if self.intersection_count is not None and metrics.intersection_count() >= self.intersection_count:
+            return "intersection_count"
+        if self.total_road_length is not None and metrics.total_road_length() >= self.total_road_length:
+            return "total_road_length"
+        if self.orientation_order_tolerance is not None:
+            # The orientation order is compared with its value at the last
+            # checkpoint once a window of iterations has passed.
+            if self._order_checkpoint is None:
+                self._order_checkpoint = (iteration, metrics.orientation_order())
+            elif iteration - self._order_checkpoint[0] >= self.orientation_order_window:
+                orientation_order = metrics.orientation_order()
+                if abs(orientation_order - self._order_checkpoint[1]) < self.orientation_order_tolerance:
+                    return "orientation_order"
+                self._order_checkpoint = (iteration, orientation_order)
+        return None
+
+
+# INPUT:    ConfigLoader, String
+# OUTPUT:   StoppingCriteria | None
+# Returns the stopping criteria declared in the config for the phase, or None
+# if there are none.
+def create_stopping_criteria(config, phase):
+    stopping_criteria = getattr(config, "stopping_criteria", None) or {}
+    if phase not in stopping_criteria:
+        return None
+    return StoppingCriteria(**stopping_criteria[phase])
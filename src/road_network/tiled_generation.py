@@ -0,0 +1,281 @@
+import copy
+import random
+import numpy as np
+from src.road_network.vertex import Vertex
+from src.road_network.segment import Segment
+from src.road_network.road_network_store import RoadNetworkStore
+from src.road_network.spatial_index import segment_bounding_box
+from src.road_network.road_network_generator import generate_road_network
+from src.road_network.road_network_generator import create_vertex_index
+from src.road_network.road_network_generator import create_segment_index
+from src.road_network.road_network_generator import check_segment
+from src.road_network.road_network_generator import create_end_vertex
+from src.road_network.road_network_generator import get_verified_end_position
+from src.road_network.road_network_generator import _add_vertex
+from src.road_network.road_network_generator import _add_segment
+from src.utilities import find_closest_intersection
+
+# Rasters used to grow a road network, which are cropped to every tile.
+TILE_RASTERS = ["road_rules_labels", "water_mask", "population_density_field", "radial_centers", "radial_center_index"]
+
+# Length below which a stitched seam segment is considered to collapse onto
+# its start.
+MIN_SEGMENT_LENGTH = 1e-6
+
+
+# INPUT:    ConfigLoader, (Tuple, Integer, Integer, Integer, Bool, Bool)
+# OUTPUT:   List, Dictionary | RoadNetworkStore
+# Generates a road network by splitting the map into a grid of tiles, given
+# as (rows, columns), and growing a road network in every tile independently.
+# Every tile grows in a window extending margin pixels beyond the tile, with
+# the axiom segments starting inside the tile, or a single axiom segment at
+# the dry pixel closest to its center if there are none. The tiles are grown in
+# a pool of the given number of processes, or one after another in this process
+# if processes is None. Every tile reseeds the random module from the seed,
+# drawn from the random module if not given, and its index, so the result
+# does not depend on the number of processes. The tiles are then stitched
+# together, see stitch_tiles. Note that every tile is grown with the full
+# iteration budgets of the config.
+def generate_road_network_tiled(config, tiles=(2, 2), margin=None, processes=None, seed=None, return_store=False, batched=False):
+    config.load_rasters(TILE_RASTERS)
+    seam_distance = get_seam_distance(config)
+    margin = 2 * seam_distance if margin is None else margin
+    seed = random.getrandbits(32) if seed is None else seed
+
+    tile_windows = get_tile_windows(config.road_rules_labels.shape, tiles, margin)
+    tasks = [(create_tile_config(config, core, window), seed, index, batched) for index, (core, window) in enumerate(tile_windows)]
+    if processes is None:
+        random_state = random.getstate()
+        tile_stores = [_grow_tile(task) for task in tasks]
+        random.setstate(random_state)
+    else:
+        from multiprocessing import Pool
+        with Pool(processes) as pool:
+            tile_stores = pool.map(_grow_tile, tasks)
+
+    store = stitch_tiles(config, tile_stores, tile_windows, seam_distance)
+    if return_store:
+        return store
+    return store.to_road_network()
+
+
+# INPUT:    ConfigLoader
+# OUTPUT:   Float
+# Returns the length of the longest segment the growth rules can suggest,
+# extended by the largest snapping distance. No segment reaches further than
+# this from its start vertex.
+def get_seam_distance(config):
+    max_lengths = [value for name, value in vars(config).items() if name.endswith("_road_max_length")]
+    return max(max_lengths) + max(config.major_vertex_min_distance, config.minor_vertex_min_distance)
+
+
+# INPUT:    Tuple, Tuple, Float
+# OUTPUT:   List
+# Splits a map of the given (height, width) into a grid of (rows, columns)
+# tiles. Returns the (x0, y0, x1, y1) bounds of every tile, in row-major
+# order, together with the bounds of its window, i.e. the tile extended by
+# margin pixels and clipped to the map.
+def get_tile_windows(shape, tiles, margin):
+    height, width = shape
+    rows, columns = tiles
+    y_bounds = np.linspace(0, height, rows + 1).round().astype(int)
+    x_bounds = np.linspace(0, width, columns + 1).round().astype(int)
+    margin = int(np.ceil(margin))
+
+    tile_windows = []
+    for row in range(rows):
+        for column in range(columns):
+            core = (x_bounds[column], y_bounds[row], x_bounds[column + 1], y_bounds[row + 1])
+            window = (max(core[0] - margin, 0), max(core[1] - margin, 0),
+                      min(core[2] + margin, width), min(core[3] + margin, height))
+            tile_windows.append((tuple(map(int, core)), tuple(map(int, window))))
+    return tile_windows
+
+
+# INPUT:    ConfigLoader, Tuple, Tuple
+# OUTPUT:   ConfigLoader
+# Returns a copy of the config for growing a tile in the local coordinates of
+# its window: the rasters are cropped to the window, and the radial centers
+# and axiom segments are shifted by its origin. Other rasters are not
+# available to the tile.
+def create_tile_config(config, core, window):
+    x0, y0, x1, y1 = window
+    tile_config = copy.copy(config)
+    for name in config.RASTERS:
+        tile_config.__dict__[name] = None
+    tile_config.road_rules_labels = config.road_rules_labels[y0:y1, x0:x1]
+    tile_config.water_mask = config.water_mask[y0:y1, x0:x1]
+    tile_config.population_density_field = config.population_density_field[y0:y1, x0:x1]
+    # The radial centers are shifted in the same coordinate order in which the
+    # radial rule compares them with positions.
+    tile_config.radial_centers = np.asarray(config.radial_centers) - (x0, y0)
+    if config.radial_center_index is not None:
+        tile_config.radial_center_index = config.radial_center_index[y0:y1, x0:x1]
+
+    axiom = [segment for segment in config.axiom if _inside(segment.start_vert.position, core)]
+    if len(axiom) == 0:
+        axiom = _create_tile_axiom(config, core)
+    tile_config.axiom = []
+    for segment in axiom:
+        tile_segment = Segment(segment_array=np.array([segment.start_vert.position, segment.end_vert.position]) - (x0, y0))
+        tile_segment.is_minor_road = segment.is_minor_road
+        tile_config.axiom.append(tile_segment)
+    return tile_config
+
+
+# INPUT:    ConfigLoader, Tuple
+# OUTPUT:   List
+# Returns an axiom for a tile without axiom segments: the first axiom segment
+# of the config moved to the dry pixel closest to the center of the tile, or
+# no segment if the tile only contains water.
+def _create_tile_axiom(config, core):
+    x0, y0, x1, y1 = core
+    dry_y, dry_x = np.nonzero(~config.water_mask[y0:y1, x0:x1])
+    if len(dry_x) == 0 or len(config.axiom) == 0:
+        return []
+    closest = np.argmin((dry_x + x0 - (x0 + x1) / 2)**2 + (dry_y + y0 - (y0 + y1) / 2)**2)
+    start = np.array([dry_x[closest] + x0, dry_y[closest] + y0])
+    vector = config.axiom[0].end_vert.position - config.axiom[0].start_vert.position
+    return [Segment(segment_array=np.array([start, start + vector]))]
+
+
+# INPUT:    Tuple
+# OUTPUT:   RoadNetworkStore
+# Grows the road network of a single tile.
+def _grow_tile(task):
+    tile_config, seed, index, batched = task
+    random.seed("{}-{}".format(seed, index))
+    return generate_road_network(tile_config, return_store=True, batched=batched)
+
+
+# INPUT:    ConfigLoader, List, List, Float
+# OUTPUT:   RoadNetworkStore
+# Stitches the road networks of the tiles into a single road network. Every
+# tile keeps the segments whose midpoint lies inside the tile, so every part
+# of the map is covered by a single tile. Kept segments further than
+# seam_distance from the borders the tile shares with other tiles cannot
+# conflict with segments of other tiles, and are added as they are. The
+# remaining seam segments are added one at a time through the checks of
+# verify_segment, starting from the vertex their start was stitched to, so
+# that they snap to close vertices, intersect crossing segments and respect the
+# maximum number of roads in an intersection, just like segments grown by
+# generate_road_network. Where two tiles overlap, snapping an end to a close
+# vertex often changes the direction of a seam segment enough to cross another
+# road, so a seam segment is also dropped if it crosses the road network after
+# snapping, or if stitching shortened it below the minimum vertex distance, so
+# that it would collapse onto its start. A seam segment is only added, together
+# with its start and end vertices, once all checks have passed, so dropped seam
+# segments leave the road network unchanged.
+def stitch_tiles(config, tile_stores, tile_windows, seam_distance):
+    store = RoadNetworkStore()
+    vertex_index = create_vertex_index(config)
+    segment_index = create_segment_index(config)
+    height, width = config.road_rules_labels.shape
+
+    vertex_maps = []
+    seam_segments = []
+    for tile, (tile_store, (core, window)) in enumerate(zip(tile_stores, tile_windows)):
+        positions = tile_store.positions + window[:2]
+        segment_vertices = tile_store.segment_vertices
+        segment_arrays = positions[segment_vertices]
+        kept = _inside(segment_arrays.mean(axis=1), core)
+
+        # Distance of both endpoints to the closest border shared with another tile.
+        x0, y0, x1, y1 = core
+        borders = [(x0 > 0, segment_arrays[:, :, 0] - x0), (y0 > 0, segment_arrays[:, :, 1] - y0),
+                   (x1 < width, x1 - segment_arrays[:, :, 0]), (y1 < height, y1 - segment_arrays[:, :, 1])]
+        border_distance = np.full(segment_arrays.shape[:2], np.inf)
+        for is_shared, distance in borders:
+            if is_shared:
+                border_distance = np.minimum(border_distance, distance)
+        is_seam = border_distance.min(axis=1) < seam_distance
+
+        vertex_map = {}
+        for segment in np.flatnonzero(kept & ~is_seam):
+            start_vertex, end_vertex = (_map_vertex(vertex_map, vertex, positions[vertex], store, vertex_index)
+                                        for vertex in segment_vertices[segment].tolist())
+            _add_segment(start_vertex, end_vertex, bool(tile_store.is_minor_road[segment]), store, segment_index)
+        vertex_maps.append(vertex_map)
+        seam_segments.extend((tile, segment) for segment in np.flatnonzero(kept & is_seam))
+
+    for tile, segment in seam_segments:
+        tile_store, vertex_map = tile_stores[tile], vertex_maps[tile]
+        origin = tile_windows[tile][1][:2]
+        local_start, local_end = tile_store.segment_vertices[segment].tolist()
+        is_minor_road = bool(tile_store.is_minor_road[segment])
+        min_distance = config.minor_vertex_min_distance if is_minor_road else config.major_vertex_min_distance
+        end_position = tile_store.positions[local_end] + origin
+
+        # The start is stitched to the vertex it was stitched to before, or
+        # snapped to a close vertex of another tile. Otherwise a new start
+        # vertex is added once the segment has been accepted.
+        start_vertex = vertex_map.get(local_start)
+        if start_vertex is None:
+            start_position = tile_store.positions[local_start] + origin
+            start_vertex = vertex_index.nearest(start_position, min_distance)
+        if start_vertex is not None:
+            start_position = store.positions[start_vertex]
+            if store.degree(start_vertex) >= 4:
+                continue
+        if np.linalg.norm(end_position - start_position) < min_distance:
+            continue
+
+        segment = Segment(segment_start=Vertex(start_position.copy()), segment_end=Vertex(end_position))
+        verified_end = check_segment(config, segment, -1 if start_vertex is None else start_vertex, min_distance,
+                                     store, vertex_index, segment_index)
+        if verified_end is None or (verified_end[0] == "vertex" and verified_end[1] == start_vertex):
+            continue
+        verified_end_position = get_verified_end_position(verified_end, segment, store)
+        if np.linalg.norm(verified_end_position - start_position) < MIN_SEGMENT_LENGTH:
+            continue
+        connected_vertices = [start_vertex, verified_end[1]] if verified_end[0] == "vertex" else [start_vertex]
+        ignored_segments = [verified_end[1]] if verified_end[0] == "intersection" else []
+        if _crosses_road_network(np.array([start_position, verified_end_position]), connected_vertices, store, segment_index,
+                                 ignored_segments):
+            continue
+
+        if start_vertex is None:
+            start_vertex = _add_vertex(start_position, store, vertex_index)
+        vertex_map[local_start] = start_vertex
+        end_vertex = create_end_vertex(verified_end, segment, store, vertex_index, segment_index)
+        _add_segment(start_vertex, end_vertex, is_minor_road, store, segment_index)
+        # Segments cut short by an intersection do not reach their end vertex.
+        if local_end not in vertex_map and np.linalg.norm(store.positions[end_vertex] - end_position) < min_distance:
+            vertex_map[local_end] = end_vertex
+
+    return store
+
+
+# INPUT:    numpy.Array, List, RoadNetworkStore, SegmentIndex, (List)
+# OUTPUT:   Bool
+# Returns whether the segment given as its [start, end] positions would cross
+# or touch a segment of the road network, including passing through one of its
+# vertices. Segments connected to one of the given vertices, which may include
+# None for a vertex not in the store, and the ignored segments are left out.
+def _crosses_road_network(segment_array, connected_vertices, store, segment_index, ignored_segments=()):
+    matched_segments = [segment for segment in segment_index.query(segment_bounding_box(*segment_array))
+                        if segment not in ignored_segments
+                        and not any(vertex in connected_vertices for vertex in store.segment_vertices[segment].tolist())]
+    if len(matched_segments) == 0:
+        return False
+    closest_index, _ = find_closest_intersection(segment_array, store.segment_arrays(matched_segments),
+                                                 min_value=-0.00001, max_value_one=1.00001, max_value_two=1.00001)
+    return closest_index is not None
+
+
+# INPUT:    Dictionary, Integer, numpy.Array, RoadNetworkStore, VertexIndex
+# OUTPUT:   Integer
+# Returns the vertex a tile vertex was stitched to, adding it if it is new.
+def _map_vertex(vertex_map, vertex, position, store, vertex_index):
+    if vertex not in vertex_map:
+        vertex_map[vertex] = _add_vertex(position, store, vertex_index)
+    return vertex_map[vertex]
+
+
+# INPUT:    numpy.Array, Tuple
+# OUTPUT:   Bool | numpy.Array
+# Returns whether the position(s) lie inside the (x0, y0, x1, y1) bounds.
+def _inside(positions, bounds):
+    x0, y0, x1, y1 = bounds
+    positions = np.asarray(positions)
+    return (positions[..., 0] >= x0) & (positions[..., 0] < x1) & (positions[..., 1] >= y0) & (positions[..., 1] < y1)
@@ -0,0 +1,74 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Places numpy arrays in shared memory so that worker processes can attach to
+# them without copying or pickling them. Every array is copied into its own
+# shared memory block once, and is described by a small picklable descriptor
+# (block name, shape, dtype) that is sent to the workers instead. The blocks
+# are owned by this object and are released by close(), or when it is used as
+# a context manager.
+class SharedArrays:
+    def __init__(self):
+        self.blocks = []
+        self.descriptors = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    # INPUT:    numpy.Array
+    # OUTPUT:   Tuple
+    # Copies the array into shared memory and returns its descriptor. The same
+    # array object is only copied once.
+    def share(self, array):
+        if id(array) in self.descriptors:
+            return self.descriptors[id(array)][0]
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self.blocks.append(block)
+        descriptor = (block.name, array.shape, array.dtype.str)
+        # Keep a reference to the array so its id is not reused.
+        self.descriptors[id(array)] = (descriptor, array)
+        return descriptor
+
+    # INPUT:    Dictionary
+    # OUTPUT:   Dictionary
+    # Shares every array of the dictionary. Values that are not numpy arrays,
+    # e.g. None, are left out.
+    def share_all(self, arrays):
+        return {name: self.share(array) for name, array in arrays.items() if isinstance(array, np.ndarray)}
+
+    # INPUT:    -
+    # OUTPUT:   -
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.descriptors = {}
+
+
+# Shared memory blocks attached by this process, by name. They are kept open
+# for the lifetime of the process so the arrays viewing them stay valid.
+_attached_blocks = {}
+
+
+# INPUT:    Tuple
+# OUTPUT:   numpy.Array
+# Returns a read-only array viewing the shared memory block of the descriptor.
+def attach_array(descriptor):
+    name, shape, dtype = descriptor
+    if name not in _attached_blocks:
+        _attached_blocks[name] = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_attached_blocks[name].buf)
+    array.flags.writeable = False
+    return array
+
+
+# INPUT:    Dictionary
+# OUTPUT:   Dictionary
+def attach_arrays(descriptors):
+    return {name: attach_array(descriptor) for name, descriptor in descriptors.items()}
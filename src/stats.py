@@ -1,6 +1,5 @@
 import math
 import numpy as np
-import matplotlib.pyplot as plt
 
 NUM_BINS = 36
 
@@ -138,9 +137,131 @@ def compute_orientation_order(orientation_entropy):
     orientation_order = 1 - ((orientation_entropy - min_entropy) / (max_entropy - min_entropy)) ** 2
     return orientation_order
 
+# Computes every metric above in a single pass over the road network and
+# returns them as one record. The degree of every vertex and the vector of
+# every segment are collected once, and the metrics are computed from these
+# arrays, see compute_network_stats_from_arrays. The total road length is
+# only computed if config or pixel_scaling_factor is given.
+def compute_network_stats(vertex_dict, road_segments, config=None, pixel_scaling_factor=None):
+    if config is not None:
+        pixel_scaling_factor = config.pixel_scaling_factor
+
+    degrees = np.fromiter((len(road_segments) for road_segments in vertex_dict.values()), dtype=np.int64, count=len(vertex_dict))
+    segment_vectors = np.array([road_segment.end_vert.position - road_segment.start_vert.position
+                                for road_segment in road_segments], dtype=float).reshape(-1, 2)
+    return compute_network_stats_from_arrays(degrees, segment_vectors, pixel_scaling_factor)
+
+# Vectorised version of the metrics above, given the degree of every vertex
+# and the (N,2) array of segment vectors, e.g. from a RoadNetworkStore. The
+# degrees are counted with np.bincount and the length-weighted bearings with
+# np.bincount on the bin of every bearing. The counts are identical to those
+# of the functions above, and the lengths, histogram and entropy agree with
+# them up to floating point rounding (numpy and math compute atan2 and norms
+# to within an ulp of each other).
+def compute_network_stats_from_arrays(degrees, segment_vectors, pixel_scaling_factor=None):
+    degree_counts = np.bincount(degrees, minlength=5).tolist()
+    road_lengths = np.sqrt(np.einsum("ij,ij->i", segment_vectors, segment_vectors))
+    orientation_histogram = _compute_orientation_histogram(segment_vectors, road_lengths)
+    return _compute_network_stats_from_counts(degree_counts, float(np.sum(road_lengths)), orientation_histogram, pixel_scaling_factor)
+
+# Computes the metrics from the number of vertices of every degree, the total
+# road length in pixels and the orientation histogram.
+def _compute_network_stats_from_counts(degree_counts, road_length, orientation_histogram, pixel_scaling_factor=None):
+    # Ignore straights and bends
+    node_sum = sum(degree_counts) - degree_counts[2]
+    degree_sum = sum(degree * vertex_count for degree, vertex_count in enumerate(degree_counts)) - 2 * degree_counts[2]
+    orientation_entropy = _compute_orientation_entropy(orientation_histogram)
+
+    return {
+        "average_node_degree": degree_sum / node_sum,
+        "intersection_count": sum(degree_counts[3:]),
+        "proportion_dead_ends": degree_counts[1] / node_sum,
+        "proportion_3way_intersections": degree_counts[3] / node_sum,
+        "proportion_4way_intersections": degree_counts[4] / node_sum,
+        "total_road_length": road_length * pixel_scaling_factor if pixel_scaling_factor is not None else None,
+        "orientation_histogram": orientation_histogram,
+        "orientation_entropy": orientation_entropy,
+        "orientation_order": compute_orientation_order(orientation_entropy),
+    }
+
+# Keeps the metrics of a road network up to date while it grows, so they can
+# be read at any time without a pass over the network, e.g. to stop the
+# growth once a target is reached. Tracks the number of vertices of every
+# degree, the total road length in pixels and the orientation histogram.
+# Attach it to a RoadNetworkStore with track_metrics, which reports every new
+# vertex, change of degree and added or removed segment. Removing a segment,
+# as when a segment is split into two, subtracts its length again, so the
+# length and histogram may drift from a full recomputation by rounding.
+class NetworkStatsTracker:
+    def __init__(self, degrees=(), segment_vectors=None, pixel_scaling_factor=None):
+        segment_vectors = np.empty((0, 2)) if segment_vectors is None else np.asarray(segment_vectors, dtype=float).reshape(-1, 2)
+        road_lengths = np.sqrt(np.einsum("ij,ij->i", segment_vectors, segment_vectors))
+        self.degree_counts = np.bincount(np.asarray(degrees, dtype=np.int64), minlength=5).tolist()
+        self.road_length = float(np.sum(road_lengths))
+        self.orientation_histogram = _compute_orientation_histogram(segment_vectors, road_lengths)
+        self.pixel_scaling_factor = pixel_scaling_factor
+
+    def add_vertex(self):
+        self.degree_counts[0] += 1
+
+    def change_degree(self, old_degree, new_degree):
+        if new_degree == len(self.degree_counts):
+            self.degree_counts.append(0)
+        self.degree_counts[old_degree] -= 1
+        self.degree_counts[new_degree] += 1
+
+    # Adds the length and orientation of the segment vector, or subtracts them
+    # if weight is -1.
+    def add_segment(self, segment_vector, weight=1):
+        road_length = math.hypot(segment_vector[0], segment_vector[1])
+        theta_forward = (2*math.pi + math.atan2(segment_vector[1], segment_vector[0])) % (2*math.pi)
+        theta_backward = (2*math.pi + theta_forward + math.pi) % (2*math.pi)
+        center_adjust = (2*math.pi / NUM_BINS) / 2
+        bin_forward = int((NUM_BINS + (theta_forward + center_adjust) / (2*math.pi / NUM_BINS)) % NUM_BINS)
+        bin_backward = int((NUM_BINS + (theta_backward + center_adjust) / (2*math.pi / NUM_BINS)) % NUM_BINS)
+
+        self.road_length += weight * road_length
+        self.orientation_histogram[bin_forward] += weight * road_length
+        self.orientation_histogram[bin_backward] += weight * road_length
+
+    def remove_segment(self, segment_vector):
+        self.add_segment(segment_vector, -1)
+
+    # Counts the intersections, as compute_intersection_count
+    def intersection_count(self):
+        return sum(self.degree_counts[3:])
+
+    # Total road length in pixels, scaled by the pixel scaling factor if given
+    def total_road_length(self):
+        if self.pixel_scaling_factor is None:
+            return self.road_length
+        return self.road_length * self.pixel_scaling_factor
+
+    def orientation_order(self):
+        return compute_orientation_order(_compute_orientation_entropy(self.orientation_histogram))
+
+    # All metrics, as returned by compute_network_stats_from_arrays
+    def stats(self):
+        return _compute_network_stats_from_counts(self.degree_counts, self.road_length, list(self.orientation_histogram), self.pixel_scaling_factor)
+
+# Vectorised compute_orientation_histogram.
+def _compute_orientation_histogram(segment_vectors, road_lengths):
+    theta_forward = (2*math.pi + np.arctan2(segment_vectors[:, 1], segment_vectors[:, 0])) % (2*math.pi)
+    theta_backward = (2*math.pi + theta_forward + math.pi) % (2*math.pi)
+    center_adjust = (2*math.pi / NUM_BINS) / 2
+    bins = ((NUM_BINS + (np.concatenate((theta_forward, theta_backward)) + center_adjust) / (2*math.pi / NUM_BINS)) % NUM_BINS).astype(int)
+    return np.bincount(bins, weights=np.tile(road_lengths, 2), minlength=NUM_BINS).tolist()
+
+# Vectorised compute_orientation_entropy.
+def _compute_orientation_entropy(orientation_histogram):
+    norm_histogram = np.asarray(orientation_histogram) / np.sum(orientation_histogram)
+    return -float(np.sum(norm_histogram * np.log(norm_histogram + 1e-8)))
+
 # Displays the polar histogram of road orientations
 # y axis going from top to bottom, so angles go clockwise (theta_direction=-1) by default
 def show_orientation_histogram(orientation_histogram, theta_direction=-1):
+    import matplotlib.pyplot as plt
+
     # Calculate bin centers
     bin_width = 2*math.pi / NUM_BINS
     centers = np.arange(0, 2*math.pi, bin_width)
@@ -0,0 +1,97 @@
+import os
+import numpy as np
+from src.road_network.road_network_store import RoadNetworkStore
+
+# Land usages in the order of their codes in the binary format.
+LAND_USE_CODES = ["residential", "commercial", "industry", "none"]
+
+# Arrays making up the binary format, each stored as <name>.npy.
+BINARY_ARRAYS = ["vertex_positions", "segment_vertices", "segment_is_minor_road",
+                 "polygon_offsets", "polygon_vertices", "land_use_codes",
+                 "population_density", "population"]
+
+
+# INPUT:    List, List, List, (String)
+# OUTPUT:   -
+# Writes the road network and land usages as typed arrays, one .npy file per
+# array, to the given directory. Defaults to output/roadnetwork in the current
+# working directory. This holds the same information as city_to_json in a
+# fraction of the space, and can be read back with load_city_binary without
+# parsing. The vertices of polygon i are
+# polygon_vertices[polygon_offsets[i]:polygon_offsets[i+1]], given as indices
+# into vertex_positions.
+def city_to_binary(road_network, vertices, land_usages, output=None):
+    if output is None:
+        output = os.getcwd() + "/output/roadnetwork"
+    os.makedirs(output, exist_ok=True)
+
+    # Map every vertex position to the index of the first vertex at that position.
+    vertex_indices = {}
+    for index, vertex in enumerate(vertices):
+        vertex_indices.setdefault(tuple(vertex.position.tolist()), index)
+
+    polygon_sizes = [len(land_usage["polygon"]) for land_usage in land_usages]
+    arrays = {
+        "vertex_positions": np.array([vertex.position for vertex in vertices], dtype=np.float64).reshape(-1, 2),
+        "segment_vertices": np.array([(vertex_indices[tuple(segment.start_vert.position.tolist())],
+                                       vertex_indices[tuple(segment.end_vert.position.tolist())])
+                                      for segment in road_network], dtype=np.int32).reshape(-1, 2),
+        "segment_is_minor_road": np.array([segment.is_minor_road for segment in road_network], dtype=bool),
+        "polygon_offsets": np.cumsum([0] + polygon_sizes, dtype=np.int64),
+        "polygon_vertices": np.array([vertex_indices[(position['x'], position['z'])]
+                                      for land_usage in land_usages for position in land_usage["polygon"]], dtype=np.int32),
+        "land_use_codes": np.array([LAND_USE_CODES.index(land_usage["land_usage"]) for land_usage in land_usages], dtype=np.uint8),
+        "population_density": np.array([land_usage["population_density"] for land_usage in land_usages], dtype=np.float64),
+        "population": np.array([land_usage["population"] for land_usage in land_usages], dtype=np.int64),
+    }
+
+    for name in BINARY_ARRAYS:
+        np.save(os.path.join(output, name + ".npy"), arrays[name])
+
+
+# INPUT:    String
+# OUTPUT:   CityBinary
+# Opens a city written by city_to_binary. The arrays are memory-mapped and
+# only read from disk when accessed.
+def load_city_binary(path):
+    return CityBinary(path)
+
+
+# A city read back from the binary format. Every array listed in BINARY_ARRAYS
+# is available as a read-only memory-mapped attribute. The object graph used by
+# the statistics is rebuilt lazily, on the first call to road_network.
+class CityBinary:
+    def __init__(self, path):
+        self.path = path
+        for name in BINARY_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        self._road_network = None
+
+    # INPUT:    -
+    # OUTPUT:   RoadNetworkStore
+    def store(self):
+        return RoadNetworkStore.from_arrays(self.vertex_positions, self.segment_vertices, self.segment_is_minor_road)
+
+    # INPUT:    -
+    # OUTPUT:   List, Dictionary
+    # Returns the list of segments and the dictionary mapping every vertex to
+    # its connected segments, i.e. the road_network and vertex_dict inputs of
+    # the statistics.
+    def road_network(self):
+        if self._road_network is None:
+            self._road_network = self.store().to_road_network()
+        return self._road_network
+
+    # INPUT:    -
+    # OUTPUT:   List
+    # Returns the land usages in the format written by city_to_json.
+    def land_usages(self):
+        land_usages = []
+        positions = self.vertex_positions.tolist()
+        offsets = self.polygon_offsets.tolist()
+        polygon_vertices = self.polygon_vertices.tolist()
+        for i, (code, density, population) in enumerate(zip(self.land_use_codes.tolist(), self.population_density.tolist(), self.population.tolist())):
+            land_usages.append({"polygon" : [{'x': positions[vertex][0], 'z': positions[vertex][1], 'mark': 0}
+                                             for vertex in polygon_vertices[offsets[i]:offsets[i + 1]]],
+                                "land_usage" : LAND_USE_CODES[code], "population_density" : density, "population" : population})
+        return land_usages
@@ -2,32 +2,63 @@ import os
 import json
 
 
-# INPUT:    List, Dict, Dict
+# INPUT:    List, List, List, (String | File)
 # OUTPUT:   -
-def city_to_json(road_network, vertices, land_usages):
-    output = {}
+# Writes the road network and land usages to json. The output is streamed to
+# the file at the given path, or to the given file-like object, one vertex,
+# segment and polygon at a time rather than being built in memory first.
+# Defaults to output/roadnetwork.json in the current working directory.
+def city_to_json(road_network, vertices, land_usages, output=None):
+    if output is None:
+        output = os.getcwd() + "/output/roadnetwork.json"
 
-    # Save all vertices in road network.
-    output['roadSegments'] = []
-    output['roadVertices'] = []
-    for vertex in vertices:
-        output["roadVertices"].append({
-            "position": {
-                'x' : float(vertex.position[0]),
-                'y' : float(vertex.position[1])
-            }
-        })
+    if isinstance(output, (str, bytes, os.PathLike)):
+        with open(output, "w") as out:
+            write_city_json(out, road_network, vertices, land_usages)
+    else:
+        write_city_json(output, road_network, vertices, land_usages)
+
+
+# INPUT:    File, List, List, List
+# OUTPUT:   -
+# Streams the json object {"roadSegments": [...], "roadVertices": [...],
+# "land_usages": [...]} to out, formatted exactly like json.dump would.
+def write_city_json(out, road_network, vertices, land_usages):
+    # Map every vertex position to the index of the first vertex at that
+    # position, which is the index list.index would find.
+    vertex_indices = {}
+    for index, vertex in enumerate(vertices):
+        vertex_indices.setdefault(tuple(vertex.position.tolist()), index)
 
     # Save all segments in road network.
-    for segment in road_network:
-        output["roadSegments"].append({
-            "startVertIndex" : vertices.index(segment.start_vert),
-            "endVertIndex" : vertices.index(segment.end_vert)
-        })
+    out.write('{"roadSegments": ')
+    write_json_array(out, ({
+        "startVertIndex" : vertex_indices[tuple(segment.start_vert.position.tolist())],
+        "endVertIndex" : vertex_indices[tuple(segment.end_vert.position.tolist())]
+    } for segment in road_network))
+
+    # Save all vertices in road network.
+    out.write(', "roadVertices": ')
+    write_json_array(out, ({
+        "position": {
+            'x' : float(vertex.position[0]),
+            'y' : float(vertex.position[1])
+        }
+    } for vertex in vertices))
 
     # Save all polygons w/ land usage, population density, and population.
-    output["land_usages"] = land_usages
+    out.write(', "land_usages": ')
+    write_json_array(out, land_usages)
+    out.write('}')
 
-    # Dump to json file.
-    with open(os.getcwd() + "/output/roadnetwork.json", "w") as out:
-        json.dump(output, out)
+
+# INPUT:    File, Iterable
+# OUTPUT:   -
+# Writes the items as a json array, one item at a time.
+def write_json_array(out, items):
+    out.write('[')
+    for index, item in enumerate(items):
+        if index > 0:
+            out.write(', ')
+        out.write(json.dumps(item))
+    out.write(']')
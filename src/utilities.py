@@ -1,7 +1,9 @@
 import numpy as np
-from PIL import Image
-import skimage.morphology
-import gdal
+# PIL, gdal and skimage are imported by the functions using them, so that
+# importing this module does not pay for libraries a run may not need.
+
+# Candidate count above which find_closest_intersection applies its bounding box prefilter.
+INTERSECTION_PREFILTER_SIZE = 32
 
 # INPUT:    String
 # OUTPUT:   numpy.Array
@@ -10,6 +12,7 @@ import gdal
 # lists where each parent list corresponds to a row of pixel
 # values. All pixels contain [r, g, b]-values.
 def parse_image(filename):
+    from PIL import Image
     image_array = np.asarray(Image.open(filename))
     # Remove alpha value if image only contains a single color.
     if image_array.shape[2] == 4:
@@ -20,13 +23,17 @@ def parse_image(filename):
 # INPUT:    numpy.Array, numpy.Array
 # OUTPUT:   numpy.Array
 # Given an array of colour values, and a specific legend color,
-# we create and subsequently zip a 2-tuple of arrays containing 
-# indices in the first and second dimension corresponding to the 
-# pixel values of the colour matching the legend.
+# we return an (N,2) array of the indices in the first and second
+# dimension of the pixels whose colour matches the legend.
 def find_legend_color_coordinates(image_array, legend_color):
-    indices = np.where(np.all(image_array == legend_color, axis=-1))
-    # Convert iterator to list to array before returning.
-    return np.array(list(zip(indices[0], indices[1]))) 
+    return np.argwhere(find_legend_mask(image_array, legend_color))
+
+
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   numpy.Array
+# Returns a Boolean mask of the pixels whose colour matches the legend.
+def find_legend_mask(image_array, legend):
+    return np.all(image_array == legend, axis=-1)
 
 
 # INPUT:    Segment
@@ -37,6 +44,47 @@ def find_pixel_value(segment, image_array):
     return image_array[y,x]
 
 
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   numpy.Array
+# Batched version of find_pixel_value for an (N,2) array of positions.
+def find_pixel_values(positions, image_array):
+    return image_array[np.round(positions[:, 1]).astype(int), np.round(positions[:, 0]).astype(int)]
+
+
+# INPUT:    numpy.Array, List, Integer
+# OUTPUT:   numpy.Array
+# Compiles an RGB image into an int8 raster of labels. legend_labels is a list
+# of (legend colour, label) pairs in order of precedence. Pixels matching none
+# of the legends are assigned default_label.
+def compile_label_raster(image_array, legend_labels, default_label):
+    labels = np.full(image_array.shape[:2], default_label, dtype=np.int8)
+    for legend, label in reversed(legend_labels):
+        labels[np.all(image_array == legend, axis=-1)] = label
+    return labels
+
+
+# INPUT:    Tuple, numpy.Array, (Tuple)
+# OUTPUT:   numpy.Array
+# Computes a raster of the given (height, width) shape holding, for every pixel
+# position (x, y), the index of the nearest of the given centers. Ties are
+# resolved in favour of the first center, matching numpy.argmin. The raster
+# starts at the (x, y) origin, so a window of a larger raster can be computed
+# on its own.
+def compute_nearest_center_raster(shape, centers, origin=(0, 0)):
+    dtype = np.int16 if len(centers) <= np.iinfo(np.int16).max else np.int32
+    nearest = np.zeros(shape, dtype=dtype)
+    y, x = np.indices(shape, dtype=np.float64)
+    x += origin[0]
+    y += origin[1]
+    nearest_distance = np.full(shape, np.inf)
+    for index, center in enumerate(centers):
+        distance = np.hypot(x - center[0], y - center[1])
+        closer = distance < nearest_distance
+        nearest[closer] = index
+        nearest_distance[closer] = distance[closer]
+    return nearest
+
+
 # INPUT:    numpy.Array
 # OUTPUT:   Tuple
 def find_coordinates_centroid(coordinates):
@@ -50,31 +98,46 @@ def find_coordinates_centroid(coordinates):
 
 #INPUT:     numpy.Array, List
 #OUTPUT:    numpy.Array
+# Returns the (row, column) centroid of every cluster of pixels matching the
+# legend colour, or an empty list if the legend is not present in the image.
 def find_legend_centers(image_array, legend):
-    # Find all coordinates matching the specified legend.
-    legend_indices = find_legend_color_coordinates(image_array, legend)
-
-    # if the legend is not present in the image, return an empty list, i.e. no centers
-    if legend_indices.size == 0:
-        return []
-    
     # Create a Boolean matrix of size image_width x image_height and mark every
     # cell as either True or False depending on whether the legend colour is
     # present in that pixel. 
-    legend_matches = np.zeros((np.shape(image_array)[0], np.shape(image_array)[1]), dtype=bool)
-    legend_matches[legend_indices[:,0], legend_indices[:,1]] = True
+    return find_mask_centers(find_legend_mask(image_array, legend))
+
+
+#INPUT:     numpy.Array
+#OUTPUT:    numpy.Array
+# Returns the (row, column) centroid of every cluster of True pixels of a
+# Boolean mask, or an empty list if there are none.
+def find_mask_centers(legend_matches):
+    # if the legend is not present in the image, return an empty list, i.e. no centers
+    if not legend_matches.any():
+        return []
 
     # Find clusters of the legend in the array and label them.
+    import skimage.morphology
     labeled_matches = skimage.morphology.label(legend_matches)
 
-    # Create list of coordinates for each cluster in the array.
-    clusters = [list(zip(y, x)) for y, x in 
-               [(labeled_matches == cluster).nonzero() for cluster in range(1, labeled_matches.max()+1)]]
-               
     # Find the centroids of each cluster.
-    centroids = [find_coordinates_centroid(coords) for coords in np.array(clusters)]
+    return find_label_centroids(labeled_matches)
+
 
-    return np.array(centroids)
+#INPUT:     numpy.Array
+#OUTPUT:    numpy.Array
+# Returns the (row, column) centroid of every region of a label array, for
+# the labels 1 to labels.max(), as a (K,2) array. Label 0 is background. The
+# centroids are computed in a single pass over the labelled pixels by summing
+# their coordinates per label with np.bincount.
+def find_label_centroids(labels):
+    rows, columns = np.nonzero(labels)
+    region_labels = labels[rows, columns]
+    label_count = int(labels.max()) + 1 if rows.size > 0 else 1
+    counts = np.bincount(region_labels, minlength=label_count)[1:]
+    row_sums = np.bincount(region_labels, weights=rows, minlength=label_count)[1:]
+    column_sums = np.bincount(region_labels, weights=columns, minlength=label_count)[1:]
+    return np.column_stack((row_sums / counts, column_sums / counts))
 
 
 # INPUT:    numpy.Array, Float
@@ -91,6 +154,28 @@ def rotate(vector, angle):
     return np.dot(vector, rotation_matrix)
 
 
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   numpy.Array
+# Batched version of rotate. Rotates every vector in an (...,2) array by the
+# corresponding angle, in degrees, of an array broadcastable to (...).
+def rotate_batch(vectors, angles):
+    angles = np.radians(angles)
+    cos, sin = np.cos(angles), np.sin(angles)
+    return np.stack((vectors[..., 0] * cos - vectors[..., 1] * sin,
+                     vectors[..., 0] * sin + vectors[..., 1] * cos), axis=-1)
+
+
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   numpy.Array, numpy.Array
+# Used by the batched growth rules. Given the (N,K,2) candidate end positions
+# of K proposal slots for N parent segments and an (N,K) mask of accepted
+# candidates, returns the parent index and end position of every accepted
+# candidate, ordered by parent and then by slot.
+def collect_proposals(end_positions, accepted):
+    parents = np.nonzero(accepted)[0]
+    return parents, end_positions[accepted]
+
+
 # INPUT:    Segment, Segment
 # OUTPUT:   numpy.Array
 # Computes the normalised position of the intersection on segment_one.
@@ -106,12 +191,77 @@ def compute_intersection(segment_one, segment_two):
         return np.array([np.inf, np.inf])
 
 
+# INPUT:    numpy.Array, numpy.Array, (Float, Float, Float)
+# OUTPUT:   Tuple
+# Batched version of compute_intersection. Given a segment as a (2,2) array of
+# [start, end] positions and N candidate segments as an (N,2,2) array, the
+# normalised positions of intersection on the segment (t) and on every
+# candidate (u) are computed in closed form using 2D cross products, with
+# parallel and degenerate candidates masked out. Returns the index of the valid
+# intersection closest to the start of the segment together with its t value,
+# or (None, numpy.inf) if there is none. An intersection is valid if
+# min_value < t < max_value_one and min_value < u < max_value_two.
+def find_closest_intersection(segment_array, candidate_arrays, min_value=0.00001, max_value_one=1.49999, max_value_two=0.99999):
+    if len(candidate_arrays) == 0:
+        return None, np.inf
+
+    # Work relative to the start of the segment.
+    start = segment_array[0]
+    sub_x, sub_y = segment_array[1] - start
+    offsets = (candidate_arrays - start).reshape(-1, 4)
+    candidate_indices = None
+
+    # For large candidate sets, a cheap bounding box prefilter against the box
+    # swept by the segment discards candidates before solving. For small sets
+    # the prefilter costs more than it saves.
+    if len(offsets) > INTERSECTION_PREFILTER_SIZE:
+        swept_x = (0, max_value_one * sub_x)
+        swept_y = (0, max_value_one * sub_y)
+        overlaps = ((np.minimum(offsets[:, 0], offsets[:, 2]) <= max(swept_x)) &
+                    (np.maximum(offsets[:, 0], offsets[:, 2]) >= min(swept_x)) &
+                    (np.minimum(offsets[:, 1], offsets[:, 3]) <= max(swept_y)) &
+                    (np.maximum(offsets[:, 1], offsets[:, 3]) >= min(swept_y)))
+        candidate_indices = np.nonzero(overlaps)[0]
+        if candidate_indices.size == 0:
+            return None, np.inf
+        offsets = offsets[candidate_indices]
+
+    # Solve t * segment_sub = candidate_start + u * candidate_sub, where both
+    # candidate positions are relative to the segment start.
+    denominator = offsets @ np.array([sub_y, -sub_x, -sub_y, sub_x])
+    t_numerator = offsets[:, 0] * offsets[:, 3] - offsets[:, 1] * offsets[:, 2]
+    u_numerator = offsets[:, :2] @ np.array([sub_y, -sub_x])
+
+    # Parallel and degenerate (zero length) segments have no unique intersection.
+    solvable = denominator != 0
+    t = np.divide(t_numerator, denominator, out=np.full(len(offsets), np.inf), where=solvable)
+    u = np.divide(u_numerator, denominator, out=np.full(len(offsets), np.inf), where=solvable)
+
+    valid = (t > min_value) & (t < max_value_one) & (u > min_value) & (u < max_value_two)
+    if not valid.any():
+        return None, np.inf
+
+    t[~valid] = np.inf
+    closest = int(np.argmin(t))
+    closest_value = float(t[closest])
+    if candidate_indices is not None:
+        closest = int(candidate_indices[closest])
+    return closest, closest_value
+
+
 # INPUT:    Segment, np.Array
 # OUTPUT:   Integer
 # Get the population density value for a specific pixel of
 # the population density image
 def get_population_density_value(segment, population_image_array):
-    return population_image_array[int(segment.end_vert.position[1])][int(segment.end_vert.position[0])]
+    return population_image_array[int(segment.end_vert.position[1]), int(segment.end_vert.position[0])]
+
+
+# INPUT:    numpy.Array, numpy.Array
+# OUTPUT:   numpy.Array
+# Batched version of get_population_density_value for an (N,2) array of positions.
+def get_population_density_values(positions, population_image_array):
+    return population_image_array[positions[:, 1].astype(int), positions[:, 0].astype(int)]
 
 
 # INPUT:    numpy.Array
@@ -124,6 +274,7 @@ def normalise_pixel_values(image_array):
 # INPUT:    String
 # OUTPUT:   numpy.Array
 def read_tif_file(filename):
+    import gdal
     gdo = gdal.Open(filename)
     band = gdo.GetRasterBand(1)
     return np.array(gdo.ReadAsArray(0, 0, band.XSize, band.YSize))
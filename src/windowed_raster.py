@@ -0,0 +1,336 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from src.utilities import compute_nearest_center_raster
+
+
+# Read-only raster that is read in square blocks of block_size x block_size
+# pixels on demand, instead of being held in memory as a whole. The most
+# recently used max_blocks blocks are kept in an LRU cache, so lookups close
+# to earlier lookups, as made by a growing road network, rarely read from the
+# source. The pixels come from a reader, see ArrayReader, GdalReader,
+# DerivedReader, DecimatedReader and NearestCenterReader.
+# The raster is indexed like a numpy array of the given (height, width) shape:
+# raster[y, x] with integers or integer arrays returns the pixel values, with
+# negative indices counted from the end and out of bounds indices raising an
+# IndexError, and raster[y0:y1, x0:x1] returns the window as a numpy array.
+# An overview raster, see overview, reads from a reader of reduced resolution
+# but is indexed with full resolution coordinates, every coordinate being
+# divided by scale. The raster can be used from several threads and is
+# pickled without its cached blocks.
+class WindowedRaster:
+    def __init__(self, reader, block_size=256, max_blocks=64, shape=None, scale=1):
+        self.reader = reader
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.shape = tuple(reader.shape) if shape is None else tuple(shape)
+        self.scale = scale
+        self.dtype = reader.dtype
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["blocks"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __array__(self, dtype=None):
+        array = self[:, :]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    # INPUT:    Integer | numpy.Array | slice | Tuple
+    # OUTPUT:   Value | numpy.Array
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 1:
+            key = key + (slice(None),)
+        if len(key) != 2:
+            raise IndexError("windowed rasters are indexed with (row, column)")
+        rows, columns = key
+
+        # Single pixel lookups, by far the most common, skip the array conversions.
+        if isinstance(rows, (int, np.integer)) and isinstance(columns, (int, np.integer)):
+            height, width = self.shape[:2]
+            if not (-height <= rows < height and -width <= columns < width):
+                raise IndexError("index ({}, {}) out of bounds for raster of shape {}".format(rows, columns, self.shape))
+            return self._pixel(int(rows) % height // self.scale, int(columns) % width // self.scale)
+
+        if not isinstance(rows, slice) and not isinstance(columns, slice):
+            rows = _normalise_index(rows, self.shape[0]) // self.scale
+            columns = _normalise_index(columns, self.shape[1]) // self.scale
+            if rows.ndim == 0 and columns.ndim == 0:
+                return self._pixel(int(rows), int(columns))
+            return self._gather(rows, columns)
+
+        if isinstance(rows, slice) and isinstance(columns, slice):
+            row_start, row_stop, row_step = rows.indices(self.shape[0])
+            column_start, column_stop, column_step = columns.indices(self.shape[1])
+            if self.scale == 1 and row_step == 1 and column_step == 1:
+                return self.read_window(column_start, row_start, column_stop, row_stop)
+            rows = np.arange(row_start, row_stop, row_step)[:, None]
+            columns = np.arange(column_start, column_stop, column_step)[None, :]
+        elif isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.shape[0]))
+            columns = np.full(rows.shape, columns)
+        else:
+            columns = np.arange(*columns.indices(self.shape[1]))
+            rows = np.full(columns.shape, rows)
+        if np.ndim(rows) > 2 or np.ndim(columns) > 2:
+            raise IndexError("windowed rasters do not support mixing slices and index arrays")
+        return self[rows, columns]
+
+    # INPUT:    Integer, Integer, Integer, Integer
+    # OUTPUT:   numpy.Array
+    # Reads the (x0, y0, x1, y1) window of a full resolution raster directly
+    # from the reader, bypassing the block cache so that large windows do not
+    # evict the cached blocks.
+    def read_window(self, x0, y0, x1, y1):
+        if x1 <= x0 or y1 <= y0:
+            return np.empty((max(y1 - y0, 0), max(x1 - x0, 0)) + self.shape[2:], dtype=self.dtype)
+        return np.asarray(self.reader.read(x0, y0, x1, y1))
+
+    # INPUT:    Function
+    # OUTPUT:   WindowedRaster
+    # Returns a raster whose blocks are computed by applying the transform to
+    # the blocks of this raster, e.g. to compile a label raster from an
+    # image. The transform has to map every pixel independently and be
+    # picklable for the raster to be sent to other processes.
+    def derive(self, transform):
+        reader = DerivedReader(self.reader, transform)
+        return WindowedRaster(reader, self.block_size, self.max_blocks, shape=self.shape[:2] + reader.shape[2:], scale=self.scale)
+
+    # INPUT:    Integer
+    # OUTPUT:   WindowedRaster
+    # Returns the overview of this raster that is reduced in resolution by the
+    # given factor. Every lookup returns the value of a single pixel of the
+    # factor x factor block containing it, so label and mask values are kept
+    # as they are. Readers with native overviews, e.g. GeoTIFFs with overviews
+    # built by build_overviews, provide them directly.
+    def overview(self, factor):
+        if factor == 1:
+            return self
+        reader = self.reader.overview(factor) if hasattr(self.reader, "overview") else DecimatedReader(self.reader, factor)
+        return WindowedRaster(reader, self.block_size, self.max_blocks, shape=self.shape, scale=self.scale * factor)
+
+    # INPUT:    -
+    # OUTPUT:   Value
+    # Returns the maximum value of the raster, reading it one block at a time.
+    def max(self):
+        height, width = self.reader.shape[:2]
+        return max(self.read_window(x0, y0, min(x0 + self.block_size, width), min(y0 + self.block_size, height)).max()
+                   for y0 in range(0, height, self.block_size) for x0 in range(0, width, self.block_size))
+
+    # INPUT:    Integer, Integer
+    # OUTPUT:   Value
+    def _pixel(self, row, column):
+        block = self._block(row // self.block_size, column // self.block_size)
+        return block[row % self.block_size, column % self.block_size]
+
+    # INPUT:    numpy.Array, numpy.Array
+    # OUTPUT:   numpy.Array
+    # Returns the pixels at the given reader coordinates. The coordinates are
+    # grouped by block so that every block is looked up once.
+    def _gather(self, rows, columns):
+        rows, columns = np.broadcast_arrays(rows, columns)
+        band_shape = tuple(self.reader.shape[2:])
+        values = np.empty((rows.size,) + band_shape, dtype=self.dtype)
+        rows, columns, shape = rows.ravel(), columns.ravel(), rows.shape
+        if rows.size == 0:
+            return values.reshape(shape + band_shape)
+
+        blocks_across = -(-self.reader.shape[1] // self.block_size)
+        block_ids = (rows // self.block_size) * blocks_across + columns // self.block_size
+        order = np.argsort(block_ids, kind="stable")
+        sorted_ids = block_ids[order]
+        bounds = np.flatnonzero(np.diff(sorted_ids)) + 1
+        for start, stop in zip(np.r_[0, bounds].tolist(), np.r_[bounds, len(order)].tolist()):
+            block_id = int(sorted_ids[start])
+            block = self._block(block_id // blocks_across, block_id % blocks_across)
+            members = order[start:stop]
+            values[members] = block[rows[members] % self.block_size, columns[members] % self.block_size]
+        return values.reshape(shape + band_shape)
+
+    # INPUT:    Integer, Integer
+    # OUTPUT:   numpy.Array
+    # Returns the block in the given block row and column, reading it on a miss.
+    def _block(self, block_row, block_column):
+        key = (block_row, block_column)
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+
+            self.misses += 1
+            height, width = self.reader.shape[:2]
+            y0, x0 = block_row * self.block_size, block_column * self.block_size
+            block = self.read_window(x0, y0, min(x0 + self.block_size, width), min(y0 + self.block_size, height))
+            block.flags.writeable = False
+            self.blocks[key] = block
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+            return block
+
+
+# Reads windows of an array held in memory or memory-mapped from a .npy
+# file. Memory-mapped arrays are pickled as their file name rather than their
+# contents.
+class ArrayReader:
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def __getstate__(self):
+        if isinstance(self.array, np.memmap) and self.array.filename is not None:
+            return {"filename": self.array.filename}
+        return {"array": self.array}
+
+    def __setstate__(self, state):
+        self.__init__(np.load(state["filename"], mmap_mode="r") if "filename" in state else state["array"])
+
+    # INPUT:    Integer, Integer, Integer, Integer
+    # OUTPUT:   numpy.Array
+    def read(self, x0, y0, x1, y1):
+        return self.array[y0:y1, x0:x1]
+
+
+# Reads windows of the first band of a raster file through GDAL, without
+# reading the rest of the file. With a factor above 1, windows are read at
+# 1/factor of the resolution, which GDAL serves from the closest overview of
+# the file if it has any, see build_overviews.
+class GdalReader:
+    def __init__(self, filename, factor=1):
+        import gdal
+        self.filename = filename
+        self.factor = factor
+        self.dataset = gdal.Open(filename)
+        self.band = self.dataset.GetRasterBand(1)
+        self.shape = (-(-self.band.YSize // factor), -(-self.band.XSize // factor))
+        self.dtype = np.asarray(self.band.ReadAsArray(0, 0, 1, 1)).dtype
+
+    def __getstate__(self):
+        return {"filename": self.filename, "factor": self.factor}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"], state["factor"])
+
+    # INPUT:    Integer
+    # OUTPUT:   GdalReader
+    def overview(self, factor):
+        return GdalReader(self.filename, self.factor * factor)
+
+    # INPUT:    Integer, Integer, Integer, Integer
+    # OUTPUT:   numpy.Array
+    def read(self, x0, y0, x1, y1):
+        if self.factor == 1:
+            return self.band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        full_x0, full_y0 = x0 * self.factor, y0 * self.factor
+        full_x1, full_y1 = min(x1 * self.factor, self.band.XSize), min(y1 * self.factor, self.band.YSize)
+        return self.band.ReadAsArray(full_x0, full_y0, full_x1 - full_x0, full_y1 - full_y0,
+                                     buf_xsize=x1 - x0, buf_ysize=y1 - y0)
+
+
+# Reads windows of another reader and applies a per-pixel transform to them.
+class DerivedReader:
+    def __init__(self, reader, transform):
+        self.reader = reader
+        self.transform = transform
+        sample = np.asarray(transform(reader.read(0, 0, 1, 1)))
+        self.shape = tuple(reader.shape[:2]) + sample.shape[2:]
+        self.dtype = sample.dtype
+
+    # INPUT:    Integer, Integer, Integer, Integer
+    # OUTPUT:   numpy.Array
+    def read(self, x0, y0, x1, y1):
+        return np.asarray(self.transform(self.reader.read(x0, y0, x1, y1)))
+
+
+# Reads windows of another reader at 1/factor of its resolution by keeping
+# the top left pixel of every factor x factor block.
+class DecimatedReader:
+    def __init__(self, reader, factor):
+        self.reader = reader
+        self.factor = factor
+        self.shape = (-(-reader.shape[0] // factor), -(-reader.shape[1] // factor)) + tuple(reader.shape[2:])
+        self.dtype = reader.dtype
+
+    # INPUT:    Integer, Integer, Integer, Integer
+    # OUTPUT:   numpy.Array
+    def read(self, x0, y0, x1, y1):
+        height, width = self.reader.shape[:2]
+        window = self.reader.read(x0 * self.factor, y0 * self.factor,
+                                  min(x1 * self.factor, width), min(y1 * self.factor, height))
+        return np.asarray(window)[::self.factor, ::self.factor]
+
+
+# Computes windows of the raster holding, for every pixel, the index of the
+# nearest of the given centers, see compute_nearest_center_raster.
+class NearestCenterReader:
+    def __init__(self, centers, shape):
+        self.centers = np.asarray(centers)
+        self.shape = tuple(shape[:2])
+        self.dtype = np.dtype(np.int16 if len(self.centers) <= np.iinfo(np.int16).max else np.int32)
+
+    # INPUT:    Integer, Integer, Integer, Integer
+    # OUTPUT:   numpy.Array
+    def read(self, x0, y0, x1, y1):
+        return compute_nearest_center_raster((y1 - y0, x1 - x0), self.centers, origin=(x0, y0))
+
+
+# INPUT:    String
+# OUTPUT:   ArrayReader | GdalReader
+# Returns a reader of the raster file. GeoTIFFs are read through GDAL and
+# .npy files are memory-mapped. Other image formats cannot be read in
+# windows and have to be decoded into an ArrayReader instead.
+def open_raster_reader(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in (".tif", ".tiff"):
+        return GdalReader(filename)
+    elif extension == ".npy":
+        return ArrayReader(np.load(filename, mmap_mode="r"))
+    raise ValueError("Cannot read {} in windows".format(filename))
+
+
+# INPUT:    String, (List, String)
+# OUTPUT:   -
+# Builds overviews of a GeoTIFF at 1/factor of its resolution for each of the
+# given factors. The overviews are stored next to the file, as file.ovr, and
+# are used by GdalReader for overview rasters. Nearest resampling keeps label
+# values intact.
+def build_overviews(filename, factors=(2, 4, 8, 16), resampling="NEAREST"):
+    import gdal
+    dataset = gdal.Open(filename)
+    dataset.BuildOverviews(resampling, list(factors))
+    dataset = None
+
+
+# INPUT:    Integer | numpy.Array, Integer
+# OUTPUT:   numpy.Array
+# Converts indices into non-negative indices along an axis of the given size,
+# following numpy's indexing rules.
+def _normalise_index(index, size):
+    index = np.asarray(index)
+    if not np.issubdtype(index.dtype, np.integer):
+        raise IndexError("only integers and integer arrays are valid indices")
+    index = np.where(index < 0, index + size, index)
+    if index.size > 0 and (index.min() < 0 or index.max() >= size):
+        raise IndexError("index out of bounds for axis with size {}".format(size))
+    return index
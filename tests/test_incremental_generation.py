@@ -0,0 +1,52 @@
+import os
+import random
+import numpy as np
+import pytest
+from src.config_loader import ConfigLoader
+from src.incremental_generation import regenerate_region
+from src.road_network.road_network_generator import generate_road_network
+from src.road_network.spatial_index import SegmentIndex
+from src.road_network.spatial_index import segment_bounding_box
+from src.utilities import find_closest_intersection
+
+# The config loader reads the input images relative to the working directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(ROOT, "input", "configs", "auckland.json")
+
+
+# Returns the number of segments crossing or touching a segment they share no
+# vertex with.
+def count_crossings(store):
+    segment_arrays = store.positions[store.segment_vertices]
+    segment_index = SegmentIndex(40)
+    for segment, segment_array in enumerate(segment_arrays):
+        segment_index.insert(segment, *segment_array)
+
+    crossings = 0
+    for segment, segment_array in enumerate(segment_arrays):
+        vertices = set(store.segment_vertices[segment].tolist())
+        others = [other for other in segment_index.query(segment_bounding_box(*segment_array))
+                  if not vertices & set(store.segment_vertices[other].tolist())]
+        if others:
+            closest_index, _ = find_closest_intersection(segment_array, segment_arrays[others], min_value=-0.00001,
+                                                         max_value_one=1.00001, max_value_two=1.00001)
+            crossings += closest_index is not None
+    return crossings
+
+
+# Regrown roads must not cross the roads kept around the region. Reading the
+# population density map needs GDAL.
+@pytest.mark.parametrize("seed, dirty_region", [(4, (300, 300, 340, 340)), (1, (400, 400, 440, 440))])
+def test_regrown_roads_do_not_cross_kept_roads(seed, dirty_region, monkeypatch):
+    pytest.importorskip("gdal")
+    monkeypatch.chdir(ROOT)
+    config = ConfigLoader(CONFIG_PATH)
+    random.seed(seed)
+    np.random.seed(seed)
+    store = generate_road_network(config, return_store=True)
+
+    for regrowth_seed in range(3):
+        random.seed(regrowth_seed)
+        np.random.seed(regrowth_seed)
+        new_store, _ = regenerate_region(config, store, [], dirty_region)
+        assert count_crossings(new_store) <= count_crossings(store)
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from src.city_blocks.land_usage import LAND_USAGES, get_land_use_classes, get_land_use_lookup_table
+
+CONFIG = SimpleNamespace(residential_legends=[1, 2], commercial_legends=[3, 1], industry_legends=[7])
+
+
+# Every sample gets the class of the first legend it is listed in, and values
+# in no legend, including nodata values and fractional values of float
+# rasters, get len(LAND_USAGES).
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.float32])
+def test_land_use_classes(dtype):
+    samples = np.array([1, 2, 3, 7, 0, 100], dtype=dtype)
+    classes = get_land_use_classes(samples, get_land_use_lookup_table(CONFIG))
+    assert classes.tolist() == [0, 0, 1, 2, 3, 3]
+
+
+def test_land_use_classes_of_nodata_and_fractional_values():
+    lookup_table = get_land_use_lookup_table(CONFIG)
+    assert get_land_use_classes(np.array([-9999, 7], dtype=np.int16), lookup_table).tolist() == [len(LAND_USAGES), 2]
+    assert get_land_use_classes(np.array([2.5, np.nan, 3.0], dtype=np.float32), lookup_table).tolist() == [3, 3, 1]
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from src.road_network.road_network_store import RoadNetworkStore
+from src.road_network.spatial_index import SegmentIndex
+from src.road_network.spatial_index import VertexIndex
+from src.road_network.spatial_index import segment_bounding_box
+
+
+# The closest vertex strictly within distance_upper_bound, found by checking
+# every vertex, as the cKDTree query it replaced.
+def nearest_brute_force(positions, position, distance_upper_bound):
+    distances = np.hypot(positions[:, 0] - position[0], positions[:, 1] - position[1])
+    closest = int(np.argmin(distances))
+    return closest if distances[closest] < distance_upper_bound else None
+
+
+@pytest.mark.parametrize("cell_size", [1, 7.5, 40])
+def test_nearest_vertex(cell_size):
+    rng = np.random.default_rng(0)
+    positions = rng.uniform(-50, 150, (500, 2))
+    vertex_index = VertexIndex(cell_size)
+    for vertex, position in enumerate(positions):
+        vertex_index.insert(vertex, position)
+
+    for position in rng.uniform(-60, 160, (200, 2)):
+        for distance_upper_bound in [0.5, 3, 12, 50]:
+            assert vertex_index.nearest(position, distance_upper_bound) == nearest_brute_force(positions, position, distance_upper_bound)
+
+
+# A vertex exactly at the distance upper bound is not returned, as with
+# cKDTree, also when it lies on a cell border.
+def test_nearest_vertex_at_distance_upper_bound():
+    vertex_index = VertexIndex(5)
+    vertex_index.insert(0, np.array([13.0, 14.0]))
+    assert vertex_index.nearest(np.array([10.0, 10.0]), 5) is None
+    assert vertex_index.nearest(np.array([10.0, 10.0]), 5.000001) == 0
+    vertex_index.insert(1, np.array([15.0, 10.0]))
+    assert vertex_index.nearest(np.array([10.0, 10.0]), 5) is None
+    assert vertex_index.nearest(np.array([10.0, 10.0]), 5.000001) in (0, 1)
+    assert vertex_index.nearest(np.array([10.0, 10.0]), 0) is None
+
+
+# The segments whose bounding boxes overlap the box, found by checking every
+# segment of the store.
+def query_brute_force(store, bounding_box):
+    min_x, min_y, max_x, max_y = bounding_box
+    segment_arrays = store.positions[store.segment_vertices]
+    minimum, maximum = segment_arrays.min(axis=1), segment_arrays.max(axis=1)
+    overlaps = (minimum[:, 0] <= max_x) & (maximum[:, 0] >= min_x) & (minimum[:, 1] <= max_y) & (maximum[:, 1] >= min_y)
+    return np.flatnonzero(overlaps).tolist()
+
+
+# Segments are added to the store and the index, and split as in
+# _create_intersection: the split segment is updated in the index and the new
+# segment inserted.
+@pytest.mark.parametrize("cell_size", [3, 40])
+def test_segment_query(cell_size):
+    rng = np.random.default_rng(1)
+    store = RoadNetworkStore()
+    segment_index = SegmentIndex(cell_size)
+    for start_position, end_position in rng.uniform(0, 200, (300, 2, 2)):
+        segment = store.add_segment(store.add_vertex(start_position), store.add_vertex(end_position))
+        segment_index.insert(segment, start_position, end_position)
+    for segment in rng.choice(store.segment_count, 150, replace=False).tolist():
+        start_position, end_position = store.segment_array(segment)
+        new_segment = store.split_segment(segment, store.add_vertex(start_position + rng.uniform() * (end_position - start_position)))
+        segment_index.update(segment, *store.segment_array(segment))
+        segment_index.insert(new_segment, *store.segment_array(new_segment))
+    assert len(segment_index) == store.segment_count
+
+    for start_position, end_position in rng.uniform(-10, 210, (500, 2, 2)):
+        bounding_box = segment_bounding_box(start_position, end_position)
+        assert segment_index.query(bounding_box) == query_brute_force(store, bounding_box)
+    for segment_array in store.positions[store.segment_vertices][:50]:
+        bounding_box = segment_bounding_box(*segment_array)
+        assert segment_index.query(bounding_box) == query_brute_force(store, bounding_box)
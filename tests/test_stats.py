@@ -0,0 +1,83 @@
+import os
+import random
+import numpy as np
+import pytest
+from src import stats
+from src.config_loader import ConfigLoader
+from src.road_network.road_network_generator import generate_road_network
+
+# The config loader reads the input images relative to the working directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(ROOT, "input", "configs", "auckland.json")
+
+COUNT_METRICS = ["intersection_count"]
+FLOAT_METRICS = ["average_node_degree", "proportion_dead_ends", "proportion_3way_intersections",
+                 "proportion_4way_intersections", "total_road_length", "orientation_entropy", "orientation_order"]
+
+
+# Generates a road network with its metrics tracked. A uniform population
+# density replaces the population density map, which would need GDAL.
+@pytest.fixture
+def store():
+    previous_directory = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        config = ConfigLoader(CONFIG_PATH)
+    finally:
+        os.chdir(previous_directory)
+    config.population_density_field = np.full(config.road_rules_labels.shape, 0.5, dtype=np.float32)
+    config.max_minor_road_iterations = 2000
+    random.seed(1)
+    np.random.seed(1)
+    return generate_road_network(config, return_store=True, track_metrics=True)
+
+
+# Computes the metrics of the road network with the original list-based
+# functions.
+def list_based_stats(store):
+    road_network, vertex_dict = store.to_road_network()
+    orientation_histogram = stats.compute_orientation_histogram(road_network)
+    orientation_entropy = stats.compute_orientation_entropy(np.array(orientation_histogram))
+    return {
+        "average_node_degree": stats.compute_average_node_degree(vertex_dict),
+        "intersection_count": stats.compute_intersection_count(vertex_dict),
+        "proportion_dead_ends": stats.compute_proportion_dead_ends(vertex_dict),
+        "proportion_3way_intersections": stats.compute_proportion_3way_intersections(vertex_dict),
+        "proportion_4way_intersections": stats.compute_proportion_4way_intersections(vertex_dict),
+        "total_road_length": stats.compute_total_road_length(road_network, pixel_scaling_factor=store.metrics.pixel_scaling_factor),
+        "orientation_histogram": orientation_histogram,
+        "orientation_entropy": orientation_entropy,
+        "orientation_order": stats.compute_orientation_order(orientation_entropy),
+    }
+
+
+def assert_stats_equal(network_stats, expected_stats, rtol=1e-9):
+    for metric in COUNT_METRICS:
+        assert network_stats[metric] == expected_stats[metric], metric
+    for metric in FLOAT_METRICS:
+        assert network_stats[metric] == pytest.approx(expected_stats[metric], rel=rtol), metric
+    np.testing.assert_allclose(network_stats["orientation_histogram"], expected_stats["orientation_histogram"], rtol=rtol)
+
+
+def test_array_stats_match_list_based_stats(store):
+    road_network, vertex_dict = store.to_road_network()
+    expected_stats = list_based_stats(store)
+    assert_stats_equal(stats.compute_network_stats(vertex_dict, road_network, pixel_scaling_factor=store.metrics.pixel_scaling_factor),
+                       expected_stats)
+    segment_arrays = store.positions[store.segment_vertices]
+    assert_stats_equal(stats.compute_network_stats_from_arrays(store.degrees, segment_arrays[:, 1] - segment_arrays[:, 0],
+                                                               store.metrics.pixel_scaling_factor),
+                       expected_stats)
+
+
+# The tracker follows the growth of the network, including the segments split
+# by intersections during growth, and the segments split afterwards.
+def test_tracked_stats_match_list_based_stats(store):
+    degree_counts = store.metrics.degree_counts
+    assert degree_counts == np.bincount(store.degrees, minlength=len(degree_counts)).tolist()
+    assert_stats_equal(store.metrics.stats(), list_based_stats(store))
+
+    for segment in range(0, store.segment_count, 7):
+        start_position, end_position = store.positions[store.segment_vertices[segment]]
+        store.split_segment(segment, store.add_vertex((start_position + end_position) / 2))
+    assert_stats_equal(store.metrics.stats(), list_based_stats(store))
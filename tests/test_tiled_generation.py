@@ -0,0 +1,29 @@
+import os
+import random
+import numpy as np
+import pytest
+from src.config_loader import ConfigLoader
+from src.road_network.tiled_generation import generate_road_network_tiled
+
+# The config loader reads the input images relative to the working directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(ROOT, "input", "configs", "auckland.json")
+
+
+# Stitched tiles must form a valid road network: no zero-length segments, no
+# two vertices at the same position, no vertices without segments and no
+# more than four roads in an intersection. Reading the population density
+# map needs GDAL.
+@pytest.mark.parametrize("seed", [1, 5])
+def test_stitched_network_is_valid(seed, monkeypatch):
+    pytest.importorskip("gdal")
+    monkeypatch.chdir(ROOT)
+    random.seed(seed)
+    np.random.seed(seed)
+    store = generate_road_network_tiled(ConfigLoader(CONFIG_PATH), tiles=(2, 2), seed=seed, return_store=True)
+
+    segment_arrays = store.positions[store.segment_vertices]
+    assert np.all(np.linalg.norm(segment_arrays[:, 1] - segment_arrays[:, 0], axis=1) > 0)
+    assert len(np.unique(store.positions, axis=0)) == store.vertex_count
+    assert np.all(store.degrees > 0)
+    assert np.all(store.degrees <= 4)
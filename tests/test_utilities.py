@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from src.road_network.vertex import Vertex
+from src.road_network.segment import Segment
+from src.utilities import INTERSECTION_PREFILTER_SIZE
+from src.utilities import compute_intersection
+from src.utilities import find_closest_intersection
+
+# (min_value, max_value_one, max_value_two) of check_segment and of the
+# crossing check of stitch_tiles.
+BOUNDS = [(0.00001, 1.49999, 0.99999), (-0.00001, 1.00001, 1.00001)]
+
+
+# The closest intersection found by checking every candidate with
+# compute_intersection, as check_segment did before find_closest_intersection.
+def find_closest_intersection_scalar(segment_array, candidate_arrays, min_value, max_value_one, max_value_two):
+    segment = Segment(segment_start=Vertex(segment_array[0]), segment_end=Vertex(segment_array[1]))
+    closest_index, closest_value = None, np.inf
+    for index, candidate_array in enumerate(candidate_arrays):
+        candidate = Segment(segment_start=Vertex(candidate_array[0]), segment_end=Vertex(candidate_array[1]))
+        intersection = compute_intersection(segment, candidate)
+        if (intersection[0] > min_value and intersection[0] < max_value_one and
+           intersection[1] > min_value and intersection[1] < max_value_two and intersection[0] < closest_value):
+            closest_index, closest_value = index, intersection[0]
+    return closest_index, closest_value
+
+
+def assert_same_intersection(segment_array, candidate_arrays, bounds):
+    expected_index, expected_value = find_closest_intersection_scalar(segment_array, candidate_arrays, *bounds)
+    index, value = find_closest_intersection(segment_array, candidate_arrays, *bounds)
+    assert index == expected_index
+    assert value == pytest.approx(expected_value, rel=1e-9)
+
+
+# Random candidates around the segment, both fewer and more than the number
+# from which candidates are prefiltered by their bounding boxes.
+@pytest.mark.parametrize("bounds", BOUNDS)
+@pytest.mark.parametrize("candidate_count", [1, 5, INTERSECTION_PREFILTER_SIZE, INTERSECTION_PREFILTER_SIZE + 1, 200])
+def test_random_segments(bounds, candidate_count):
+    rng = np.random.default_rng(candidate_count)
+    for _ in range(200):
+        segment_array = rng.uniform(0, 100, (2, 2))
+        candidate_arrays = rng.uniform(-20, 120, (candidate_count, 2, 2))
+        assert_same_intersection(segment_array, candidate_arrays, bounds)
+
+
+# Segment from (0, 0) to (10, 0) against degenerate candidates: colinear,
+# parallel, of zero length, touching the segment or ending just inside or
+# outside the bounds, and crossing the extension of the segment.
+DEGENERATE_CANDIDATES = {
+    "colinear overlapping": [[2, 0], [8, 0]],
+    "colinear beyond the end": [[12, 0], [14, 0]],
+    "parallel": [[0, 1], [10, 1]],
+    "zero length on the segment": [[5, 0], [5, 0]],
+    "zero length off the segment": [[5, 1], [5, 1]],
+    "start touching the segment": [[5, 0], [5, 5]],
+    "end touching the segment": [[5, -5], [5, 0]],
+    "through the segment start": [[0, -5], [0, 5]],
+    "through the segment end": [[10, -5], [10, 5]],
+    "ending just inside the bounds": [[5, -5], [5, 0.00002 * 5 / 0.99999]],
+    "ending just outside the bounds": [[5, -5], [5, -0.00002]],
+    "crossing the extension": [[13, -5], [13, 5]],
+    "crossing beyond the extension": [[16, -5], [16, 5]],
+    "crossing behind the start": [[-1, -5], [-1, 5]],
+}
+
+
+@pytest.mark.parametrize("bounds", BOUNDS)
+@pytest.mark.parametrize("name", DEGENERATE_CANDIDATES)
+def test_degenerate_segments(bounds, name):
+    segment_array = np.array([[0, 0], [10, 0]], dtype=float)
+    assert_same_intersection(segment_array, np.array([DEGENERATE_CANDIDATES[name]], dtype=float), bounds)
+
+
+# All degenerate candidates at once, also after the prefilter, together with
+# a crossing candidate that must be found among them.
+@pytest.mark.parametrize("bounds", BOUNDS)
+@pytest.mark.parametrize("copies", [1, 3])
+def test_closest_among_degenerate_segments(bounds, copies):
+    segment_array = np.array([[0, 0], [10, 0]], dtype=float)
+    candidate_arrays = np.array(list(DEGENERATE_CANDIDATES.values()) * copies + [[[7, -1], [7, 1]]], dtype=float)
+    assert_same_intersection(segment_array, candidate_arrays, bounds)
+    assert find_closest_intersection(segment_array, candidate_arrays, *bounds)[0] is not None
@@ -1,77 +1,78 @@
-import math
-import geojson
+import os
+import sys
+import random
+import argparse
 import numpy as np
-import osmnx as ox
-import pandas as pd
-import matplotlib.pyplot as plt
-from src.road_network.vertex import Vertex
-from src.road_network.segment import Segment
 from src.config_loader import ConfigLoader
-from citygenerator import visualise
+from src.reference_network import load_reference_network
+from src.reference_network import save_reference_network
+from src.reference_network import compute_reference_stats
+from src.reference_network import download_reference_network
 
-# Import and re-use statistic functions.
-from src.stats import compute_total_road_length
-from src.stats import compute_intersection_count
-from src.stats import compute_proportion_dead_ends
-from src.stats import compute_proportion_3way_intersections
-from src.stats import compute_proportion_4way_intersections
-from src.stats import compute_orientation_histogram
-from src.stats import compute_orientation_order
-from src.stats import compute_orientation_entropy
-from src.stats import show_orientation_histogram
+# Bounding box (north, south, east, west) of Auckland matching the bbox we are using.
+AUCKLAND_BBOX = (-36.83, -36.94, 174.82, 174.68)
 
-config = ConfigLoader('input/configs/auckland.json')
-ox.config(log_console=True, use_cache=True)
-weight_by_length = False
-NUM_BINS = 36
+# Metrics compared between the reference and the generated network, with their labels.
+METRICS = [("orientation_entropy", "Entropy"), ("orientation_order", "Orientation-Order"),
+           ("average_node_degree", "Average Node Degree"), ("proportion_dead_ends", "Proportion Dead-Ends"),
+           ("proportion_3way_intersections", "Proportion 3-way Intersections"),
+           ("proportion_4way_intersections", "Proportion 4-way Intersections"),
+           ("intersection_count", "Intersection Count"), ("total_road_length", "Total Road Length")]
 
-# Grab Auckland matching the bbox we are using.
-Auckland = ox.graph_from_bbox(-36.83, -36.94, 174.82, 174.68, network_type='drive')
 
-# Extract road_segments and vertex_dict.
-vertex_dict = {}
-road_segments = []
+# INPUT:    String, (Integer)
+# OUTPUT:   Dictionary
+# Generates the road network of the config with the given seed and returns
+# its metrics.
+def compute_generated_stats(config_path, seed=42):
+    from src.stats import compute_network_stats
+    from src.road_network.road_network_generator import generate_road_network
 
-for edge in Auckland.edges:
-    start_id, end_id, _ = edge
-    start_vert = Vertex(np.array((Auckland.nodes[start_id]["x"], Auckland.nodes[start_id]["y"])))
-    end_vert = Vertex(np.array((Auckland.nodes[end_id]["x"], Auckland.nodes[end_id]["y"])))
-    road_segment = Segment(start_vert, end_vert)
-    road_segments.append(road_segment)
-    
-    if start_vert in vertex_dict:
-        if road_segment not in vertex_dict[start_vert]:
-            vertex_dict[start_vert].append(road_segment)
-    else:
-        vertex_dict[start_vert] = [road_segment]
+    config = ConfigLoader(config_path)
+    random.seed(seed)
+    np.random.seed(seed)
+    road_network, vertex_dict = generate_road_network(config)
+    return compute_network_stats(vertex_dict, road_network, config=config)
 
-    if end_vert in vertex_dict:
-        if road_segment not in vertex_dict[end_vert]:
-            vertex_dict[end_vert].append(road_segment)
-    else:
-        vertex_dict[end_vert] = [road_segment]
 
-# Call everything.
-orientation_histogram = compute_orientation_histogram(road_segments)
-entropy = compute_orientation_entropy(orientation_histogram)
-orientation_order = compute_orientation_order(entropy)
-proportion_dead_ends = compute_proportion_dead_ends(vertex_dict)
-proportion_3way_intersections = compute_proportion_3way_intersections(vertex_dict)
-proportion_4way_intersections = compute_proportion_4way_intersections(vertex_dict)
-intersection_count = compute_intersection_count(vertex_dict)
-total_road_length = ox.basic_stats(Auckland)["street_length_total"]
-avg_node_degree = ox.basic_stats(Auckland)["streets_per_node_avg"]
+# INPUT:    (List)
+# OUTPUT:   -
+# Command line entry point. Computes the metrics of a reference network
+# stored in a local file (GraphML, OSM XML or a compact .npz dump) and
+# optionally compares them with a generated network, e.g.
+#   python verify.py input/reference/auckland.graphml --config input/configs/auckland.json
+# The reference metrics are cached in --cache-dir. --download fetches the
+# Auckland network with osmnx and saves it to the reference path first.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a generated road network with a reference network.")
+    parser.add_argument("reference", help="path to the reference network (.graphml, .osm, .xml or .npz)")
+    parser.add_argument("--config", default=None, help="path to the config file of the generated network to compare with")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the generated network (default: 42)")
+    parser.add_argument("--cache-dir", default=os.getcwd() + "/output/reference_cache",
+                        help="directory of the cached reference metrics (default: output/reference_cache)")
+    parser.add_argument("--save-compact", default=None, help="also save the reference network as a compact .npz dump")
+    parser.add_argument("--download", action="store_true", help="download the Auckland network with osmnx first")
+    parser.add_argument("--show-histogram", action="store_true", help="plot the orientation histogram of the reference")
+    args = parser.parse_args(argv)
 
-print('Entropy:', entropy)
-print('Orientation-Order:', orientation_order)
-print('Average Node Degree:', avg_node_degree)
-print('Proportion Dead-Ends:', proportion_dead_ends)
-print('Proportion 3-way Intersections', proportion_3way_intersections)
-print('Proportion 4-way Intersections', proportion_4way_intersections)
-print('Intersection Count:', intersection_count)
-print('Total Road Length:', total_road_length)
+    if args.download:
+        download_reference_network(args.reference, AUCKLAND_BBOX)
+    if args.save_compact is not None:
+        save_reference_network(args.save_compact, load_reference_network(args.reference))
 
-# visualise(config.water_map_array, road_segments)
+    reference_stats = compute_reference_stats(args.reference, args.cache_dir)
+    generated_stats = compute_generated_stats(args.config, args.seed) if args.config is not None else None
 
-# Print orientation histogram.
-show_orientation_histogram(orientation_histogram, theta_direction=1)
\ No newline at end of file
+    for metric, label in METRICS:
+        if generated_stats is None:
+            print('{}:'.format(label), reference_stats[metric])
+        else:
+            print('{}: {} (generated: {})'.format(label, reference_stats[metric], generated_stats[metric]))
+
+    if args.show_histogram:
+        from src.stats import show_orientation_histogram
+        show_orientation_histogram(reference_stats["orientation_histogram"], theta_direction=1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])